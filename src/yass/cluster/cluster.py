@@ -108,7 +108,8 @@ class Cluster(object):
         # save clusters
         self.save_result(indices_train_final, templates_final)
 
-    def cluster(self, current_indices, local, gen, branch, hist):
+    def cluster(self, current_indices, local, gen, branch, hist,
+                rhat_init=None):
 
         ''' Recursive clustering function
             channel: current channel being clusterd
@@ -116,6 +117,8 @@ class Cluster(object):
             sic = spike_indices of spikes on current channel
             gen = generation of cluster; increases with each clustering step        
             hist = is the current branch parent history
+            rhat_init = parent's soft assignments of current_indices, used
+                to warm start mfm if warm_start is on
         '''
 
         if self.min(current_indices.shape[0]): return 
@@ -132,12 +135,14 @@ class Cluster(object):
             idx_keep = self.knn_triage_step(gen, pca_wf)
             pca_wf = pca_wf[idx_keep]
             current_indices = current_indices[idx_keep]
+            if rhat_init is not None:
+                rhat_init = rhat_init[idx_keep]
 
         ## subsample if too many
         #pca_wf_subsample = self.subsample_step(gen, pca_wf_triage)
         ## run mfm
         #vbParam1 = self.run_mfm(gen, pca_wf_subsample)
-        vbParam2 = self.run_mfm(gen, pca_wf)
+        vbParam2 = self.run_mfm(gen, pca_wf, rhat_init)
 
         ## recover spikes using soft-assignments
         #idx_recovered, vbParam2 = self.recover_step(gen, vbParam1, pca_wf)
@@ -169,7 +174,8 @@ class Cluster(object):
         # multiple clusters
         else:
             self.multi_cluster_step(current_indices, pca_wf, local,
-                                    cc_assignment, gen, branch, hist)
+                                    cc_assignment, gen, branch, hist,
+                                    vbParam2.rhat)
 
     def save_metadata(self, pca_wf_all, vbParam, cc_label, current_indices, local,
                         gen, branch, hist):
@@ -255,6 +261,12 @@ class Cluster(object):
         self.center_spike_size = self.CONFIG.center_spike_size
         self.neighbors = self.CONFIG.neigh_channels
         self.triage_value = self.CONFIG.cluster.knn_triage
+        # approximate/parallel knn queries for triage
+        self.knn_eps = self.CONFIG.cluster.knn_eps
+        self.knn_n_jobs = self.CONFIG.cluster.knn_n_jobs
+        # start child generations from the parent's mfm fit
+        self.warm_start = self.CONFIG.cluster.warm_start
+        self.elbo_tol = self.CONFIG.cluster.elbo_tol
 
         # random subsample, remove edge spikes
         #self.clean_input_data()
@@ -664,14 +676,18 @@ class Cluster(object):
 
         return pca_wf
 
-    def run_mfm(self, gen, pca_wf):
+    def run_mfm(self, gen, pca_wf, rhat_init=None):
 
         mask = np.ones((pca_wf.shape[0], 1))
         group = np.arange(pca_wf.shape[0])
+        if not self.warm_start:
+            rhat_init = None
         vbParam = mfm.spikesort(pca_wf[:,:,np.newaxis],
                                 mask,
                                 group,
-                                self.CONFIG)
+                                self.CONFIG,
+                                rhat_init,
+                                self.elbo_tol)
 
         if self.verbose:
             print("chan "+ str(self.channel)+', gen '\
@@ -687,7 +703,9 @@ class Cluster(object):
         knn_triage_threshold = 100*(1-self.triage_value)
 
         if pca_wf.shape[0] > 1/self.triage_value:
-            idx_keep = knn_triage(knn_triage_threshold, pca_wf)
+            idx_keep = knn_triage(knn_triage_threshold,
+                                  KNNIndex(pca_wf, self.knn_eps,
+                                           self.knn_n_jobs))
             idx_keep = np.where(idx_keep==1)[0]
         else:
             idx_keep = np.arange(pca_wf.shape[0])
@@ -715,7 +733,8 @@ class Cluster(object):
             pca_wf_temp[i*min_spikes:(i+1)*min_spikes]= np.random.multivariate_normal(muhat[i], cov[i], min_spikes)
             #assignment_temp[i*min_spikes:(i+1)*min_spikes] = i
 
-        kdist_temp = knn_dist(pca_wf_temp)
+        kdist_temp = knn_dist(KNNIndex(pca_wf_temp, self.knn_eps,
+                                       self.knn_n_jobs))
         kdist_temp = kdist_temp[:,1:]
 
         median_distances = np.zeros([cov.shape[0]])
@@ -724,7 +743,8 @@ class Cluster(object):
             median_distances[i] = np.percentile(np.sum(kdist_temp[i*min_spikes:(i+1)*min_spikes], axis = 1), 90)
 
         ## The percentile value also needs to be tested, value of 50 and scale of 1.2 works wells
-        kdist = np.sum(knn_dist(pca_wf)[:, 1:], axis=1)
+        kdist = np.sum(knn_dist(KNNIndex(pca_wf, self.knn_eps,
+                                         self.knn_n_jobs))[:, 1:], axis=1)
         min_threshold = np.percentile(kdist, 100*float(self.CONFIG.cluster.min_spikes)/len(kdist))
         threshold = max(np.median(median_distances), min_threshold)
         idx_keep = kdist <= threshold
@@ -949,7 +969,7 @@ class Cluster(object):
                         " skipping ...")  
              
     def multi_cluster_step(self, current_indices, pca_wf, local, cc_assignment,
-                                gen, branch_current, hist):
+                                gen, branch_current, hist, rhat=None):
         
         # if self.plotting and gen<20:
             # self.plot_clustering_scatter(gen, pca_wf, cc_assignment,
@@ -969,8 +989,9 @@ class Cluster(object):
             # Cat: TODO: this list append is not pythonic
             local_hist=list(hist)
             local_hist.append(branch_current)
+            rhat_next = rhat[idx] if rhat is not None else None
             self.cluster(current_indices[idx],local, gen+1, branch_next,
-                         local_hist)
+                         local_hist, rhat_next)
 
     def get_templates_on_all_channels(self, indices_in):
         
@@ -1062,19 +1083,53 @@ class Cluster(object):
                  templates=templates
                 )
 
+class KNNIndex(object):
+    ''' Nearest neighbours of every point of pca_wf. The distances of
+        the largest query so far are kept, so knn_triage (k=6) and
+        knn_dist (k=30) given the same index share one query
+
+        eps > 0 gives approximate neighbours (the k-th one is within a
+        factor 1+eps of the true k-th distance), much faster on large
+        clusters. n_jobs queries in parallel (-1 uses all cores)
+    '''
+
+    def __init__(self, pca_wf, eps=0, n_jobs=1):
+
+        self.pca_wf = pca_wf
+        self.eps = eps
+        self.n_jobs = n_jobs
+        self.tree = cKDTree(pca_wf)
+        self.dist = None
+
+    def query(self, k):
+
+        if self.dist is None or self.dist.shape[1] < k:
+            try:
+                self.dist = self.tree.query(self.pca_wf, k=k, eps=self.eps,
+                                            workers=self.n_jobs)[0]
+            except TypeError:
+                # scipy < 1.6
+                self.dist = self.tree.query(self.pca_wf, k=k, eps=self.eps,
+                                            n_jobs=self.n_jobs)[0]
+
+        return self.dist[:, :k]
+
 def knn_triage(th, pca_wf):
+    ''' pca_wf can be features or a KNNIndex built on them
+    '''
+    if not isinstance(pca_wf, KNNIndex):
+        pca_wf = KNNIndex(pca_wf)
 
-    tree = cKDTree(pca_wf)
-    dist, ind = tree.query(pca_wf, k=6)
-    dist = np.sum(dist, 1)
+    dist = np.sum(pca_wf.query(6), 1)
 
     idx_keep1 = dist <= np.percentile(dist, th)
     return idx_keep1
 
 def knn_dist(pca_wf):
-    tree = cKDTree(pca_wf)
-    dist, ind = tree.query(pca_wf, k=30)
-    return dist
+    if not isinstance(pca_wf, KNNIndex):
+        pca_wf = KNNIndex(pca_wf)
+
+    return pca_wf.query(30)
 
 def connecting_points(points, index, neighbors, t_diff, keep=None):
 
@@ -10,153 +10,161 @@ from tqdm import tqdm
 # CONFIG = read_config()
 # os.environ["CUDA_VISIBLE_DEVICES"] = str(CONFIG.resources.gpu_id)
 
+
+def get_device(denoiser=None):
+    ''' Run on the device of the denoiser if there is one, otherwise on
+        gpu if available and cpu if not
+    '''
+    if denoiser is not None:
+        return next(denoiser.parameters()).device
+    if torch.cuda.is_available():
+        return torch.device('cuda')
+    return torch.device('cpu')
+
+
+def partition_spikes(spike_times, idx_list):
+    ''' Sort spikes by time once and find the range of spikes falling in
+        each batch [start, end) with searchsorted
+
+        returns order (spike ids sorted by time) and bounds, spikes of
+        batch k are order[bounds[k, 0]:bounds[k, 1]]
+    '''
+    order = np.argsort(spike_times, kind='mergesort')
+    bounds = np.searchsorted(spike_times[order], idx_list)
+
+    return order, bounds
+
+
+def get_snippets(dat, times, channels, t_range):
+    ''' Gather dat[times + t_range, channels] for every spike in one
+        indexing op, dat is a (n_times, n_channels) tensor. Channels equal
+        to n_channels (padding) give zeros
+    '''
+    n_channels = dat.shape[1]
+    pad = channels >= n_channels
+    channels = torch.clamp(channels, max=n_channels-1)
+
+    wfs = dat[times[:, None] + t_range, channels[:, None]]
+    if pad.any():
+        wfs[pad] = 0
+
+    return wfs
+
+
+def denoise(wfs, denoiser, block_size):
+    ''' Run the denoiser on (n_spikes, n_times) wfs in blocks of at most
+        block_size spikes
+    '''
+    denoised_wfs = torch.empty_like(wfs)
+    with torch.no_grad():
+        for j in range(0, wfs.shape[0], block_size):
+            denoised_wfs[j:j+block_size] = denoiser(
+                wfs[j:j+block_size])[0]
+
+    return denoised_wfs
+
+
+def ptp(wfs):
+    return torch.max(wfs, 1)[0] - torch.min(wfs, 1)[0]
+
+
 class GETPTP(object):
+
+    # number of spikes per denoiser call
+    block_size = 10000
+
     def __init__(self, fname_spike_index, reader, CONFIG, denoiser=None):
-        
+
         os.environ["CUDA_VISIBLE_DEVICES"] = str(CONFIG.resources.gpu_id)
-        
+
         self.spike_index = np.load(fname_spike_index)
-        self.spike_index = torch.from_numpy(self.spike_index).long().cuda()
         self.reader = reader
         self.denoiser = denoiser
-        
+        self.device = get_device(denoiser)
+
         if denoiser is not None:
             self.n_times = denoiser.out.weight.shape[0]
         else:
             self.n_times = reader.spike_size
-        
-    def compute_ptps(self):
-
-        t_range = torch.arange(-(self.n_times//2), self.n_times//2+1).cuda()
-        
-        ptps_raw = torch.zeros(self.spike_index.shape[0]).float().cuda()
-        if self.denoiser is not None:
-            ptps_denoised = torch.zeros(self.spike_index.shape[0]).float().cuda()
-        else:
-            ptps_denoised = None
-        
-        # batch offsets
-        offsets = torch.from_numpy(self.reader.idx_list[:, 0] - self.reader.buffer).cuda().long()
 
-        with tqdm(total=self.reader.n_batches) as pbar:
+    def iterate_batches(self, spike_index):
+        ''' Yield, for every batch with spikes, the spike ids (rows of
+            spike_index) in the batch and their snippets on their channel
+        '''
+        t_range = torch.arange(-(self.n_times//2), self.n_times//2+1,
+                               device=self.device)
+        order, bounds = partition_spikes(spike_index[:, 0],
+                                         self.reader.idx_list)
 
-            for batch_id in range(self.reader.n_batches):
+        for batch_id in tqdm(range(self.reader.n_batches)):
 
-                # load residual data
-                dat = self.reader.read_data_batch(batch_id, add_buffer=True)
-                dat = torch.from_numpy(dat).cuda()
+            idx_in = order[bounds[batch_id, 0]:bounds[batch_id, 1]]
 
-                # relevant idx
-                idx_in = torch.nonzero(
-                    (self.spike_index[:, 0] > self.reader.idx_list[batch_id][0]) & 
-                    (self.spike_index[:, 0] < self.reader.idx_list[batch_id][1]))[:,0]
+            # skip if no spikes
+            if len(idx_in) == 0:
+                continue
 
-                spike_index_batch = self.spike_index[idx_in]
-                spike_index_batch[:, 0] -= offsets[batch_id]
+            # load data
+            dat = self.reader.read_data_batch(batch_id, add_buffer=True)
+            dat = torch.from_numpy(dat).float().to(self.device)
 
-                # skip if no spikes
-                if len(spike_index_batch) == 0:
-                    continue
+            # spike times relative to the buffered batch
+            offset = self.reader.idx_list[batch_id, 0] - self.reader.buffer
+            spike_index_batch = torch.from_numpy(
+                spike_index[idx_in]).long().to(self.device)
 
-                # get residual snippets
-                t_index = spike_index_batch[:, 0][:, None] + t_range
-                c_index = spike_index_batch[:,1].long()
+            wfs = get_snippets(dat,
+                               spike_index_batch[:, 0] - offset,
+                               spike_index_batch[:, 1],
+                               t_range)
 
-                dat = torch.cat((dat, torch.zeros((dat.shape[0], 1)).cuda()), 1)
-                wfs = dat[t_index, c_index[:,None]]
-                ptps_raw[idx_in] = (torch.max(wfs, 1)[0] - torch.min(wfs, 1)[0])
+            yield idx_in, wfs
 
-                if self.denoiser is not None:
-                    n_sample_run = 1000
-
-                    idx_list = np.hstack((
-                        np.arange(0, wfs.shape[0], n_sample_run), wfs.shape[0]))
-                    denoised_wfs = torch.zeros_like(wfs).cuda()
-                    #print ("denoised_wfs; ", denoised_wfs.shape)
-                    #print ("wfs; ", wfs.shape)
-                    for j in range(len(idx_list)-1):
-                        #print ("idx_list[j], j+1: ", idx_list[j], idx_list[j+1])
-                        denoised_wfs[idx_list[j]:idx_list[j+1]] = self.denoiser(
-                            wfs[idx_list[j]:idx_list[j+1]])[0].data
-                    ptps_denoised[idx_in] = (torch.max(denoised_wfs, 1)[0] - torch.min(denoised_wfs, 1)[0])
-
-                pbar.update()
-
-        ptps_raw_cpu = ptps_raw.cpu().numpy()
-
-        del dat, idx_in, spike_index_batch, t_index, c_index, wfs, ptps_raw
+    def compute_ptps(self):
 
+        ptps_raw = np.zeros(self.spike_index.shape[0], 'float32')
         if self.denoiser is not None:
-            ptps_denoised_cpu = ptps_denoised.cpu().numpy()
-            del denoised_wfs, ptps_denoised
-        else:
-            ptps_denoised_cpu = np.copy(ptps_raw_cpu)
+            ptps_denoised = np.zeros(self.spike_index.shape[0], 'float32')
 
-        torch.cuda.empty_cache()
+        for idx_in, wfs in self.iterate_batches(self.spike_index):
 
-        return ptps_raw_cpu, ptps_denoised_cpu
-    
-    
-    def compute_wfs(self, idx):
+            ptps_raw[idx_in] = ptp(wfs).cpu().numpy()
 
-        t_range = torch.arange(-(self.n_times_nn//2), self.n_times_nn//2+1).cuda()
-        
-        wfs_raw = torch.zeros(len(idx), self.n_times_nn).float().cuda()
-        wfs_denoised = torch.zeros(len(idx), self.n_times_nn).float().cuda()
-        
-        spike_index_in = self.spike_index[idx]
-        with tqdm(total=self.reader.n_batches) as pbar:
+            if self.denoiser is not None:
+                denoised_wfs = denoise(wfs, self.denoiser, self.block_size)
+                ptps_denoised[idx_in] = ptp(denoised_wfs).cpu().numpy()
 
-            for batch_id in range(self.reader.n_batches):
+        if self.denoiser is None:
+            ptps_denoised = np.copy(ptps_raw)
 
-                # load residual data
-                dat = self.reader.read_data_batch(batch_id, add_buffer=True)
-                dat = torch.from_numpy(dat).cuda()
+        if self.device.type == 'cuda':
+            torch.cuda.empty_cache()
 
-                # relevant idx
-                idx_in = torch.nonzero(
-                    (spike_index_in[:, 0] > self.reader.idx_list[batch_id][0]) & 
-                    (spike_index_in[:, 0] < self.reader.idx_list[batch_id][1]))[:,0]
+        return ptps_raw, ptps_denoised
 
-                spike_index_batch = spike_index_in[idx_in] 
-                spike_index_batch[:, 0] -= (self.reader.idx_list[batch_id][0] - 
-                                            self.reader.buffer)
 
-                # get residual snippets
-                t_index = spike_index_batch[:, 0][:, None] + t_range
-                c_index = spike_index_batch[:,1].long()
+    def compute_wfs(self, idx):
 
-                dat = torch.cat((dat, torch.zeros((dat.shape[0], 1)).cuda()), 1)
-                wfs = dat[t_index, c_index[:,None]]
+        wfs_raw = np.zeros((len(idx), self.n_times), 'float32')
+        wfs_denoised = np.zeros((len(idx), self.n_times), 'float32')
 
-                n_sample_run = 1000
+        for idx_in, wfs in self.iterate_batches(self.spike_index[idx]):
 
-                idx_list = np.hstack((
-                    np.arange(0, wfs.shape[0], n_sample_run), wfs.shape[0]))
-                denoised_wfs = torch.zeros_like(wfs).cuda()
-                for j in range(len(idx_list)-1):
-                    denoised_wfs[idx_list[j]:idx_list[j+1]] = self.denoiser(
-                        wfs[idx_list[j]:idx_list[j+1]])[0]
+            wfs_raw[idx_in] = wfs.cpu().numpy()
+            wfs_denoised[idx_in] = denoise(
+                wfs, self.denoiser, self.block_size).cpu().numpy()
 
-                wfs_raw[idx_in] = wfs.data
-                wfs_denoised[idx_in] = denoised_wfs.data
-                
-                pbar.update()
+        return wfs_raw, wfs_denoised
 
-        return wfs_raw.cpu().numpy(), wfs_denoised.cpu().numpy()
 
-    
-class GETCLEANPTP(object):
+class GETCLEANPTP(GETPTP):
     def __init__(self, fname_spike_index, fname_labels,
                  fname_templates, fname_shifts, fname_scales,
                  reader_residual, denoiser=None):
 
         self.spike_index = np.load(fname_spike_index)
-        self.spike_index = torch.from_numpy(self.spike_index).long().cuda()
-        
         self.labels = np.load(fname_labels)
-        self.labels = torch.from_numpy(self.labels).long().cuda()
-        
+
         templates = np.load(fname_templates)
         mcs = templates.ptp(1).argmax(1)
         n_units, n_times, n_channels = templates.shape
@@ -165,13 +173,12 @@ class GETCLEANPTP(object):
             self.templates[k] = templates[k, :, mcs[k]]
 
         self.shifts = np.load(fname_shifts)
-        self.shifts = torch.from_numpy(self.shifts).float().cuda()
-
         self.scales = np.load(fname_scales)
-        self.scales = torch.from_numpy(self.scales).float().cuda()
 
+        self.reader = reader_residual
         self.reader_residual = reader_residual
         self.denoiser = denoiser
+        self.device = get_device(denoiser)
 
         if self.denoiser is not None:
             self.n_times = denoiser.out.weight.shape[0]
@@ -179,15 +186,16 @@ class GETCLEANPTP(object):
         else:
             self.n_times = n_times
 
-        self.templates = torch.from_numpy(self.templates).float().cuda()
+        self.templates = torch.from_numpy(
+            self.templates).float().to(self.device)
 
     def crop_templates(self):
-        
+
         n_times_templates = self.templates.shape[1]
         if n_times_templates > self.n_times:
             n_diff = (n_times_templates - self.n_times)//2
             self.templates = self.templates[:, n_diff:-n_diff]
-            
+
         elif n_times_templates < self.n_times:
             n_diff = (self.n_times - n_times_templates)//2
             buffer = np.zeros((self.templates.shape[0], n_diff), 'float32')
@@ -195,73 +203,33 @@ class GETCLEANPTP(object):
 
     def compute_ptps(self):
 
-        t_range = torch.arange(-(self.n_times//2), self.n_times//2+1).cuda()
-        
-        ptps_raw = torch.zeros(self.spike_index.shape[0]).float().cuda()
+        ptps_raw = np.zeros(self.spike_index.shape[0], 'float32')
         if self.denoiser is not None:
-            ptps_denoised = torch.zeros(self.spike_index.shape[0]).float().cuda()
-        else:
-            ptps_denoised = None
+            ptps_denoised = np.zeros(self.spike_index.shape[0], 'float32')
 
-        # batch offsets
-        offsets = torch.from_numpy(self.reader_residual.idx_list[:, 0]
-                                   - self.reader_residual.buffer).cuda().long()
+        for idx_in, residuals in self.iterate_batches(self.spike_index):
 
-        with tqdm(total=self.reader_residual.n_batches) as pbar:
+            # TODO: align residuals
+            #shifts_batch = self.shifts[idx_in]
+            #residuals = shift_chans(residuals, -shifts_batch)
 
-            for batch_id in range(self.reader_residual.n_batches):
+            # make clean wfs
+            labels = torch.from_numpy(self.labels[idx_in]).long().to(
+                self.device)
+            scales = torch.from_numpy(self.scales[idx_in]).float().to(
+                self.device)
+            wfs = residuals + scales[:, None]*self.templates[labels]
 
-                # load residual data
-                dat = self.reader_residual.read_data_batch(batch_id, add_buffer=True)
-                dat = torch.from_numpy(dat).cuda()
+            ptps_raw[idx_in] = ptp(wfs).cpu().numpy()
 
-                # relevant idx
-                idx_in = torch.nonzero(
-                    (self.spike_index[:, 0] > self.reader_residual.idx_list[batch_id][0]) & 
-                    (self.spike_index[:, 0] < self.reader_residual.idx_list[batch_id][1]))[:,0]
+            if self.denoiser is not None:
+                denoised_wfs = denoise(wfs, self.denoiser, self.block_size)
+                ptps_denoised[idx_in] = ptp(denoised_wfs).cpu().numpy()
 
-                spike_index_batch = self.spike_index[idx_in] 
-                spike_index_batch[:, 0] -= offsets[batch_id]
+        if self.denoiser is None:
+            ptps_denoised = np.copy(ptps_raw)
 
-                # get residual snippets
-                t_index = spike_index_batch[:, 0][:, None] + t_range
-                c_index = spike_index_batch[:,1].long()
-
-                dat = torch.cat((dat, torch.zeros((dat.shape[0], 1)).cuda()), 1)
-                residuals = dat[t_index, c_index[:,None]]
-                
-                # TODO: align residuals
-                #shifts_batch = self.shifts[idx_in]
-                #residuals = shift_chans(residuals, -shifts_batch)
-
-                # make clean wfs
-                wfs = residuals + self.scales[idx_in][:, None]*self.templates[self.labels[idx_in]]
-
-                ptps_raw[idx_in] = (torch.max(wfs, 1)[0] - torch.min(wfs, 1)[0])
-
-                if self.denoiser is not None:
-                    n_sample_run = 1000
-
-                    idx_list = np.hstack((
-                        np.arange(0, wfs.shape[0], n_sample_run), wfs.shape[0]))
-                    denoised_wfs = torch.zeros_like(wfs).cuda()
-                    for j in range(len(idx_list)-1):
-                        denoised_wfs[idx_list[j]:idx_list[j+1]] = self.denoiser(
-                            wfs[idx_list[j]:idx_list[j+1]])[0].data
-                    ptps_denoised[idx_in] = (torch.max(denoised_wfs, 1)[0] - torch.min(denoised_wfs, 1)[0])
-
-                pbar.update()
-
-        ptps_raw_cpu = ptps_raw.cpu().numpy()
-
-        del dat, idx_in, spike_index_batch, t_index, c_index, residuals, wfs, ptps_raw
-
-        torch.cuda.empty_cache()
-
-        if self.denoiser is not None:
-            ptps_denoised_cpu = ptps_denoised.cpu().numpy()
-            del denoised_wfs, ptps_denoised
-        else:
-            ptps_denoised_cpu = np.copy(ptps_raw_cpu)
+        if self.device.type == 'cuda':
+            torch.cuda.empty_cache()
 
-        return ptps_raw_cpu, ptps_denoised_cpu
+        return ptps_raw, ptps_denoised
@@ -1,8 +1,8 @@
 import logging
+import multiprocessing as mp
 import numpy as np
 import os
 from tqdm import tqdm
-import parmap
 
 from yass import read_config
 from yass.reader import READER
@@ -91,13 +91,15 @@ def run(output_directory,
                         recording_dtype,
                         CONFIG,
                         CONFIG.resources.n_sec_chunk_gpu_deconv,
-                        chunk_sec = CONFIG.clustering_chunk)
+                        chunk_sec = CONFIG.clustering_chunk,
+                        mmap=True)
     if fname_residual is not None:
         reader_resid = READER(fname_residual,
                               residual_dtype,
                               CONFIG,
                               CONFIG.resources.n_sec_chunk_gpu_deconv,
-                              chunk_sec = CONFIG.clustering_chunk
+                              chunk_sec = CONFIG.clustering_chunk,
+                              mmap=True
                              )
     else:
         reader_resid = None
@@ -194,9 +196,9 @@ def run(output_directory,
         if not os.path.exists(tmp_save_dir):
             os.makedirs(tmp_save_dir)
 
-        # Cat: TODO: this parallelization may not be optimally asynchronous
-        # make arg list first
-        args_in = []
+        # one task per partition not done yet. readers and CONFIG2 are the
+        # same for every task and are sent once to each worker
+        tasks = []
         for ctr, unit in enumerate(units):
 
             # check to see if chunk + channel already completed
@@ -206,26 +208,17 @@ def run(output_directory,
             # skip 
             if os.path.exists(filename_postclustering):
                 continue
-            args_in.append([raw_data,
-                            full_run,
-                            CONFIG2,
-                            reader_raw,
-                            reader_resid,
-                            filename_postclustering,
-                            fnames_input[ctr]])
+            tasks.append([filename_postclustering, fnames_input[ctr]])
 
         logger.info("starting clustering")
         if CONFIG.resources.multi_processing:
-            parmap.map(Cluster, args_in, 
-                       processes=CONFIG.resources.n_processors,
-                       pm_pbar=True)
-
+            n_processors = CONFIG.resources.n_processors
         else:
-            with tqdm(total=len(args_in)) as pbar:
-                for arg_in in args_in:
-                    Cluster(arg_in)
-                    pbar.update()
-
+            n_processors = 1
+        run_cluster_tasks(tasks,
+                          [raw_data, full_run, CONFIG2,
+                           reader_raw, reader_resid],
+                          n_processors)
 
         # first gather clustering result
         fname_templates_out, fname_spike_train_out = gather_clustering_result(
@@ -278,3 +271,57 @@ def run(output_directory,
     #    np.save(check_zero_out, None)
 
     return fname_templates_out, fname_spike_train_out
+
+
+# clustering inputs shared by all tasks of a worker process, set once by
+# init_cluster_worker
+_cluster_shared = None
+
+
+def init_cluster_worker(shared):
+    global _cluster_shared
+    _cluster_shared = shared
+
+
+def run_cluster_task(task):
+    Cluster(list(_cluster_shared) + list(task))
+
+    return task[0]
+
+
+def partition_size(fname_input):
+    ''' number of spikes to cluster in a partition saved by load_waveforms
+    '''
+    with np.load(fname_input) as input_data:
+        return len(input_data['spike_times'])
+
+
+def run_cluster_tasks(tasks, shared, n_processors):
+    ''' Run Cluster on every [filename_postclustering, fname_input] task
+
+    Partitions range from a few to max_n_spikes spikes, so tasks are sent
+    largest first, one at a time, to whichever worker is free. shared
+    ([raw_data, full_run, CONFIG2, reader_raw, reader_resid]) is given
+    to each worker once through the pool initializer
+    '''
+    sizes = [partition_size(task[1]) for task in tasks]
+    order = np.argsort(sizes, kind='mergesort')[::-1]
+    tasks = [tasks[j] for j in order]
+
+    if n_processors > 1 and len(tasks) > 1:
+        pool = mp.Pool(min(n_processors, len(tasks)),
+                       initializer=init_cluster_worker,
+                       initargs=(shared,))
+        try:
+            for _ in tqdm(pool.imap_unordered(run_cluster_task, tasks,
+                                              chunksize=1),
+                          total=len(tasks)):
+                pass
+        finally:
+            pool.close()
+            pool.join()
+
+    else:
+        init_cluster_worker(shared)
+        for task in tqdm(tasks):
+            run_cluster_task(task)
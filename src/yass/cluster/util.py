@@ -416,8 +416,8 @@ def load_align_waveforms_parallel(labels_in,
         neighbor_chans = np.where(CONFIG.neigh_channels[channel])[0]
 
         if raw_data:
-            wf, skipped_idx = reader_raw.read_waveforms(
-                spike_times, spike_size_read, neighbor_chans)
+            wf, skipped_idx = reader_raw.read_waveforms_bulk(
+                spike_times, neighbor_chans, spike_size_read)
             spike_times = np.delete(spike_times, skipped_idx)
 
         else:
@@ -609,8 +609,8 @@ def load_waveforms_parallel(labels_in,
         neighbor_chans = np.where(CONFIG.neigh_channels[channel])[0]
 
         if raw_data:
-            wf, skipped_idx = reader_raw.read_waveforms(
-                spike_times, spike_size_read, neighbor_chans)
+            wf, skipped_idx = reader_raw.read_waveforms_bulk(
+                spike_times, neighbor_chans, spike_size_read)
             spike_times = np.delete(spike_times, skipped_idx)
 
         else:
@@ -630,8 +630,8 @@ def load_waveforms_parallel(labels_in,
             scales_ = scales[idx_][idx_sampled]
  
             # get clean waveforms
-            resid_, skipped_idx = reader_resid.read_waveforms(
-                spike_times, spike_size_read, neighbor_chans)
+            resid_, skipped_idx = reader_resid.read_waveforms_bulk(
+                spike_times, neighbor_chans, spike_size_read)
             # delete edge spike data
             spike_times = np.delete(spike_times, skipped_idx)
             template_ids_in = np.delete(template_ids_in, skipped_idx)
@@ -0,0 +1,187 @@
+"""Content addressed cache for the deconvolution initialization
+
+The shift svd decomposition, temp_temp convolutions and bspline
+coefficients only depend on the templates, the svd rank, the pad/jitter
+lengths, the geometry, the neighbouring channels and the sampling rate.
+Entries are keyed by a hash of those inputs so
+that every deconv run (iterative blocks, pre final and final deconv,
+repeated runs) using the same templates shares one copy.
+
+Each entry is a folder of plain .npy files that can be memory mapped.
+Ragged lists (one array per template) are stored as a flat data array plus
+the shape of every element, no pickling involved.
+"""
+import errno
+import hashlib
+import logging
+import os
+import shutil
+import time
+
+import numpy as np
+
+from yass.util import replace_file
+
+
+logger = logging.getLogger(__name__)
+
+# bump whenever the content or layout of an entry changes, so that entries
+# written by older versions are not used
+INIT_CACHE_VERSION = '2'
+
+
+def init_cache_key(templates, rank, pad_len, jitter_len, geom,
+                   neigh_channels, sampling_rate):
+    """Hash of everything the deconv initialization depends on
+
+    Parameters
+    ----------
+    templates: numpy.ndarray
+        Templates used by the deconvolution
+    rank: int
+        Rank of the shift svd
+    pad_len, jitter_len: int
+        Padding and jitter of the temp_temp computation
+    geom: numpy.ndarray
+        Channel geometry
+    neigh_channels: numpy.ndarray
+        Neighbouring channels (n_channels, n_channels) boolean matrix
+    sampling_rate: int
+        Recording sampling rate
+    """
+    templates = np.ascontiguousarray(templates, dtype='float32')
+    geom = np.ascontiguousarray(geom, dtype='float64')
+    neigh_channels = np.ascontiguousarray(neigh_channels, dtype='bool')
+
+    h = hashlib.sha1()
+    h.update('version {}'.format(INIT_CACHE_VERSION).encode())
+    h.update(str(templates.shape).encode())
+    h.update(templates.tobytes())
+    h.update(str(geom.shape).encode())
+    h.update(geom.tobytes())
+    h.update(str(neigh_channels.shape).encode())
+    h.update(neigh_channels.tobytes())
+    h.update('sampling rate {}'.format(float(sampling_rate)).encode())
+    h.update('{} {} {}'.format(int(rank), int(pad_len),
+                               int(jitter_len)).encode())
+
+    return h.hexdigest()
+
+
+class InitCache(object):
+    """Folder of cache entries, evicted by least recent use
+
+    Parameters
+    ----------
+    root: str
+        Folder holding the cache entries
+    max_size: int
+        Maximum total size (in bytes) of the cache, least recently used
+        entries are deleted once it is exceeded
+    """
+
+    def __init__(self, root, max_size):
+        self.root = root
+        self.max_size = max_size
+
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+
+    def entry_dir(self, key):
+        return os.path.join(self.root, key)
+
+    def has(self, key, names):
+        """True if all arrays in names are cached under key
+        """
+        return all(os.path.exists(self._fname(key, name))
+                   for name in names)
+
+    def load(self, key, name, mmap_mode='r'):
+        """Load an array saved with save
+        """
+        self.touch(key)
+        return np.load(self._fname(key, name), mmap_mode=mmap_mode)
+
+    def load_list(self, key, name, mmap_mode='r'):
+        """Load a list of arrays saved with save_list, elements are views
+        into one (memory mapped) array
+        """
+        self.touch(key)
+        data = np.load(self._fname(key, name), mmap_mode=mmap_mode)
+        shapes = np.load(self._fname(key, name+'_shapes'))
+
+        sizes = np.prod(shapes, axis=1).astype('int64')
+        offsets = np.hstack((0, np.cumsum(sizes)))
+
+        return [data[offsets[j]:offsets[j+1]].reshape(shapes[j])
+                for j in range(len(shapes))]
+
+    def save(self, key, name, array):
+        self._write(key, name, np.asarray(array))
+
+    def save_list(self, key, name, arrays):
+        """Save a list of arrays with same dtype and number of dimensions
+        """
+        arrays = [np.asarray(array) for array in arrays]
+        shapes = np.array([array.shape for array in arrays], 'int64')
+        if len(arrays) > 0:
+            data = np.hstack([array.ravel() for array in arrays])
+        else:
+            data = np.zeros(0)
+
+        # data goes last, an entry is complete once it exists
+        self._write(key, name+'_shapes', shapes)
+        self._write(key, name, data)
+
+    def touch(self, key):
+        """Mark an entry as used now
+        """
+        os.utime(self.entry_dir(key), None)
+
+    def evict(self, keep=None):
+        """Delete least recently used entries until the cache fits in
+        max_size, the entry keep is never deleted
+        """
+        entries = []
+        for key in os.listdir(self.root):
+            path = self.entry_dir(key)
+            if not os.path.isdir(path):
+                continue
+            # entries can be deleted by another run while listing
+            try:
+                size = sum(os.path.getsize(os.path.join(path, f))
+                           for f in os.listdir(path))
+                entries.append((os.path.getmtime(path), size, key))
+            except OSError:
+                continue
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in sorted(entries):
+            if total <= self.max_size:
+                break
+            if key == keep:
+                continue
+            logger.info('deleting deconv init cache entry %s', key)
+            shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+            total -= size
+
+    def _fname(self, key, name):
+        return os.path.join(self.entry_dir(key), name+'.npy')
+
+    def _write(self, key, name, array):
+        ''' Write to a temporary file and rename it, so that concurrent
+            deconv runs never read a partially written array
+        '''
+        path = self.entry_dir(key)
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            # another run created it in the meantime
+            if e.errno != errno.EEXIST:
+                raise
+
+        fname = self._fname(key, name)
+        fname_tmp = '{}.{}.{}.tmp'.format(fname, os.getpid(), time.time())
+        with open(fname_tmp, 'wb') as f:
+            np.save(f, array, allow_pickle=False)
+        replace_file(fname_tmp, fname)
@@ -0,0 +1,123 @@
+import numpy as np
+import torch
+
+from yass.deconvolve.match_pursuit_gpu_new import deconvGPU
+
+
+def bspline_basis(delta, order=3):
+    ''' Values of the (order + 1) uniform B-spline bases that are non zero
+        at a fractional offset delta (in [0, 1)) from a knot
+
+        Same recursion as the cuda kernel (interpSub_kernels.cu), delta can
+        be a tensor of any shape, bases are stacked in the last dimension
+    '''
+    basis = delta.new_zeros(delta.shape + (order+1,))
+    for path in range(2**order):
+        split = 2**order
+        imj = 0
+        coef = torch.ones_like(delta)
+        for m in range(1, order+1):
+            split //= 2
+            if path < split:
+                coef = coef*(m - imj - delta)/m
+                imj += 1
+            else:
+                coef = coef*(delta + imj)/m
+            path = path % split
+        basis[..., order - imj] += coef
+
+    return basis
+
+
+class deconvCPU(deconvGPU):
+    ''' Match pursuit deconvolution on cpu
+
+        Same algorithm and interface (initialize, run(chunk_id),
+        gather_results) as deconvGPU, the cuda extensions for spline
+        subtraction and refractory fill are replaced by batched scatter
+        adds over all (spike, visible unit) pairs
+    '''
+
+    device = torch.device('cpu')
+
+    # number of (spike, visible unit) pairs per scatter add
+    pair_block_size = 50000
+
+    def coefficients_to_gpu(self, vis_units):
+        ''' Put spline coefficients of all templates in one
+            (n visible units in total, n coefficients) array
+        '''
+        n_vis = np.array([len(vis_units[p]) for p in range(self.K)])
+        self.coef_ptr = torch.from_numpy(
+            np.hstack((0, np.cumsum(n_vis)))).long()
+        self.coef_count = torch.from_numpy(n_vis).long()
+        self.coef_rows = torch.from_numpy(
+            np.hstack([vis_units[p] for p in range(self.K)])).long()
+        self.coef_data = torch.from_numpy(np.vstack(
+            [self.coefficients[p] for p in range(self.K)])).float()
+
+    def synchronize(self):
+        pass
+
+    def empty_cache(self):
+        pass
+
+    def subtract_splines(self, spike_times, xshifts, spike_temps, scaling):
+
+        spike_times = spike_times.reshape(-1)
+        spike_temps = spike_temps.reshape(-1)
+        xshifts = xshifts.reshape(-1)
+        scaling = scaling.reshape(-1)
+
+        # same sub-sample convention as the cuda kernel
+        delta = -xshifts
+        negative = delta < 0
+        delta = delta + negative.float()
+        spike_times = spike_times + negative.long()
+        basis = bspline_basis(delta)
+
+        # one row (visible unit) of a template per pair
+        counts = self.coef_count[spike_temps]
+        spike_id = torch.repeat_interleave(
+            torch.arange(len(spike_temps)), counts)
+        first_pair = torch.cumsum(counts, 0) - counts
+        coef_id = (torch.arange(len(spike_id)) -
+                   first_pair[spike_id] +
+                   self.coef_ptr[spike_temps][spike_id])
+
+        n_coef = self.coef_data.shape[1]
+        length = n_coef - basis.shape[1]
+        for k in range(0, len(spike_id), self.pair_block_size):
+            idx = slice(k, k+self.pair_block_size)
+            spike_id_ = spike_id[idx]
+            coef_id_ = coef_id[idx]
+
+            # evaluate splines
+            basis_ = basis[spike_id_]
+            coefs = self.coef_data[coef_id_]
+            vals = torch.zeros((len(spike_id_), length))
+            for j in range(basis.shape[1]):
+                vals += coefs[:, j:j+length] * basis_[:, j:j+1]
+            vals *= scaling[spike_id_][:, None]
+
+            rows = self.coef_rows[coef_id_][:, None].expand(-1, length)
+            cols = spike_times[spike_id_][:, None] + torch.arange(length)
+            self.scatter_add(rows, cols, -vals)
+
+    def refrac_fill(self, spike_times, spike_temps, fill_value):
+
+        fill_length = self.refractory*2+1
+        fill_offset = self.subtraction_offset-2-self.refractory
+
+        cols = (spike_times.reshape(-1)[:, None] + fill_offset +
+                torch.arange(fill_length))
+        rows = spike_temps.reshape(-1)[:, None].expand_as(cols)
+        self.scatter_add(rows, cols, torch.full(cols.shape, fill_value))
+
+    def scatter_add(self, rows, cols, vals):
+        ''' obj_gpu[rows, cols] += vals, out of bound columns are dropped
+        '''
+        inbounds = (cols >= 0) & (cols < self.obj_gpu.shape[1])
+        self.obj_gpu.index_put_(
+            (rows[inbounds], cols[inbounds]), vals[inbounds],
+            accumulate=True)
@@ -13,12 +13,16 @@ from torch import nn
 #from torch.autograd import Variable
 
 # cuda package to do GPU based spline interpolation and subtraction
-import cudaSpline as deconv
-import rowshift as rowshift
+# (not available on cpu only nodes, see match_pursuit_cpu.deconvCPU)
+try:
+    import cudaSpline as deconv
+except ImportError:
+    deconv = None
 
 from yass.postprocess.duplicate import abs_max_dist
 from yass.deconvolve.util import WaveForms
 from yass.deconvolve.utils import TempTempConv, reverse_shifts
+from yass.deconvolve.init_cache import InitCache, init_cache_key
 
 
 # # ****************************************************************************
@@ -99,6 +103,18 @@ def fit_spline_cpu(curve, knots=None, prepad=0, postpad=0, order=3):
                      
 class deconvGPU(object):
 
+    # data is moved to the current cuda device
+    device = torch.device('cuda')
+
+    # max size (in floats) of the shifted data used for the objective of
+    # a block of units
+    objective_block_size = 2**27
+
+    # find peaks only where the objective changed since the last iteration
+    incremental_peaks = True
+    # size (in time steps) of the blocks refreshed by incremental peak search
+    peak_block_size = 512
+
     def __init__(self, CONFIG, fname_templates, out_dir):
     
         #os.environ["CUDA_VISIBLE_DEVICES"] = str(CONFIG.resources.gpu_id)
@@ -111,10 +127,6 @@ class deconvGPU(object):
         self.seg_dir = os.path.join(self.out_dir, 'segs')
         if not os.path.exists(self.seg_dir):
             os.mkdir(self.seg_dir)
-            
-        self.init_dir = os.path.join(self.out_dir, 'initialize')
-        if not os.path.exists(self.init_dir):
-            os.mkdir(self.init_dir)
 
         #self.temps_dir = os.path.join(self.out_dir, 'template_updates')
         #if not os.path.exists(self.temps_dir):
@@ -144,6 +156,16 @@ class deconvGPU(object):
         # set max deconv threshold
         self.deconv_thresh = self.CONFIG.deconvolution.threshold
 
+        # initialization (svd, temp_temp, bsplines) is cached by content
+        # and shared by all deconv runs of the same output directory
+        if self.CONFIG.path_to_output_directory is not None:
+            cache_root = self.CONFIG.path_to_output_directory
+        else:
+            cache_root = os.path.dirname(os.path.abspath(out_dir))
+        self.init_cache = InitCache(
+            os.path.join(cache_root, 'deconv_init_cache'),
+            int(self.CONFIG.deconvolution.init_cache_size_gb*1e9))
+
 
     def initialize(self, move_data_to_gpu=True):
         
@@ -180,24 +202,7 @@ class deconvGPU(object):
         self.lockout_window = self.STIME - 1
 
     def initialize_shift_svd(self):
-        
-        fname_templates_denoised = os.path.join(
-            self.init_dir, 'templates_denoised.npy')
-        fname_spat_comp = os.path.join(
-            self.init_dir, 'spat_comp.npy')
-        fname_temp_comp = os.path.join(
-            self.init_dir, 'temp_comp.npy')
-        fname_align_shifts = os.path.join(
-            self.init_dir, 'align_shifts.npy')
-        fname_subtraction_offset = os.path.join(
-            self.init_dir, 'subtraction_offset.npy')
-        fname_peak_time_residual_offset = os.path.join(
-            self.init_dir, 'peak_time_residual_offset.npy')
-        fname_temp_temp = os.path.join(
-            self.init_dir, 'temp_temp.npy')
-        fname_vis_units = os.path.join(
-            self.init_dir, 'vis_units.npy')
-        
+
         # pad len is constant and is 1.5 ms on each side, i.e. a total of 3 ms
         self.pad_len = int(1.5 * self.CONFIG.recordings.sampling_rate / 1000.)
         # jitter_len is selected in a way that deconv works with 3 ms signals
@@ -208,28 +213,36 @@ class deconvGPU(object):
         #    self.jitter_diff = int(self.jitter_diff * self.CONFIG.recordings.sampling_rate / 1000. / 2.)
         self.jitter_len = self.pad_len + self.jitter_diff
 
-        if (os.path.exists(fname_templates_denoised) and
-            os.path.exists(fname_temp_temp) and
-            os.path.exists(fname_vis_units) and
-            os.path.exists(fname_spat_comp) and
-            os.path.exists(fname_temp_comp) and
-            os.path.exists(fname_align_shifts) and
-            os.path.exists(fname_subtraction_offset) and
-            os.path.exists(fname_peak_time_residual_offset)):
-
-            self.temps = np.load(fname_templates_denoised, allow_pickle=True)
-            self.spat_comp = np.load(fname_spat_comp, allow_pickle=True)
-            self.temp_comp = np.load(fname_temp_comp, allow_pickle=True)
-            self.align_shifts = np.load(fname_align_shifts, allow_pickle=True)
-            self.subtraction_offset = int(np.load(fname_subtraction_offset, allow_pickle=True))
-            self.peak_time_residual_offset = np.load(fname_peak_time_residual_offset)
-            
+        self.init_key = init_cache_key(
+            self.temps, self.RANK, self.pad_len, self.jitter_len,
+            self.CONFIG.geom, self.CONFIG.neigh_channels,
+            self.CONFIG.recordings.sampling_rate)
+        self.init_dir = self.init_cache.entry_dir(self.init_key)
+
+        cache = self.init_cache
+        key = self.init_key
+        if cache.has(key, ['templates_denoised', 'spat_comp', 'temp_comp',
+                           'align_shifts', 'subtraction_offset',
+                           'peak_time_residual_offset', 'temp_temp',
+                           'vis_units']):
+
+            print ("  ... loading deconv initialization from cache")
+            self.temps = cache.load(key, 'templates_denoised', mmap_mode=None)
+            self.spat_comp = cache.load(key, 'spat_comp', mmap_mode=None)
+            self.temp_comp = cache.load(key, 'temp_comp', mmap_mode=None)
+            self.align_shifts = cache.load(key, 'align_shifts', mmap_mode=None)
+            self.subtraction_offset = int(cache.load(
+                key, 'subtraction_offset', mmap_mode=None))
+            self.peak_time_residual_offset = cache.load(
+                key, 'peak_time_residual_offset', mmap_mode=None)
+
         else:
             ttc = TempTempConv(
                 self.CONFIG, 
                 templates=self.temps.transpose(2,0,1),
                 geom=self.CONFIG.geom, rank=self.RANK,
-                pad_len=self.pad_len, jitter_len=self.jitter_len, sparse=True)
+                pad_len=self.pad_len, jitter_len=self.jitter_len, sparse=True,
+                tmp_dir=self.out_dir)
 
             # update self.temps to the denoised templates
             self.temps = ttc.residual_temps.transpose(1, 2, 0)
@@ -239,24 +252,26 @@ class deconvGPU(object):
             self.subtraction_offset = int(ttc.peak_time_temp_temp_offset)
             self.peak_time_residual_offset = ttc.peak_time_residual_offset
 
-            # save the results
-            np.save(fname_templates_denoised, self.temps, allow_pickle=True)
-            np.save(fname_spat_comp, self.spat_comp, allow_pickle=True)
-            np.save(fname_temp_comp, self.temp_comp, allow_pickle=True)
-            np.save(fname_align_shifts, self.align_shifts, allow_pickle=True)
-            np.save(fname_subtraction_offset, self.subtraction_offset, allow_pickle=True)
-            np.save(fname_peak_time_residual_offset, self.peak_time_residual_offset, allow_pickle=True)
-            np.save(fname_temp_temp, ttc.temp_temp, allow_pickle=True)
-            np.save(fname_vis_units, ttc.unit_overlap, allow_pickle=True)
+            # save the results, ragged lists go last as they mark the
+            # entry complete
+            cache.save(key, 'templates_denoised', self.temps)
+            cache.save(key, 'spat_comp', self.spat_comp)
+            cache.save(key, 'temp_comp', self.temp_comp)
+            cache.save(key, 'align_shifts', self.align_shifts)
+            cache.save(key, 'subtraction_offset', self.subtraction_offset)
+            cache.save(key, 'peak_time_residual_offset',
+                       self.peak_time_residual_offset)
+            cache.save_list(key, 'temp_temp', ttc.temp_temp)
+            cache.save_list(key, 'vis_units', ttc.unit_overlap)
 
         
     def templates_to_bsplines(self):
 
-        fname = os.path.join(self.init_dir, 'bsplines.npy')
-        if not os.path.exists(fname):
+        cache = self.init_cache
+        key = self.init_key
+        if not cache.has(key, ['bsplines']):
             print ("  making template bsplines")
-            fname_temp_temp = os.path.join(self.init_dir, 'temp_temp.npy')
-            temp_temp = np.load(fname_temp_temp, allow_pickle=True)
+            temp_temp = cache.load_list(key, 'temp_temp')
 
             # multi-core bsplines
             if self.CONFIG.resources.multi_processing:
@@ -268,30 +283,56 @@ class deconvGPU(object):
                 coefficients = []
                 for template in temp_temp:
                     coefficients.append(transform_template_parallel(template))
-            np.save(fname, coefficients, allow_pickle=True)
+            cache.save_list(key, 'bsplines', coefficients)
 
             self.coefficients = coefficients
         else:
             print ("  ... loading coefficients from disk")
-            self.coefficients = np.load(fname, allow_pickle=True)
+            self.coefficients = cache.load_list(key, 'bsplines', mmap_mode=None)
+
+        # the entry is in use, make room for it
+        cache.evict(keep=key)
 
     def data_to_gpu(self):
         
-        self.peak_pts = torch.arange(-1,+2).cuda()
+        self.peak_pts = torch.arange(-1,+2).to(self.device)
 
         #norm
         norm = np.sum(np.square(self.temps), (0, 1))
-        self.norms = torch.from_numpy(norm).float().cuda()
+        self.norms = torch.from_numpy(norm).float().to(self.device)
         
         # spatial and temporal component of svd
-        self.spat_comp = torch.from_numpy(self.spat_comp).float().cuda()
-        self.temp_comp = torch.from_numpy(self.temp_comp).float().cuda()        
+        self.spat_comp = torch.from_numpy(self.spat_comp).float().to(self.device)
+        self.temp_comp = torch.from_numpy(self.temp_comp).float().to(self.device)
 
-        print ("  ... moving coefficients to cuda objects")
+        # channel shifts that align each template, as offsets into the
+        # left zero padded data (see make_objective_shifted_svd)
+        shifts = np.stack([reverse_shifts(align_shifts)
+                           for align_shifts in self.align_shifts])
+        self.max_shift = int(shifts.max())
+        self.shift_offsets = torch.from_numpy(
+            self.max_shift - shifts).long().to(self.device)
 
         # load vis units
-        fname_vis_units = os.path.join(self.init_dir, 'vis_units.npy')
-        vis_units = np.load(fname_vis_units, allow_pickle=True)
+        vis_units = self.init_cache.load_list(
+            self.init_key, 'vis_units', mmap_mode=None)
+
+        # objective columns changed by subtracting (or adding back) a spike
+        # at t are in [t + touch_start, t + touch_end)
+        spline_length = self.coefficients[0].shape[1] - 4
+        fill_offset = self.subtraction_offset-2-self.refractory
+        fill_length = self.refractory*2+1
+        self.touch_start = min(0, fill_offset)
+        self.touch_end = max(spline_length + 1, fill_offset + fill_length)
+
+        self.coefficients_to_gpu(vis_units)
+
+        if self.fit_height:
+            self.large_units = torch.from_numpy(self.large_units).to(self.device)
+
+    def coefficients_to_gpu(self, vis_units):
+
+        print ("  ... moving coefficients to cuda objects")
 
         #
         coefficients_cuda = []
@@ -302,12 +343,12 @@ class deconvGPU(object):
         self.coefficients = deconv.BatchedTemplates(coefficients_cuda)
 
         del coefficients_cuda
-        torch.cuda.empty_cache()
-
-        if self.fit_height:
-            self.large_units = torch.from_numpy(self.large_units).cuda()
+        self.empty_cache()
 
-    def run(self, chunk_id):
+    def run(self, chunk_id, chunk=None):
+        ''' Deconvolve one chunk, chunk is the output of read_chunk(chunk_id)
+            (read here if None)
+        '''
 
         # rest lists for each segment of time
         self.spike_array = []
@@ -321,7 +362,7 @@ class deconvGPU(object):
         self.chunk_id = chunk_id
 
         # load raw data and templates
-        self.load_data(chunk_id)
+        self.load_data(chunk_id, chunk)
         
         # make objective function
         #self.make_objective()
@@ -331,7 +372,7 @@ class deconvGPU(object):
         self.subtraction_step()
 
         # empty cache
-        torch.cuda.empty_cache()
+        self.empty_cache()
 
         # gather results (and move to cpu)
         self.gather_results()
@@ -359,24 +400,38 @@ class deconvGPU(object):
         self.shift_list = None
         self.height_list = None
 
-    def load_data(self, chunk_id):
+    def read_chunk(self, chunk_id):
+        ''' Read raw data of a chunk (on cpu), safe to call from another
+            thread while the previous chunk is being deconvolved
+        '''
+        data_cpu = self.reader.read_data_batch(chunk_id, add_buffer=True).T
+        data = torch.from_numpy(np.ascontiguousarray(data_cpu, 'float32'))
+        # page locked memory for an asynchronous copy to the gpu
+        if self.device.type == 'cuda':
+            data = data.pin_memory()
+
+        offset = self.reader.idx_list[chunk_id, 0] - self.reader.buffer
+
+        return data, offset
+
+    def load_data(self, chunk_id, chunk=None):
         '''  Function to load raw data 
         '''
         
         try:
             del self.data 
-            torch.cuda.empty_cache()
+            self.empty_cache()
         except:
             pass
             
         start = dt.datetime.now().timestamp()
 
         # read dat using reader class
-        self.data_cpu = self.reader.read_data_batch(
-            chunk_id, add_buffer=True).T
-        
-        self.offset = self.reader.idx_list[chunk_id, 0] - self.reader.buffer
-        self.data = torch.from_numpy(self.data_cpu).float().cuda()
+        if chunk is None:
+            chunk = self.read_chunk(chunk_id)
+        data, self.offset = chunk
+
+        self.data = data.to(self.device, non_blocking=True)
 
         #print (" self.data: ", self.data.shape, ", size: ", sys.getsizeof(self.data.storage()))
 
@@ -393,44 +448,46 @@ class deconvGPU(object):
         if self.verbose:
             print ("Computing objective ")       
        
-        #obj_function = np.zeros([NUNIT, data.shape[1] + 61 - 1])
-        #self.obj_gpu = torch.zeros((self.K, self.data.shape[1]+self.STIME-1 + 2 * self.jitter_diff),
-        #                            dtype=torch.float).cuda()
-        self.obj_gpu = torch.cuda.FloatTensor(self.K, self.data.shape[1]+self.STIME-1 + 2 * self.jitter_diff).fill_(0)
-        for unit in range(self.K):
-            # Do the shifts that was required for aligning template
-            shifts = reverse_shifts(self.align_shifts[unit])
-            #print ("shifts: ", shifts.shape)
-            
-            # this needs to be taken out of this loop and done single time
-            shifts_gpu = torch.from_numpy(shifts).long().cuda()
-            
-            # CUDA code
-            rowshift.forward(self.data, shifts_gpu)
+        n_chan, n_time = self.data.shape
+        self.obj_gpu = torch.zeros(
+            (self.K, n_time+self.STIME-1 + 2 * self.jitter_diff),
+            device=self.device)
+
+        # data shifted for unit k (to align its template) on channel c is
+        # data_unfold[c, self.shift_offsets[k, c]] (zero padded on the left)
+        data_unfold = nn.functional.pad(
+            self.data, (self.max_shift, 0)).unfold(1, n_time, 1)
+        channels = torch.arange(n_chan, device=self.device)
+
+        # units per block, so that shifted data of a block fits in memory
+        block_size = max(1, min(self.K,
+            self.objective_block_size//(n_chan*n_time)))
+        for k in range(0, self.K, block_size):
+            units = torch.arange(k, min(k+block_size, self.K),
+                                 device=self.device)
+
+            # spatial projection of shifted data: (n_units, RANK, n_time)
+            mm = torch.bmm(self.spat_comp[units],
+                           data_unfold[channels, self.shift_offsets[units]])
+
+            # temporal components of all units and ranks in one conv
+            n_filters = len(units)*self.RANK
+            conv = nn.functional.conv1d(
+                mm.reshape(1, n_filters, n_time),
+                self.temp_comp[units].reshape(n_filters, 1, -1),
+                padding=self.STIME-1,
+                groups=n_filters)[0]
+            conv = conv.reshape(len(units), self.RANK, -1).sum(1)
+            self.obj_gpu[units, :conv.shape[1]] = conv
 
-            # multiplication step
-            mm = torch.mm(self.spat_comp[unit], self.data)
-                    
-            # Sum over Rank
-            for i in range(self.RANK):
-                self.obj_gpu[unit,:]+= nn.functional.conv1d(mm[i][None,None,:],
-                                               self.temp_comp[unit,i][None,None,:], 
-                                               padding = self.STIME-1)[0][0]
-                #print ("Convolution result: ", temp_out.shape)
-                  
-            # Undo the shifts that we did earlier
-            #in_place_roll_shift(data, -shifts)
-            rowshift.backward(self.data, shifts_gpu)
-
-        #obj_function = 2 * obj_function - temp_norms[:NUNIT][:, None]  #drop NUNIT;  # drop additional dimensions;
-        #print ("obj_function: ", self.obj_gpu.shape)
-        #print ("self.norms: ", self.norms.shape)
         self.obj_gpu = 2 * self.obj_gpu - self.norms[:,None]  #drop NUNIT;  # drop additional dimensions;
 
+        self.reset_peak_cache()
+
         del mm
-        #del temp_out
-        torch.cuda.empty_cache()
-        torch.cuda.synchronize()
+        del data_unfold
+        self.empty_cache()
+        self.synchronize()
         
 
     def save_spikes(self):
@@ -606,7 +663,7 @@ class deconvGPU(object):
             self.heights = height
             
         else:
-            self.heights = torch.ones(len(self.xshifts)).cuda()
+            self.heights = torch.ones_like(self.xshifts)
 
         return (dt.datetime.now().timestamp()- start1)
 
@@ -629,9 +686,40 @@ class deconvGPU(object):
 
         return a*shift**2 + b*shift + c
 
+    def reset_peak_cache(self):
+        ''' Cached max of obj_gpu over units, its argmax and the local peaks
+            over time, all blocks need to be refreshed
+        '''
+        n_time = self.obj_gpu.shape[1]
+        n_blocks = (n_time - 1)//self.peak_block_size + 1
+        self.obj_max = torch.zeros(n_time, device=self.device)
+        self.obj_argmax = torch.zeros(n_time, dtype=torch.long,
+                                      device=self.device)
+        self.is_peak = torch.zeros(n_time, dtype=torch.bool,
+                                   device=self.device)
+        self.dirty_blocks = torch.ones(n_blocks, dtype=torch.bool,
+                                       device=self.device)
+
+    def touch_objective(self, spike_times):
+        ''' Mark blocks of obj_gpu changed by subtracting (or adding back)
+            spikes at spike_times (as passed to subtract_splines)
+        '''
+        spike_times = spike_times.reshape(-1)
+        n_blocks = len(self.dirty_blocks)
+        first = torch.clamp((spike_times + self.touch_start)//
+                            self.peak_block_size, 0, n_blocks-1)
+        last = torch.clamp((spike_times + self.touch_end - 1)//
+                           self.peak_block_size, 0, n_blocks-1)
+        max_span = ((self.touch_end - self.touch_start - 1)//
+                    self.peak_block_size + 2)
+        for k in range(max_span):
+            self.dirty_blocks[torch.min(first + k, last)] = True
+
     def find_peaks(self):
         ''' Function to use torch.max and an algorithm to find peaks
         '''
+        if self.incremental_peaks:
+            return self.find_peaks_incremental()
         
         # Cat: TODO: make sure you can also deconvolve ends of data;
         #      currently using padding here...
@@ -641,9 +729,9 @@ class deconvGPU(object):
         #       output:  n_times (i.e. the max energy function value at each point in time)
         #       note: windows are padded
         start = dt.datetime.now().timestamp()
-        torch.cuda.synchronize()
+        self.synchronize()
         self.gpu_max, self.neuron_ids = torch.max(self.obj_gpu, 0)
-        torch.cuda.synchronize()
+        self.synchronize()
         end_max = dt.datetime.now().timestamp()-start
 
         #np.save('/media/cat/2TB/liam/49channels/data1_allset_shifted_svd/tmp/block_2/deconv/neuron_ids_'+
@@ -693,11 +781,75 @@ class deconvGPU(object):
         return (dt.datetime.now().timestamp()-start)         
     
         
+    def find_peaks_incremental(self):
+        ''' Same peaks as find_peaks, but the max over units and the local
+            peaks over time are only recomputed in blocks of obj_gpu that
+            changed since the last call (see touch_objective)
+        '''
+        start = dt.datetime.now().timestamp()
+        self.synchronize()
+
+        n_time = self.obj_gpu.shape[1]
+        block = self.peak_block_size
+        window = self.lockout_window
+        pad = window//2
+
+        dirty = torch.nonzero(self.dirty_blocks)[:, 0]
+        if len(dirty) > 0:
+            # max over units in changed blocks
+            if len(dirty) == len(self.dirty_blocks):
+                self.obj_max, self.obj_argmax = torch.max(self.obj_gpu, 0)
+            else:
+                cols = (dirty[:, None]*block +
+                        torch.arange(block, device=self.device)).reshape(-1)
+                cols = cols[cols < n_time]
+                self.obj_max[cols], self.obj_argmax[cols] = torch.max(
+                    self.obj_gpu[:, cols], 0)
+
+            # local peaks: t is a peak if it is the max of obj_max in
+            # [t - pad, t - pad + window - 1], this changes for t up to
+            # one window away from a changed block
+            halo = window
+            obj_max_padded = nn.functional.pad(
+                self.obj_max, (halo + pad, halo + window + block),
+                value=-float('inf'))
+            seg_len = block + 2*halo + window - 1
+            segs = obj_max_padded[dirty[:, None]*block +
+                                  torch.arange(seg_len, device=self.device)]
+            window_maxima = torch.nn.functional.max_pool1d_with_indices(
+                segs[:, None], window, 1)[1][:, 0]
+            n_out = window_maxima.shape[1]
+            peak = (window_maxima ==
+                    torch.arange(n_out, device=self.device) + pad)
+
+            ts = (dirty[:, None]*block - halo +
+                  torch.arange(n_out, device=self.device))
+            inbounds = (ts >= 0) & (ts < n_time)
+            self.is_peak[ts[inbounds]] = peak[inbounds]
+
+            self.dirty_blocks[:] = False
+
+        self.gpu_max = self.obj_max
+
+        # only deconvolve spikes where obj_function max > threshold, and
+        # exclude spikes in the lock out window at the edges
+        spike = self.is_peak & (self.obj_max > self.deconv_thresh)
+        spike[:self.subtraction_offset+1] = False
+        spike[n_time-self.subtraction_offset:] = False
+        self.spike_times = torch.nonzero(spike)
+
+        # save only neuron ids for spikes to be deconvolved
+        self.neuron_ids = self.obj_argmax[self.spike_times]
+
+        self.synchronize()
+
+        return (dt.datetime.now().timestamp()-start)
+
     def subtract_cpp(self):
         
         start = dt.datetime.now().timestamp()
         
-        torch.cuda.synchronize()
+        self.synchronize()
         
         if False:
             self.spike_times = self.spike_times[:1]
@@ -708,6 +860,7 @@ class deconvGPU(object):
 
         #spike_times = self.spike_times.squeeze()-self.lockout_window
         spike_times = self.spike_times.squeeze()-self.subtraction_offset
+        self.touch_objective(spike_times)
         spike_temps = self.neuron_ids.squeeze()
         
         # zero out shifts if superres shift turned off
@@ -775,15 +928,13 @@ class deconvGPU(object):
         
         #self.obj_gpu = self.obj_gpu*0.
         #spike_times = spike_times -99
-        deconv.subtract_splines(
-                    self.obj_gpu,
+        self.subtract_splines(
                     spike_times,
                     self.xshifts,
                     spike_temps,
-                    self.coefficients,
                     self.tempScaling*self.heights)
                                
-        torch.cuda.synchronize()
+        self.synchronize()
         
         # also fill in self-convolution traces with low energy so the
         #   spikes cannot be detected again (i.e. enforcing refractoriness)
@@ -791,17 +942,39 @@ class deconvGPU(object):
 
         if self.refractoriness:
             #print ("filling in timesteps: ", self.n_time)
-            deconv.refrac_fill(energy=self.obj_gpu,
-                                  spike_times=spike_times,
-                                  spike_ids=spike_temps,
-                                  fill_length=self.refractory*2+1,  # variable fill length here
-                                  fill_offset=self.subtraction_offset-2-self.refractory,
-                                  fill_value=-self.fill_value)
+            self.refrac_fill(spike_times, spike_temps, -self.fill_value)
 
-        torch.cuda.synchronize()
+        self.synchronize()
             
         return (dt.datetime.now().timestamp()-start)
 
+    def subtract_splines(self, spike_times, xshifts, spike_temps, scaling):
+        ''' Subtract (scaled, shifted) template convolutions from obj_gpu
+        '''
+        deconv.subtract_splines(
+                    self.obj_gpu,
+                    spike_times,
+                    xshifts,
+                    spike_temps,
+                    self.coefficients,
+                    scaling)
+
+    def refrac_fill(self, spike_times, spike_temps, fill_value):
+        ''' Add fill_value to obj_gpu in the refractory period of each spike
+        '''
+        deconv.refrac_fill(energy=self.obj_gpu,
+                           spike_times=spike_times,
+                           spike_ids=spike_temps,
+                           fill_length=self.refractory*2+1,  # variable fill length here
+                           fill_offset=self.subtraction_offset-2-self.refractory,
+                           fill_value=fill_value)
+
+    def synchronize(self):
+        torch.cuda.synchronize()
+
+    def empty_cache(self):
+        torch.cuda.empty_cache()
+
     def sample_spikes_allspikes(self):
         """
             Same as sample_spikes() but picking all spikes from a previous iteration,
@@ -818,35 +991,29 @@ class deconvGPU(object):
     def add_cpp_allspikes(self):
         #start = dt.datetime.now().timestamp()
         
-        torch.cuda.synchronize()
+        self.synchronize()
                         
         # select all spikes from a previous iteration
         spike_times, spike_temps, spike_shifts, spike_heights = self.sample_spikes_allspikes()
+        self.touch_objective(spike_times)
 
-        torch.cuda.synchronize()
+        self.synchronize()
 
         # also fill in self-convolution traces with low energy so the
         #   spikes cannot be detected again (i.e. enforcing refractoriness)
         # Cat: TODO: investgiate whether putting the refractoriness back in is viable
         if self.refractoriness:
-            deconv.refrac_fill(energy=self.obj_gpu,
-                              spike_times=spike_times,
-                              spike_ids=spike_temps,
-                              fill_length=self.refractory*2+1,  # variable fill length here
-                              fill_offset=self.subtraction_offset-2-self.refractory,
-                              fill_value=self.fill_value)
+            self.refrac_fill(spike_times, spike_temps, self.fill_value)
 
-        torch.cuda.synchronize()
+        self.synchronize()
 
         # Add spikes back in;
-        deconv.subtract_splines(
-                            self.obj_gpu,
+        self.subtract_splines(
                             spike_times,
                             spike_shifts,
                             spike_temps,
-                            self.coefficients,
                             -self.tempScaling*spike_heights)
 
-        torch.cuda.synchronize()
+        self.synchronize()
 
         return 
@@ -1,5 +1,8 @@
 import os
 import logging
+import threading
+import time
+import traceback
 import numpy as np
 import parmap
 import scipy
@@ -11,7 +14,10 @@ import torch.multiprocessing as mp
 
 from yass import read_config
 from yass.reader import READER
+from yass.util import (prefetch, BackgroundWriter, worker_devices,
+                       replace_file, queue)
 from yass.deconvolve.match_pursuit_gpu_new import deconvGPU
+from yass.deconvolve.match_pursuit_cpu import deconvCPU
 from yass.deconvolve.util import make_CONFIG2
 
 def run(fname_templates_in,
@@ -123,7 +129,11 @@ def deconv_ONgpu(fname_templates_in,
                  run_chunk_sec):
 
     # **************** MAKE DECONV OBJECT *****************
-    d_gpu = deconvGPU(CONFIG, fname_templates_in, output_directory)
+    # without gpus, the same match pursuit runs on cpu
+    if CONFIG.torch_devices[0].type == 'cuda':
+        d_gpu = deconvGPU(CONFIG, fname_templates_in, output_directory)
+    else:
+        d_gpu = deconvCPU(CONFIG, fname_templates_in, output_directory)
 
     # Cat: TODO: read from CONFIG
     d_gpu.max_iter = 1000
@@ -189,123 +199,305 @@ def deconv_ONgpu(fname_templates_in,
 
     # ************** SAVE SPIKES & SHIFTS **********************
     print ("  gathering spike trains and shifts from deconv")
+    gather_segments(d_gpu, range(reader.n_batches))
 
-    # get number of max spikes first
-    n_spikes = 0
-    for chunk_id in tqdm(range(reader.n_batches)):
-        time_index = int((chunk_id+1)*reader.n_sec_chunk +
-                         d_gpu.reader.start/d_gpu.reader.sampling_rate)
-        fname = os.path.join(d_gpu.seg_dir,str(time_index).zfill(6)+'.npz')
-        n_spikes += len(np.load(fname, allow_pickle=True)['spike_train'])
-
-    # loop over chunks and add spikes;
-    batch_size = d_gpu.reader.batch_size
-    buffer_size = d_gpu.reader.buffer
 
-    spike_train = np.zeros((n_spikes, 2), 'int32')
-    shifts = np.zeros(n_spikes, 'float32')
-    scales = np.zeros(n_spikes, 'float32')
+def gather_segments(d_gpu, chunk_ids):
+    """Concatenate the (buffer trimmed, time sorted) segments into
+    spike_train.npy, shifts.npy and scales.npy in out_dir
 
+    Segment sizes come from their index files so the outputs are written
+    directly into memory mapped files, reading every segment once
+    """
+    fnames = [segment_fname(d_gpu, chunk_id) for chunk_id in chunk_ids]
+    n_spikes_seg = [segment_n_spikes(d_gpu, fname) for fname in fnames]
+    n_spikes = int(np.sum(n_spikes_seg))
+
+    outputs = {}
+    for name, shape, dtype in (('spike_train', (n_spikes, 2), 'int32'),
+                               ('shifts', (n_spikes,), 'float32'),
+                               ('scales', (n_spikes,), 'float32')):
+        outputs[name] = np.lib.format.open_memmap(
+            os.path.join(d_gpu.out_dir, name+'.npy.tmp'),
+            mode='w+', dtype=dtype, shape=shape)
+    spike_train = outputs['spike_train']
+
+    # chunks do not overlap once buffer spikes are removed, so segments in
+    # chunk order are already globally sorted and the k-way merge reduces
+    # to appending them; check it at segment boundaries
     counter = 0
-    for chunk_id in tqdm(range(reader.n_batches)):
-        #fname = os.path.join(d_gpu.seg_dir,str(chunk_id).zfill(5)+'.npz')
-        time_index = int((chunk_id+1)*reader.n_sec_chunk +
-                         d_gpu.reader.start/d_gpu.reader.sampling_rate)
-        fname = os.path.join(d_gpu.seg_dir,str(time_index).zfill(6)+'.npz')
-        data = np.load(fname, allow_pickle=True)
-
-        offset = data['offset']
-        spike_train_chunk = data['spike_train']
-        shifts_chunk = data['shifts']
-        scales_chunk = data['heights']
-
-        idx_keep = np.logical_and(
-            spike_train_chunk[:, 0] >= buffer_size,
-            spike_train_chunk[:, 0] < batch_size + buffer_size)
-        idx_keep = np.where(idx_keep)[0]
-
-        # add offset
-        spike_train_chunk[:, 0] += offset
-
-        # stack data
-        idx = slice(counter, counter+len(idx_keep))
-        spike_train[idx] = spike_train_chunk[idx_keep]
-        shifts[idx] = shifts_chunk[idx_keep]
-        scales[idx] = scales_chunk[idx_keep]
-
-        counter += len(idx_keep)
-
-    spike_train = spike_train[:counter]
-    shifts = shifts[:counter]
-    scales = scales[:counter]
-
-    # sort spike train by time
-    print ("   ordering spikes: ")
-    idx = spike_train[:,0].argsort(0)
-    spike_train = spike_train[idx]
-    shifts = shifts[idx]
-    scales = scales[idx]
-
-    # save spike train
+    is_sorted = True
+    for fname, n in zip(tqdm(fnames), n_spikes_seg):
+        data = np.load(fname)
+        idx = slice(counter, counter+n)
+        spike_train[idx] = data['spike_train']
+        outputs['shifts'][idx] = data['shifts']
+        outputs['scales'][idx] = data['heights']
+        if n > 0 and counter > 0:
+            is_sorted &= bool(spike_train[counter-1, 0] <= spike_train[counter, 0])
+        counter += n
+
+    if not is_sorted:
+        print ("   ordering spikes: ")
+        idx = np.argsort(spike_train[:, 0], kind='mergesort')
+        for name in outputs:
+            outputs[name][:] = outputs[name][idx]
+
+    # save spike train (last, its existence marks deconv as done)
     print ("  saving spike_train: ", spike_train.shape)
-    fname_spike_train = os.path.join(d_gpu.out_dir, 'spike_train.npy')
-    np.save(fname_spike_train, spike_train)
-
-    # save shifts
-    fname_shifts = os.path.join(d_gpu.out_dir, 'shifts.npy')
-    np.save(fname_shifts, shifts)
+    for name in ('shifts', 'scales', 'spike_train'):
+        outputs[name].flush()
+        fname = os.path.join(d_gpu.out_dir, name+'.npy')
+        replace_file(fname+'.tmp', fname)
+    del outputs, spike_train
 
-    # save scales
-    fname_scales = os.path.join(d_gpu.out_dir, 'scales.npy')
-    np.save(fname_scales, scales)
 
+def run_core_deconv(d_gpu, CONFIG, max_retries=2):
+    """Deconvolve all chunks of d_gpu.reader
 
-def run_core_deconv(d_gpu, CONFIG):
+    Workers (one per device, see yass.util.worker_devices) pull chunk ids from a
+    shared queue, so fast workers take more chunks. A chunk that fails is
+    put back in the queue (up to max_retries times); chunks lost with a
+    worker that died are run again in a new round. Chunks with a saved
+    segment are skipped, so interrupted runs resume where they stopped
+    """
 
     os.environ["CUDA_VISIBLE_DEVICES"] = ','.join(
         [str(i) for i in range(torch.cuda.device_count())])
-    chunk_ids = np.arange(d_gpu.reader.n_batches)
     d_gpu.initialize(move_data_to_gpu=False)
 
     start_sec = int(d_gpu.reader.start/d_gpu.reader.sampling_rate)
     end_sec = int(start_sec + d_gpu.reader.n_sec_chunk*d_gpu.reader.n_batches)
     print ("running deconv from {} to {} seconds".format(start_sec, end_sec))
-    processes = []
-    if len(CONFIG.torch_devices) == 1:
-        run_core_deconv_parallel(d_gpu, chunk_ids, CONFIG.torch_devices[0].index)
-    else:
-        chunk_ids_split_gpu = np.array_split(
-             chunk_ids, len(CONFIG.torch_devices))
-        for ii, device in enumerate(CONFIG.torch_devices):
-            p = mp.Process(target=run_core_deconv_parallel,
-                           args=(d_gpu, chunk_ids_split_gpu[ii], device.index))
-            p.start()
-            processes.append(p)
-        for p in processes:
-            p.join()
+    # one worker per gpu or, without gpus, n_processors cpu workers
+    devices, n_threads = worker_devices(CONFIG)
+
+    attempts = {}
+    for round_ in range(max_retries+1):
+        # chunks already deconvolved (e.g. by an interrupted run) are skipped
+        chunk_ids = [chunk_id for chunk_id in range(d_gpu.reader.n_batches)
+                     if not segment_done(d_gpu, chunk_id) and
+                     attempts.get(chunk_id, 0) <= max_retries]
+        if len(chunk_ids) == 0:
+            break
+        if round_ > 0:
+            print ("  re-running {} deconv chunks".format(len(chunk_ids)))
+        run_deconv_workers(d_gpu, chunk_ids, devices, n_threads,
+                           attempts, max_retries)
+
+    failed = [chunk_id for chunk_id in range(d_gpu.reader.n_batches)
+              if not segment_done(d_gpu, chunk_id)]
+    if len(failed) > 0:
+        raise RuntimeError('deconv failed on chunks {}'.format(failed))
 
     return d_gpu
 
 
-def run_core_deconv_parallel(d_gpu, chunk_ids, device):
+def run_deconv_workers(d_gpu, chunk_ids, devices, n_threads, attempts,
+                       max_retries):
+    """Run chunk_ids on one worker per device, failed chunks are queued
+    again until they failed max_retries times (counted in attempts)
+    """
+    # a single worker runs in a thread of this process, as the deconv
+    # object is not copied it keeps working without multiprocessing
+    if len(devices) == 1:
+        tasks, results = queue.Queue(), queue.Queue()
+        workers = [threading.Thread(
+            target=run_core_deconv_parallel,
+            args=(d_gpu, tasks, results, 0, devices[0], n_threads))]
+    else:
+        tasks, results = mp.Queue(), mp.Queue()
+        workers = [mp.Process(
+            target=run_core_deconv_parallel,
+            args=(d_gpu, tasks, results, ii, device, n_threads))
+            for ii, device in enumerate(devices)]
+
+    for chunk_id in chunk_ids:
+        tasks.put(chunk_id)
+    begin = time.time()
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+
+    # chunks done and compute time of each worker
+    n_chunks = np.zeros(len(workers), 'int32')
+    compute_time = np.zeros(len(workers))
+
+    # once all chunks are done, or a worker died (its chunks are run again
+    # in the next round), workers are stopped after the queued chunks
+    outstanding = [len(chunk_ids)]
+    stopping = False
+
+    def handle(kind, worker_id, chunk_id, info, retry):
+        if kind == 'done':
+            outstanding[0] -= 1
+            n_chunks[worker_id] += 1
+            compute_time[worker_id] += info
+        else:
+            attempts[chunk_id] = attempts.get(chunk_id, 0) + 1
+            print ("  deconv chunk {} failed on worker {} (attempt {}):\n{}".format(
+                chunk_id, worker_id, attempts[chunk_id], info))
+            if attempts[chunk_id] <= max_retries and retry:
+                tasks.put(chunk_id)
+            else:
+                outstanding[0] -= 1
+
+    while any(w.is_alive() for w in workers):
+        if not stopping and (outstanding[0] == 0 or
+                             not all(w.is_alive() for w in workers)):
+            for worker in workers:
+                tasks.put(None)
+            stopping = True
+
+        try:
+            message = results.get(timeout=1)
+        except queue.Empty:
+            continue
+        handle(*message, retry=not stopping)
+    for worker in workers:
+        worker.join()
+
+    # results sent after the last check, failed chunks are run again in
+    # the next round of run_core_deconv
+    while True:
+        try:
+            message = results.get_nowait()
+        except queue.Empty:
+            break
+        handle(*message, retry=False)
+
+    # throughput of each worker
+    elapsed = time.time() - begin
+    for ii, device in enumerate(devices):
+        rec_sec = n_chunks[ii]*d_gpu.reader.n_sec_chunk
+        print ("  deconv worker {} ({}): {} chunks, {} x realtime "
+               "({} x realtime while computing)".format(
+                   ii, device, n_chunks[ii],
+                   np.round(rec_sec/max(elapsed, 1e-6), 2),
+                   np.round(rec_sec/max(compute_time[ii], 1e-6), 2)))
+
+
+def read_deconv_chunks(d_gpu, chunk_ids):
+    """Yields (chunk_id, chunk, error), read errors are returned (as a
+    traceback) instead of raised so that other chunks keep going
+    """
+    for chunk_id in chunk_ids:
+        try:
+            yield chunk_id, d_gpu.read_chunk(chunk_id), None
+        except Exception:
+            yield chunk_id, None, traceback.format_exc()
+
+
+def run_core_deconv_parallel(d_gpu, tasks, results, worker_id, device,
+                             n_threads=None):
+    """Deconv worker: runs chunk ids from the tasks queue until it gets
+    None, and puts ('done', worker_id, chunk_id, compute time) or
+    ('failed', worker_id, chunk_id, traceback) in the results queue
+    """
 
-    torch.cuda.set_device(device)
+    if device.type == 'cuda':
+        torch.cuda.set_device(device)
+    elif n_threads is not None:
+        torch.set_num_threads(n_threads)
     d_gpu.data_to_gpu()
 
-    for chunk_id in chunk_ids:
-        time_index = int((chunk_id+1)*d_gpu.reader.n_sec_chunk + d_gpu.reader.start/d_gpu.reader.sampling_rate)
-        fname = os.path.join(d_gpu.seg_dir, str(time_index).zfill(6)+'.npz')
+    # a chunk is done once its segment is saved
+    def save(chunk_id, compute_time, *args):
+        save_segment(segment_fname(d_gpu, chunk_id), *args)
+        results.put(('done', worker_id, chunk_id, compute_time))
 
-        if not os.path.exists(fname):
+    # the next chunk is read and the previous one saved in background
+    # threads while the current chunk is being deconvolved
+    # (one chunk ahead, so that chunks pulled from the queue stay balanced)
+    chunks = prefetch(read_deconv_chunks(d_gpu, iter(tasks.get, None)),
+                      size=1)
+    with BackgroundWriter(save, size=2) as writer:
+        for chunk_id, chunk, error in chunks:
 
-            #print ("deconv: ", time_index, " sec, ", chunk_id, "/", d_gpu.reader.n_batches)
+            #print ("deconv: ", chunk_id, "/", d_gpu.reader.n_batches)
 
             # run deconv
-            d_gpu.run(chunk_id)
+            begin = time.time()
+            if error is None:
+                try:
+                    d_gpu.run(chunk_id, chunk)
+                except Exception:
+                    error = traceback.format_exc()
+            if error is not None:
+                results.put(('failed', worker_id, chunk_id, error))
+                continue
 
             # save deconv results
-            np.savez(fname,
-                     spike_train = d_gpu.spike_train,
-                     offset = d_gpu.offset,
-                     shifts = d_gpu.shifts,
-                     heights = d_gpu.heights)
+            writer.put(chunk_id,
+                       time.time() - begin,
+                       d_gpu.spike_train,
+                       d_gpu.shifts,
+                       d_gpu.heights,
+                       d_gpu.offset,
+                       d_gpu.reader.buffer,
+                       d_gpu.reader.buffer + d_gpu.reader.batch_size)
+
+
+def segment_fname(d_gpu, chunk_id):
+    """File with the deconv results of a chunk, named by its end time (sec)
+    """
+    time_index = int((chunk_id+1)*d_gpu.reader.n_sec_chunk +
+                     d_gpu.reader.start/d_gpu.reader.sampling_rate)
+    return os.path.join(d_gpu.seg_dir, str(time_index).zfill(6)+'.npz')
+
+
+def segment_done(d_gpu, chunk_id):
+    return os.path.exists(segment_fname(d_gpu, chunk_id))
+
+
+def segment_index_fname(fname):
+    """File with the number of spikes of a segment, written before the
+    segment, so segments without it were saved by older versions
+    """
+    return fname[:-len('.npz')] + '_n_spikes.npy'
+
+
+def segment_n_spikes(d_gpu, fname):
+    """Number of spikes of a segment. Segments saved by older versions
+    (no index, buffer spikes kept and times relative to the chunk) are
+    converted first
+    """
+    fname_index = segment_index_fname(fname)
+    if not os.path.exists(fname_index):
+        data = np.load(fname, allow_pickle=True)
+        save_segment(fname, data['spike_train'], data['shifts'],
+                     data['heights'], data['offset'], d_gpu.reader.buffer,
+                     d_gpu.reader.buffer + d_gpu.reader.batch_size)
+
+    return int(np.load(fname_index))
+
+
+def save_segment(fname, spike_train, shifts, heights, offset, t_start, t_end):
+    """Save deconv results of a chunk: spikes in the buffer (outside
+    [t_start, t_end) relative to the chunk) are removed, times are made
+    relative to the recording and spikes are sorted by time
+
+    Written to a temporary file first so that an interrupted write is never
+    taken for a finished chunk. The index is saved before the segment
+    """
+    idx_keep = np.where(np.logical_and(
+        spike_train[:, 0] >= t_start,
+        spike_train[:, 0] < t_end))[0]
+    idx_keep = idx_keep[np.argsort(spike_train[idx_keep, 0], kind='mergesort')]
+
+    spike_train = spike_train[idx_keep]
+    spike_train[:, 0] += offset
+
+    fname_index = segment_index_fname(fname)
+    with open(fname_index + '.tmp', 'wb') as f:
+        np.save(f, len(idx_keep))
+    replace_file(fname_index + '.tmp', fname_index)
+
+    fname_tmp = fname + '.tmp'
+    with open(fname_tmp, 'wb') as f:
+        np.savez(f,
+                 spike_train=spike_train.astype('int32'),
+                 offset=offset,
+                 shifts=shifts[idx_keep],
+                 heights=heights[idx_keep])
+    replace_file(fname_tmp, fname)
@@ -2,9 +2,12 @@
 
 import numpy as np
 import os
+import shutil
+import tempfile
 import matplotlib.pyplot as plt
 import parmap
 
+from scipy.spatial import cKDTree
 from scipy.spatial.transform import Rotation
 from scipy.spatial.distance import cdist, pdist, squareform
 from scipy.signal import argrelmin
@@ -436,7 +439,8 @@ class TempTempConv(object):
 
     def __init__(self, CONFIG, templates, geom, pad_len, jitter_len, rank=5,
                  sparse=True, #temp_temp_fname="",
-                 vis_threshold_strong=1., vis_threshold_weak=0.5, parallel=True):
+                 vis_threshold_strong=1., vis_threshold_weak=0.5, parallel=True,
+                 tmp_dir=None):
         """
 
         params:
@@ -461,6 +465,9 @@ class TempTempConv(object):
         jitter_len: int
             Each channel will be jitter by a total of 2 * jitter_len to find
             best alignment
+        tmp_dir: str
+            Folder in which the scratch folder for the memory mapped
+            temp_temp computation is made (system temp folder if None)
         """
         self.sparse = sparse
         temp = templates
@@ -489,7 +496,9 @@ class TempTempConv(object):
         # If a unit has no visible channel, make its main channel visible
         invis_units = np.where(num_vis_chan == 0)[0]
         viscs[invis_units, temp.ptp(2).argmax(1)[invis_units]] = True
-        unit_unit_overlap = np.logical_and(viscs[None], viscs[:, None]).sum(-1) > 0
+        # spatially overlapping units as CSR (row pointers, columns)
+        overlap_ptr, overlap_idx = overlapping_unit_pairs(
+            viscs, temp.ptp(2).argmax(1), geom)
 
         # real visible channels using both strong and weak threshold
         viscs = continuous_visible_channels(
@@ -554,76 +563,6 @@ class TempTempConv(object):
         # computing template_norms
         self.temp_norms = np.square(aligned_temp).sum(-1).sum(-1)
 
-        #temp_temp = [[0. for i in range(n_unit)] for j in range(n_unit)]
-        temp_temp = None
-
-        zero_padded_temp_temp = None
-        global_argmax = None
-        #if not os.path.exists(temp_temp_fname):
-        if True:
-            print (".... computing temp_temp ...")
-            if parallel:
-                # partition the units into 12 sub problems
-                sub_size = int(np.ceil(n_unit / CONFIG.resources.n_processors))
-                if sub_size == 0:
-                    sub_size = 1
-                sub_tasks = []
-                i = 0
-                while i < n_unit:
-                    till = i + sub_size
-                    if till > n_unit:
-                        till = n_unit
-                    sub_tasks.append(range(i, till))
-                    i = i + sub_size
-
-                temp_temp_list = parmap.map(
-                    temp_temp_partial, sub_tasks,
-                    aligned_temp_=aligned_temp, align_shifts_=align_shifts,
-                    unit_unit_overlap_=unit_unit_overlap,
-                    spat_comp_=spat_comp, temp_comp_=temp_comp,
-                    rank_=rank, n_unit_=n_unit,
-                    processes=CONFIG.resources.n_processors,
-                    pm_pbar=True)
-                temp_temp = []
-                # Gather and combine all solutions
-                for res in temp_temp_list:
-                    temp_temp += res
-            else:
-                temp_temp = temp_temp_partial(
-                    units=range(n_unit), aligned_temp_=aligned_temp, align_shifts_=align_shifts,
-                    unit_unit_overlap_=unit_unit_overlap,
-                    spat_comp_=spat_comp, temp_comp_=temp_comp, rank_=rank, n_unit_=n_unit)
-            # zero pad and shift the temp temps so that everything all temp_temp[i][i] have
-            # peak at the same time and they have the same size
-
-            temp_temp_len = np.zeros([n_unit, n_unit], dtype=np.int32)
-            temp_temp_argmax = np.zeros(n_unit, dtype=np.int32)
-            for i in range(n_unit):
-                temp_temp_argmax[i] = temp_temp[i][i].argmax()
-                for j in range(n_unit):
-                    if isinstance(temp_temp[i][j], np.ndarray):
-                        temp_temp_len[i, j] = len(temp_temp[i][j])
-
-            max_len = temp_temp_len.max()
-            # (IMPORTANT): this variable is very important, later when you find
-            # peaks, the time of each peak has to be subtracted by this value
-            global_argmax = temp_temp_argmax.max()
-            # Shift all temp_temps so that the peaks are aligned
-            shifts_ = global_argmax - temp_temp_argmax
-            zero_padded_temp_temp = np.zeros([n_unit, n_unit, max_len], 'float32')
-            for i in range(n_unit):
-                u_shift = shifts_[i]
-                for j in range(n_unit):
-                    if isinstance(temp_temp[i][j], np.ndarray):
-                        #temp temp exists
-                        zero_padded_temp_temp[i, j, u_shift:u_shift+temp_temp_len[i, j]] = temp_temp[i][j]
-            #if len(temp_temp_fname) > 0:
-            #    np.save(temp_temp_fname, zero_padded_temp_temp)
-        #else:
-        #    print (".... loading temp-temp from disk")
-        #    zero_padded_temp_temp = np.load(temp_temp_fname, allow_pickle=True)
-        #    global_argmax = zero_padded_temp_temp[0][0].argmax()
-
         # Important step that gives the templates have the same length and shifted in a way
         # that spike trains for subtraction are synchronized
 
@@ -656,13 +595,88 @@ class TempTempConv(object):
         self.peak_time_residual_offset = - temp_size + 1 - main_chan_shift
         self.peak_time_residual_offset += (min_loc - min_loc_orig)
 
-        # reduce the amount of overlapping units
-        less_overlapping_units = True
+        # norms of the residual templates
         self.temp_norms = np.sum(np.square(self.residual_temps), (1,2))
-        if less_overlapping_units:
-            threshold = 0.05*self.temp_norms
-            threshold[threshold > 50] = 50
-            unit_unit_overlap = np.abs(zero_padded_temp_temp).max(2) > threshold[None]
+
+        print (".... computing temp_temp ...")
+        # temp_temp[i][j] has length 2*spike_size-1 plus the channel shifts
+        # of units i and j, they are placed in rows of one (n_pairs, max_len)
+        # buffer shifted so that all temp_temp[i][i] peak at the same time
+        temp_temp_argmax = np.zeros(n_unit, dtype=np.int32)
+        for i in range(n_unit):
+            temp_temp_argmax[i] = temp_temp_pair(
+                shift_channels(aligned_temp[i], align_shifts[i]),
+                align_shifts[i], spat_comp[i], temp_comp[i], rank).argmax()
+        # (IMPORTANT): this variable is very important, later when you find
+        # peaks, the time of each peak has to be subtracted by this value
+        global_argmax = temp_temp_argmax.max()
+        row_shifts = global_argmax - temp_temp_argmax
+
+        overlap_rows = np.repeat(np.arange(n_unit), np.diff(overlap_ptr))
+        max_shifts = align_shifts.max(1)
+        temp_temp_len = (2*spike_size - 1 + max_shifts[overlap_rows] +
+                         max_shifts[overlap_idx])
+        max_len = (temp_temp_len + row_shifts[overlap_rows]).max()
+
+        # workers read their inputs from and write their rows to memory
+        # mapped files instead of receiving pickled copies of the templates
+        tmp_dir = tempfile.mkdtemp(prefix='temp_temp_', dir=tmp_dir)
+        try:
+            for name, array in (('aligned_temp', aligned_temp),
+                                ('align_shifts', align_shifts),
+                                ('spat_comp', spat_comp),
+                                ('temp_comp', temp_comp),
+                                ('overlap_ptr', overlap_ptr),
+                                ('overlap_idx', overlap_idx),
+                                ('row_shifts', row_shifts)):
+                np.save(os.path.join(tmp_dir, name+'.npy'), array)
+            fname_temp_temp = os.path.join(tmp_dir, 'temp_temp.npy')
+            np.lib.format.open_memmap(
+                fname_temp_temp, mode='w+', dtype='float32',
+                shape=(len(overlap_idx), max_len)).flush()
+
+            if parallel:
+                # unit ranges with about the same number of pairs
+                n_tasks = 4*CONFIG.resources.n_processors
+                bounds = np.unique(np.searchsorted(
+                    overlap_ptr, np.linspace(0, len(overlap_idx), n_tasks+1)))
+                bounds[-1] = n_unit
+                sub_tasks = [range(bounds[k], bounds[k+1])
+                             for k in range(len(bounds)-1)
+                             if bounds[k+1] > bounds[k]]
+                parmap.map(temp_temp_partial, sub_tasks,
+                           tmp_dir=tmp_dir, rank_=rank,
+                           processes=CONFIG.resources.n_processors,
+                           pm_pbar=True)
+            else:
+                temp_temp_partial(range(n_unit), tmp_dir, rank)
+
+            temp_temp_data = np.load(fname_temp_temp, mmap_mode='r')
+
+            # reduce the amount of overlapping units
+            less_overlapping_units = True
+            keep = np.ones(len(overlap_idx), 'bool')
+            if less_overlapping_units:
+                threshold = 0.05*self.temp_norms
+                threshold[threshold > 50] = 50
+                for k in range(0, len(keep), 10000):
+                    keep[k:k+10000] = (np.abs(temp_temp_data[k:k+10000]).max(1) >
+                                       threshold[overlap_idx[k:k+10000]])
+
+            if not sparse:
+                # np.ndarray, shape: (n_unit, n_unit, some len)
+                # temp_size is large enough to account for shifts of largest template
+                self.temp_temp = np.zeros([n_unit, n_unit, max_len], 'float32')
+                self.temp_temp[overlap_rows, overlap_idx] = temp_temp_data
+
+            temp_temp_data = np.array(temp_temp_data[keep])
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        overlap_rows = overlap_rows[keep]
+        overlap_idx = overlap_idx[keep]
+        overlap_ptr = np.hstack(
+            (0, np.cumsum(np.bincount(overlap_rows, minlength=n_unit))))
 
         # What the user needs from this class
 
@@ -679,26 +693,29 @@ class TempTempConv(object):
         self.spat_comp = spat_comp
         # np.ndarray, shape: (n_unit, rank, spike_size)
         self.temp_comp = temp_comp
-        # np.ndarray, shape: (n_unit, n_unit, some len)
-        # temp_size is large enough to account for shifts of largest template
-        self.temp_temp = zero_padded_temp_temp
+        # CSR over overlapping unit pairs: temp_temp of units i and
+        # temp_temp_indices[k] is temp_temp_data[k] for k in
+        # temp_temp_indptr[i]:temp_temp_indptr[i+1]
+        # np.ndarray, shape: (n_pairs, some len)
+        self.temp_temp_data = temp_temp_data
+        self.temp_temp_indices = overlap_idx
+        self.temp_temp_indptr = overlap_ptr
         # integer
         self.peak_time_temp_temp_offset = int(global_argmax)
         # integer
         self.rank = rank
-        #
-        self.unit_overlap = unit_unit_overlap
         # length of new templates
 
         if sparse:
-            overlap_replacement = []
-            temp_temp_replacement = []
-            for u in range(n_unit):
-                overlap_idx = np.where(self.unit_overlap[u])[0]
-                overlap_replacement.append(overlap_idx)
-                temp_temp_replacement.append(self.temp_temp[u][overlap_idx])
-            self.temp_temp = temp_temp_replacement
-            self.unit_overlap = overlap_replacement
+            # lists of n_unit overlapping units and (views of) their temp_temp
+            self.unit_overlap = [overlap_idx[overlap_ptr[u]:overlap_ptr[u+1]]
+                                 for u in range(n_unit)]
+            self.temp_temp = [temp_temp_data[overlap_ptr[u]:overlap_ptr[u+1]]
+                              for u in range(n_unit)]
+        else:
+            # np.ndarray, shape: (n_unit, n_unit)
+            self.unit_overlap = np.zeros([n_unit, n_unit], 'bool')
+            self.unit_overlap[overlap_rows, overlap_idx] = True
 
     def set_offset(self, x):
         self.peak_time_temp_temp_offset = x
@@ -730,29 +747,117 @@ class TempTempConv(object):
         return new_spike_train
 
 
-def temp_temp_partial(
-    units, aligned_temp_, align_shifts_, unit_unit_overlap_,
-    spat_comp_, temp_comp_, rank_, n_unit_):
-    # Helper class for computing temp temp that is used in parmap parallelization
-    temp_temp = [[0. for i in range(n_unit_)] for j in range(len(units))]
-    i_unit = 0
+def overlapping_unit_pairs(viscs, main_chans, geom, block_size=100000):
+    """Units that share at least one visible channel
+
+    Candidates come from a kd tree over the position of the main channel of
+    each unit: units sharing a channel are at most as far apart as the sum of
+    the distances from their main channels to their farthest visible channel.
+
+    params:
+    -------
+    viscs: np.ndarray
+        shape (n_unit, n_channel), visible channels of each unit
+    main_chans: np.ndarray
+        shape (n_unit,), main channel of each unit
+    geom: np.ndarray
+        shape (n_channel, 2)
+
+    returns:
+    --------
+    CSR row pointers (n_unit + 1,) and sorted column indices (n_pairs,),
+    every unit overlaps with itself
+    """
+    n_unit = viscs.shape[0]
+    pos = geom[main_chans]
+
+    # farthest visible channel of each unit
+    radius = np.zeros(n_unit)
+    units, chans = np.where(viscs)
+    np.maximum.at(radius, units,
+                  np.linalg.norm(geom[chans] - pos[units], axis=1))
+
+    eps = 1e-6*(1 + radius.max())
+    pairs = cKDTree(pos).query_pairs(
+        2*radius.max() + eps, output_type='ndarray').reshape(-1, 2)
+    dist = np.linalg.norm(pos[pairs[:, 0]] - pos[pairs[:, 1]], axis=1)
+    pairs = pairs[dist <= radius[pairs[:, 0]] + radius[pairs[:, 1]] + eps]
+
+    # exact check on the candidates
+    keep = np.zeros(len(pairs), 'bool')
+    for k in range(0, len(pairs), block_size):
+        pairs_ = pairs[k:k+block_size]
+        keep[k:k+block_size] = np.any(
+            viscs[pairs_[:, 0]] & viscs[pairs_[:, 1]], 1)
+    pairs = pairs[keep]
+
+    rows = np.hstack((pairs[:, 0], pairs[:, 1], np.arange(n_unit)))
+    cols = np.hstack((pairs[:, 1], pairs[:, 0], np.arange(n_unit)))
+    cols = cols[np.lexsort((cols, rows))]
+    indptr = np.hstack((0, np.cumsum(np.bincount(rows, minlength=n_unit))))
+
+    return indptr, cols
+
+
+def temp_temp_pair(unshifted_temp, align_shifts, spat_comp, temp_comp, rank,
+                   chans=None):
+    """Convolution of an unshifted template with the shifted svd of another,
+    chans are the channels where spat_comp is non zero (all by default)
+    """
+    if chans is None:
+        chans = np.arange(len(align_shifts))
+
+    # For all spatially overlapping templates, convolve them with
+    # the outer loop template using the SVD trick
+    shifts = reverse_shifts(align_shifts)
+    size = unshifted_temp.shape[1]
+    shifted_data = np.zeros([len(chans), size + shifts.max()])
+    shifted_data[np.arange(len(chans))[:, None],
+                 np.arange(size) + shifts[chans][:, None]] = unshifted_temp[chans]
+    transformed_data = np.matmul(spat_comp[chans, :rank].T, shifted_data)
+    temp_temp = 0.
+    for r in range(rank):
+        temp_temp += np.convolve(transformed_data[r], temp_comp[r, ::-1])
+    return temp_temp
+
+
+def temp_temp_partial(units, tmp_dir, rank_):
+    # Helper for computing temp temp that is used in parmap parallelization,
+    # reads the inputs and writes rows of the temp_temp buffer in tmp_dir
+    def load(name, mmap_mode=None):
+        return np.load(os.path.join(tmp_dir, name+'.npy'), mmap_mode=mmap_mode)
+
+    aligned_temp_ = load('aligned_temp')
+    align_shifts_ = load('align_shifts')
+    spat_comp_ = load('spat_comp')
+    temp_comp_ = load('temp_comp')
+    overlap_ptr = load('overlap_ptr')
+    overlap_idx = load('overlap_idx')
+    row_shifts = load('row_shifts')
+    temp_temp = load('temp_temp', mmap_mode='r+')
+
+    # only channels with a non zero spatial component matter
+    spat_chans = [np.where(np.any(spat_comp_[unit, :, :rank_] != 0, 1))[0]
+                  for unit in range(len(spat_comp_))]
+
     #for unit in tqdm(units, "Computing pairwise convolution of templates."):
     for unit in units:
         # Full temp is the unshifted reconstructed
         # templates for a unit that acts as the data
         # that other units get convolved by
         unshifted_temp = shift_channels(aligned_temp_[unit], align_shifts_[unit])
-        for ounit in np.where(unit_unit_overlap_[unit])[0]:
-            # For all spatially overlapping templates, convolve them with
-            # the outer loop template using the SVD trick
-            shifts = reverse_shifts(align_shifts_[ounit])
-            shifted_data = shift_channels(unshifted_temp, shifts)
-            transformed_data = np.matmul(spat_comp_[ounit][:, :rank_].T, shifted_data)
-            for r in range(rank_):
-                temp_temp[i_unit][ounit] += np.convolve(
-                    transformed_data[r], temp_comp_[ounit][r, ::-1])
-        i_unit += 1
-    return temp_temp
+        shift = row_shifts[unit]
+        rows = np.zeros([overlap_ptr[unit+1] - overlap_ptr[unit],
+                         temp_temp.shape[1]], 'float32')
+        for j, ounit in enumerate(
+                overlap_idx[overlap_ptr[unit]:overlap_ptr[unit+1]]):
+            temp_temp_ = temp_temp_pair(
+                unshifted_temp, align_shifts_[ounit], spat_comp_[ounit],
+                temp_comp_[ounit], rank_, spat_chans[ounit])
+            rows[j, shift:shift+len(temp_temp_)] = temp_temp_
+        temp_temp[overlap_ptr[unit]:overlap_ptr[unit+1]] = rows
+
+    temp_temp.flush()
 
 
 def align_templates(temp_, jitter, neigh_chans, ref=None, min_loc_ref=None):
@@ -31,22 +31,80 @@ def deduplicate_gpu(spike_index_torch, energy_torch,
 
 def deduplicate(spike_index, energy,
                 recording_shape, channel_index,
-                max_window=5):
+                max_window=5, block_size=100000):
+    """Deduplicate spikes without building a dense (T, C) energy train
 
-    # initialize energy train
-    energy_train = np.zeros(recording_shape)
-    energy_train[spike_index[:,0], spike_index[:, 1]] = energy
-    energy_train = torch.from_numpy(energy_train).float()
+    Same result as deduplicate_gpu: a spike is kept if its energy is the
+    largest among spikes within max_window samples on its neighboring
+    channels (channel_index). Works on the spike list directly, so memory
+    scales with the number of spikes, not with the recording size
 
-    maxpool = torch.nn.MaxPool2d(kernel_size=[max_window*2+1, 1],
-                                 stride=1, padding=[max_window, 0])
-    max_energy = maxpool(energy_train[None, None])[0, 0]
-    max_energy = torch.cat(
-        (max_energy,
-         torch.zeros([max_energy.shape[0], 1]).float()),
-        1)
-    max_energy = torch.max(max_energy[:, channel_index], 2)[0] - 1e-8
-    spike_train_dedup = torch.nonzero(
-        (energy_train >= max_energy) & (energy_train > 2)).data.numpy()
+    Parameters
+    ----------
+    spike_index: numpy.ndarray (n_spikes, 2)
+        Spike times and channels
+    energy: numpy.ndarray (n_spikes,)
+        Energy of each spike
+    recording_shape: tuple
+        (T, C) shape of the recording the spikes were detected on
+    channel_index: numpy.ndarray (C, n_neigh)
+        Neighboring channels, C is used for padding
+    max_window: int
+        Temporal window (in samples, on each side)
+    block_size: int
+        Number of spikes processed at once
+
+    Returns
+    -------
+    spike_index_dedup: numpy.ndarray (n_spikes_dedup, 2)
+        Deduplicated spikes, sorted by time and then channel
+    """
+    n_channels = recording_shape[1]
+    spike_index = np.asarray(spike_index)
+    energy = np.asarray(energy)
+
+    idx_keep = energy > 0
+    spike_index = spike_index[idx_keep].astype('int64')
+    energy = energy[idx_keep]
+
+    # sort by time and channel, keep a single spike (the largest) for
+    # spikes detected at the same time and channel
+    key = spike_index[:, 0]*n_channels + spike_index[:, 1]
+    idx_sort = np.lexsort((-energy, key))
+    key = key[idx_sort]
+    idx_sort = idx_sort[np.hstack((True, key[1:] != key[:-1]))]
+    times = spike_index[idx_sort, 0]
+    channels = spike_index[idx_sort, 1]
+    energy = energy[idx_sort]
+
+    # neighbors[c, c2] is True if c2 is in channel_index[c]
+    neighbors = np.zeros((n_channels, n_channels + 1), 'bool')
+    neighbors[np.arange(n_channels)[:, None], channel_index] = True
+    neighbors = neighbors[:, :n_channels]
+
+    # range of spikes (in any channel) within max_window of each spike
+    start = np.searchsorted(times, times - max_window, side='left')
+    end = np.searchsorted(times, times + max_window, side='right')
+
+    n_spikes = len(times)
+    max_energy = np.zeros(n_spikes, energy.dtype)
+    for k in range(0, n_spikes, block_size):
+        start_ = start[k:k+block_size]
+        n_pairs = end[k:k+block_size] - start_
+        pair_offsets = np.cumsum(n_pairs) - n_pairs
+
+        # all (spike, spike within window) pairs for this block
+        ii = np.repeat(np.arange(k, k + len(start_)), n_pairs)
+        jj = (np.arange(n_pairs.sum()) -
+              np.repeat(pair_offsets - start_, n_pairs))
+
+        pair_energy = np.where(neighbors[channels[ii], channels[jj]],
+                               energy[jj], 0)
+        max_energy[k:k+block_size] = np.maximum.reduceat(
+            pair_energy, pair_offsets)
+
+    idx_dedup = energy >= max_energy - 1e-8
+    spike_index_dedup = np.vstack((times[idx_dedup],
+                                   channels[idx_dedup])).T
 
     return spike_index_dedup
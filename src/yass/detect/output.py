@@ -1,59 +1,210 @@
 import logging
 import os
+import uuid
 import numpy as np
 
+
+class SpikeIndexStore(object):
+    """Append-only, columnar store of detected spikes
+
+    Spikes are appended one batch at a time to fixed dtype column files
+    (times.bin, int64 and channels.bin, int32) and every append adds a
+    row (batch_id, offset, n_spikes, n_detected) to index.bin. The index
+    row is written after the data, so the batches listed in the index can
+    be read at any time, also while detection is still running. Each
+    worker appends to its own store, so no locking is needed
+
+    Parameters
+    ----------
+    path: str
+        Store directory, created if it does not exist
+    """
+    INDEX_COLUMNS = 4
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        self.fname_times = os.path.join(path, 'times.bin')
+        self.fname_channels = os.path.join(path, 'channels.bin')
+        self.fname_index = os.path.join(path, 'index.bin')
+
+        # number of spikes in the store, set on the first append
+        self._n_spikes = None
+
+    def read_index(self):
+        """(n_batches, 4) array with batch_id, offset, n_spikes and
+        n_detected (before deduplication) for every complete batch
+        """
+        if not os.path.exists(self.fname_index):
+            return np.zeros((0, self.INDEX_COLUMNS), 'int64')
+
+        index = np.fromfile(self.fname_index, dtype='int64')
+        n_batches = len(index)//self.INDEX_COLUMNS
+
+        return index[:n_batches*self.INDEX_COLUMNS].reshape(
+            n_batches, self.INDEX_COLUMNS)
+
+    def read(self):
+        """Return the index and the times and channels of all spikes in
+        complete batches
+        """
+        index = self.read_index()
+        n_spikes = _n_spikes_in_index(index)
+
+        times = np.fromfile(self.fname_times, dtype='int64',
+                            count=n_spikes) if n_spikes else \
+            np.zeros(0, 'int64')
+        channels = np.fromfile(self.fname_channels, dtype='int32',
+                               count=n_spikes) if n_spikes else \
+            np.zeros(0, 'int32')
+
+        return index, times, channels
+
+    def append(self, batch_id, spike_index, n_detected):
+        """Append the (n_spikes, 2) spike_index of a batch
+        """
+        if self._n_spikes is None:
+            self._n_spikes = self._truncate_incomplete()
+
+        with open(self.fname_times, 'ab') as f:
+            f.write(spike_index[:, 0].astype('int64').tobytes())
+        with open(self.fname_channels, 'ab') as f:
+            f.write(spike_index[:, 1].astype('int32').tobytes())
+
+        row = np.array([batch_id, self._n_spikes, len(spike_index),
+                        n_detected], 'int64')
+        with open(self.fname_index, 'ab') as f:
+            f.write(row.tobytes())
+
+        self._n_spikes += len(spike_index)
+
+    def _truncate_incomplete(self):
+        """Remove data from an interrupted append (spikes not listed in the
+        index and partial index rows), returns the number of spikes
+        """
+        index = self.read_index()
+        n_spikes = _n_spikes_in_index(index)
+
+        for fname, size in (
+                (self.fname_times, n_spikes*8),
+                (self.fname_channels, n_spikes*4),
+                (self.fname_index, index.size*8)):
+            if os.path.exists(fname) and os.path.getsize(fname) > size:
+                with open(fname, 'r+b') as f:
+                    f.truncate(size)
+
+        return n_spikes
+
+
+def _n_spikes_in_index(index):
+    if len(index) == 0:
+        return 0
+    return int(index[-1, 1] + index[-1, 2])
+
+
+# stores opened by this process, see open_worker_store
+_worker_stores = {}
+
+
+def new_run_id():
+    """Token that tells apart the worker stores of different detection runs
+    """
+    return uuid.uuid4().hex[:8]
+
+
+def open_worker_store(batch_files_dir, run_id):
+    """Store of the current process for detection run run_id in
+    batch_files_dir
+
+    It is opened once per process and run, so incomplete data is only
+    truncated before the first append. Stores of earlier runs (also of
+    processes that had the same pid) are read but never appended to
+    """
+    key = (batch_files_dir, run_id, os.getpid())
+    if key not in _worker_stores:
+        _worker_stores[key] = SpikeIndexStore(os.path.join(
+            batch_files_dir, 'worker_{}_{}'.format(run_id, os.getpid())))
+
+    return _worker_stores[key]
+
+
+def list_stores(batch_files_dir):
+    return [SpikeIndexStore(os.path.join(batch_files_dir, fname))
+            for fname in sorted(os.listdir(batch_files_dir))
+            if fname.startswith('worker_')]
+
+
+def completed_batches(batch_files_dir):
+    """Ids of batches already saved in any store in batch_files_dir
+    """
+    batch_ids = [store.read_index()[:, 0]
+                 for store in list_stores(batch_files_dir)]
+    if len(batch_ids) == 0:
+        return set()
+    return set(np.hstack(batch_ids).tolist())
+
+
+def kill_edge_spikes(spike_index_list, minibatch_loc):
+    """Keep spikes inside their minibatch (without buffer) and put all
+    minibatches together, sorted by time
+    """
+    spike_index = []
+    for spike_index_temp, (t_start, t_end) in zip(spike_index_list,
+                                                   minibatch_loc):
+        spike_index_temp = spike_index_temp[np.logical_and(
+            spike_index_temp[:, 0] >= t_start,
+            spike_index_temp[:, 0] < t_end)]
+        if np.any(np.diff(spike_index_temp[:, 0]) < 0):
+            spike_index_temp = spike_index_temp[np.argsort(
+                spike_index_temp[:, 0], kind='mergesort')]
+        spike_index.append(spike_index_temp)
+
+    if len(spike_index) == 0:
+        return np.zeros((0, 2), 'int64')
+
+    return np.concatenate(spike_index, axis=0)
+
+
 def gather_result(fname_save, batch_files_dir):
 
     logger = logging.getLogger(__name__)
     logger.info('gather detected spikes')
 
-    fnames = os.listdir(batch_files_dir)
-    spike_index = []
-    spike_index_prekill = []
+    # one (times, channels) segment per batch, from all stores
+    segments = {}
     n_spikes_prekill = 0
-    n_spikes_postkill = 0
-    for batch_id in range(len(fnames)):
-
-        # detection index
-        fname = os.path.join(batch_files_dir, fnames[batch_id])
-        detect_data =  np.load(fname, allow_pickle=True)
-        spike_index_prekill_list = detect_data['spike_index']
-        spike_index_list = detect_data['spike_index_dedup']
-        minibatch_loc = detect_data['minibatch_loc']
+    for store in list_stores(batch_files_dir):
+        index, times, channels = store.read()
+        for batch_id, offset, n_spikes, n_detected in index:
+            if batch_id in segments:
+                continue
+            segments[batch_id] = (times[offset:offset+n_spikes],
+                                  channels[offset:offset+n_spikes])
+            n_spikes_prekill += n_detected
 
-        # kill edge spikes and gather results
-        for ctr in range(len(spike_index_list)):
+    # each batch is sorted and batches cover consecutive time ranges, so
+    # merging them in batch order gives the sorted spike train
+    batch_ids = sorted(segments.keys())
+    times = np.hstack([segments[batch_id][0] for batch_id in batch_ids]
+                      + [np.zeros(0, 'int64')])
+    channels = np.hstack([segments[batch_id][1] for batch_id in batch_ids]
+                         + [np.zeros(0, 'int32')])
 
-            t_start, t_end = minibatch_loc[ctr]
-            spike_index_temp = spike_index_list[ctr]
+    if np.any(np.diff(times) < 0):
+        idx_sort = np.argsort(times, kind='mergesort')
+        times = times[idx_sort]
+        channels = channels[idx_sort]
 
-            idx_keep = np.where(np.logical_and(
-                spike_index_temp[:, 0] >= t_start,
-                spike_index_temp[:, 0] < t_end))[0]
-            spike_index.append(spike_index_temp[idx_keep].astype('int32'))
-
-            spike_index_prekill.append(spike_index_prekill_list[ctr].astype('int32'))
-
-            n_spikes_prekill += spike_index_prekill_list[ctr].shape[0]
-            n_spikes_postkill += len(idx_keep)
+    spike_index = np.vstack((times, channels)).T.astype('int32')
 
     logger.info('Total {} spikes detected'.format(
         n_spikes_prekill))
     logger.info('Total {} spikes survived after deduplication'.format(
-        n_spikes_postkill))
-
-    spike_index = np.vstack(spike_index)
-    #spike_index_prekill = np.vstack(spike_index_prekill)
-    
-    idx_sort = np.argsort(spike_index[:,0])
-    spike_index = spike_index[idx_sort]
-
-    #idx_sort = np.argsort(spike_index_prekill[:,0])
-    #spike_index_prekill = spike_index_prekill[idx_sort]
+        len(spike_index)))
 
     np.save(fname_save, spike_index)
-    #np.save(fname_save[:fname_save.rfind('.')]+'_prekill.npy',
-    #        spike_index_prekill)
 
 
 def gather_result_orig(fname_save, batch_files_dir, dedup_dir, output_directory):
@@ -16,10 +16,12 @@ import parmap
 from yass import read_config
 from yass.reader import READER
 from yass.neuralnetwork import Detect, Denoise
-from yass.util import file_loader
+from yass.util import file_loader, prefetch, worker_devices
 from yass.threshold.detect import voltage_threshold
 from yass.detect.deduplication import deduplicate_gpu, deduplicate
-from yass.detect.output import gather_result
+from yass.detect.output import (gather_result, completed_batches,
+                               open_worker_store, new_run_id,
+                               kill_edge_spikes)
 from yass.geometry import make_channel_index
 
 
@@ -127,7 +129,9 @@ def run_neural_network(standardized_path, standardized_dtype,
 
     CONFIG = read_config()
 
-    os.environ["CUDA_VISIBLE_DEVICES"] = str(CONFIG.resources.gpu_id)
+    # with several gpus, each worker uses its own device
+    if len(CONFIG.torch_devices) == 1:
+        os.environ["CUDA_VISIBLE_DEVICES"] = str(CONFIG.resources.gpu_id)
 
     # load NN detector
     detector = Detect(CONFIG.neuralnetwork.detect.n_filters,
@@ -167,110 +171,236 @@ def run_neural_network(standardized_path, standardized_dtype,
     # threshold for neuralnet detection
     detect_threshold = CONFIG.detect.threshold
 
-    # loop over each chunk
-    batch_ids = np.arange(reader.n_batches)
-    if False:
-        batch_ids_split = np.split_array(batch_ids, len(CONFIG.torch_devices))
-        processes = []
-        for ii, device in enumerate(CONFIG.torch_devices):
-            p = mp.Process(target=run_nn_detction_batch,
-                           args=(batch_ids_split[ii], output_directory, reader, n_sec_chunk,
-                                 detector, denoiser, channel_index_dedup,
-                                 detect_threshold, device))
-            p.start()
-            processes.append(p)
-        for p in processes:
-            p.join()
+    # loop over each chunk, skipping the ones already saved
+    done = completed_batches(output_directory)
+    batch_ids = [batch_id for batch_id in range(reader.n_batches)
+                 if batch_id not in done]
+
+    # workers of this run save to new stores
+    run_id = new_run_id()
+
+    # one worker per gpu or, without gpus, n_processors cpu workers
+    devices, n_threads = worker_devices(CONFIG)
+    if len(devices) > 1:
+        logger.info("running detection on {} workers".format(len(devices)))
+        run_nn_detection_workers(batch_ids, devices, n_threads,
+                                 output_directory, run_id, reader,
+                                 n_sec_chunk, detector, denoiser,
+                                 channel_index_dedup, detect_threshold)
     else:
-        run_nn_detction_batch(batch_ids, output_directory, reader, n_sec_chunk,
-                                 detector, denoiser, channel_index_dedup,
-                                 detect_threshold, device=CONFIG.resources.gpu_id)
+        run_nn_detction_batch(batch_ids, output_directory, run_id, reader,
+                              n_sec_chunk, detector, denoiser,
+                              channel_index_dedup, detect_threshold,
+                              device=devices[0])
+
+
+def run_nn_detection_workers(batch_ids, devices, n_threads, output_directory,
+                             run_id, reader, n_sec_chunk, detector, denoiser,
+                             channel_index_dedup, detect_threshold):
+    """Run nn detection with one process per device
+
+    Batch ids are put in a shared queue and each worker takes the next
+    batch when it finishes the previous one, so faster workers process
+    more batches. Each worker saves its results in its own store and
+    they are gathered in batch order. cpu workers use n_threads torch
+    threads each
+    """
+    # cuda cannot be used in forked workers. py2 has no start method
+    # contexts, there torch's default start method is used
+    ctx = mp.get_context('spawn') if hasattr(mp, 'get_context') else mp
 
+    batch_queue = ctx.Queue()
+    for batch_id in batch_ids:
+        batch_queue.put(int(batch_id))
+    # one stop signal per worker
+    for _ in devices:
+        batch_queue.put(None)
+
+    processes = []
+    for device in devices:
+        p = ctx.Process(target=run_nn_detection_worker,
+                        args=(batch_queue, output_directory, run_id,
+                              reader, n_sec_chunk, detector, denoiser,
+                              channel_index_dedup, detect_threshold,
+                              device, n_threads))
+        p.start()
+        processes.append(p)
+    for p in processes:
+        p.join()
+
+    failed = [ii for ii, p in enumerate(processes) if p.exitcode != 0]
+    if len(failed) > 0:
+        raise RuntimeError('nn detection failed on workers {} (devices {})'
+                           .format(failed, [str(devices[ii])
+                                            for ii in failed]))
+
+
+def run_nn_detection_worker(batch_queue, output_directory, run_id, reader,
+                            n_sec_chunk, detector, denoiser,
+                            channel_index_dedup, detect_threshold,
+                            device, n_threads):
+
+    if device.type == 'cpu':
+        torch.set_num_threads(n_threads)
+
+    run_nn_detction_batch(iter_queue(batch_queue), output_directory, run_id,
+                          reader, n_sec_chunk, detector, denoiser,
+                          channel_index_dedup, detect_threshold, device)
+
+
+def iter_queue(batch_queue):
+    """Yield batch ids from a shared queue until a stop signal (None)
+    """
+    while True:
+        batch_id = batch_queue.get()
+        if batch_id is None:
+            return
+        yield batch_id
 
-def run_nn_detction_batch(batch_ids, output_directory,
+
+def run_nn_detction_batch(batch_ids, output_directory, run_id,
                           reader, n_sec_chunk,
                           detector, denoiser,
                           channel_index_dedup,
                           detect_threshold,
                           device):
 
+    device = torch.device(device)
+    store = open_worker_store(output_directory, run_id)
     detector = detector.to(device)
     denoiser = denoiser.to(device)
 
-    for batch_id in batch_ids:
-        # skip if the file exists
-        fname = os.path.join(
-            output_directory,
-            "detect_" + str(batch_id).zfill(5) + '.npz')
+    # batches are read (and pinned, if on gpu) in a background thread
+    # while the previous batch is being processed
+    batches = prefetch(
+        read_nn_detection_batches(batch_ids, reader, n_sec_chunk,
+                                  pin_memory=(device.type == 'cuda')),
+        size=2)
 
-        if os.path.exists(fname):
-            continue
+    with torch.no_grad():
+        for batch_id, batched_recordings, minibatch_loc_rel in batches:
+
+            # all minibatches of this batch are copied at once
+            batched_recordings = batched_recordings.to(device,
+                                                       non_blocking=True)
+
+            # offset for big batch
+            batch_offset = reader.idx_list[batch_id, 0] - reader.buffer
+            # location of each minibatch (excluding buffer)
+            minibatch_loc = minibatch_loc_rel + batch_offset
+
+            (spike_index_list,
+             spike_index_dedup_list) = detect_nn_minibatches(
+                batched_recordings, detector, denoiser,
+                channel_index_dedup, detect_threshold)
 
+            # update the location relative to the whole recording
+            for j in range(len(spike_index_dedup_list)):
+                spike_index_dedup_list[j][:, 0] += (minibatch_loc[j, 0] -
+                                                    reader.buffer)
+
+            #if processing_ctr%100==0:
+            print('batch : {}'.format(batch_id))
+
+            # save result
+            n_detected = np.sum([len(spike_index_temp) for
+                                 spike_index_temp in spike_index_list])
+            store.append(batch_id,
+                         kill_edge_spikes(spike_index_dedup_list,
+                                          minibatch_loc),
+                         n_detected)
 
+    del detector
+    del denoiser
+
+
+def read_nn_detection_batches(batch_ids, reader, n_sec_chunk,
+                              pin_memory=False):
+    """Read batches for nn detection
+
+    Yields (batch_id, batched_recordings, minibatch_loc_rel),
+    batched_recordings is a torch tensor of shape
+    (n_minibatches, minibatch length + 2*buffer, n_channels)
+    """
+    for batch_id in batch_ids:
         # get a bach of size n_sec_chunk
-        # but partioned into smaller minibatches of 
+        # but partioned into smaller minibatches of
         # size n_sec_chunk_gpu
         batched_recordings, minibatch_loc_rel = reader.read_data_batch_batch(
             batch_id,
-            #CONFIG.detect.n_sec_chunk,
             n_sec_chunk,
             add_buffer=True)
 
-        # offset for big batch
-        batch_offset = reader.idx_list[batch_id, 0] - reader.buffer
-        # location of each minibatch (excluding buffer)
-        minibatch_loc = minibatch_loc_rel + batch_offset
-        spike_index_list = []
-        spike_index_dedup_list = []
-        for j in range(batched_recordings.shape[0]):
-            # detect spikes and get wfs
-            spike_index, wfs = detector.get_spike_times(
-                torch.FloatTensor(batched_recordings[j]).to(device),
-                threshold=detect_threshold)
-
-            # denoise and take ptp as energy
-            if len(spike_index) == 0:
-                del spike_index, wfs
-                continue
-
-            wfs_denoised = denoiser(wfs)[0].data
-            energy = (torch.max(wfs_denoised, 1)[0] - torch.min(wfs_denoised, 1)[0])
-
-            # deduplicate
-            spike_index_dedup = deduplicate_gpu(
-                spike_index, energy,
-                batched_recordings[j].shape,
-                channel_index_dedup)
-
-            # convert to numpy
-            spike_index_cpu = spike_index.cpu().data.numpy()
-            spike_index_dedup_cpu = spike_index_dedup.cpu().data.numpy()
+        batched_recordings = torch.from_numpy(batched_recordings)
+        if pin_memory:
+            batched_recordings = batched_recordings.pin_memory()
+
+        yield batch_id, batched_recordings, minibatch_loc_rel
 
-            # update the location relative to the whole recording
-            spike_index_cpu[:, 0] += (minibatch_loc[j, 0] - reader.buffer)
-            spike_index_dedup_cpu[:, 0] += (minibatch_loc[j, 0] - reader.buffer)
-            spike_index_list.append(spike_index_cpu)
-            spike_index_dedup_list.append(spike_index_dedup_cpu)
-
-            del wfs
-            del wfs_denoised
-            del energy
-            del spike_index
-            del spike_index_dedup
-
-            torch.cuda.empty_cache()
-
-        #if processing_ctr%100==0:
-        print('batch : {}'.format(batch_id))
-
-        # save result
-        np.savez(fname,
-                 spike_index=spike_index_list,
-                 spike_index_dedup=spike_index_dedup_list,
-                 minibatch_loc=minibatch_loc)
-        
-    del detector
-    del denoiser
+
+def detect_nn_minibatches(batched_recordings, detector, denoiser,
+                          channel_index_dedup, detect_threshold,
+                          denoise_block_size=50000):
+    """Detect and deduplicate spikes in all minibatches of a batch
+
+    The detector runs on one minibatch at a time (to bound memory) but the
+    denoiser runs on the waveforms of all minibatches at once and results
+    are copied back to the cpu once per batch
+
+    Returns lists (one entry per minibatch) of spike_index and
+    deduplicated spike_index, with times relative to each minibatch
+    """
+    n_minibatches = batched_recordings.shape[0]
+    minibatch_shape = batched_recordings.shape[1:]
+
+    # detect
+    spike_index = []
+    wfs = []
+    for j in range(n_minibatches):
+        spike_index_, wfs_ = detector.get_spike_times(
+            batched_recordings[j], threshold=detect_threshold)
+        spike_index.append(spike_index_)
+        wfs.append(wfs_)
+    n_spikes = [len(spike_index_) for spike_index_ in spike_index]
+    wfs = torch.cat(wfs, 0)
+
+    # denoise and take ptp as energy
+    energy = []
+    for k in range(0, wfs.shape[0], denoise_block_size):
+        wfs_denoised = denoiser(wfs[k:k+denoise_block_size])[0]
+        energy.append(torch.max(wfs_denoised, 1)[0] -
+                      torch.min(wfs_denoised, 1)[0])
+    energy = torch.split(torch.cat(energy, 0) if len(energy) > 0
+                         else wfs.new_zeros(0), n_spikes)
+
+    # deduplicate
+    spike_index_dedup = []
+    for j in range(n_minibatches):
+        if n_spikes[j] == 0:
+            spike_index_dedup.append(spike_index[j])
+            continue
+        if spike_index[j].device.type == 'cpu':
+            # no need for a dense energy train on cpu
+            spike_index_dedup.append(torch.from_numpy(deduplicate(
+                spike_index[j].numpy(), energy[j].numpy(),
+                minibatch_shape,
+                channel_index_dedup)))
+        else:
+            spike_index_dedup.append(deduplicate_gpu(
+                spike_index[j], energy[j],
+                minibatch_shape,
+                channel_index_dedup))
+    n_spikes_dedup = [len(spike_index_) for spike_index_ in spike_index_dedup]
+
+    # convert to numpy, one transfer per batch
+    spike_index = torch.cat(spike_index, 0).cpu().numpy()
+    spike_index_dedup = torch.cat(spike_index_dedup, 0).cpu().numpy()
+
+    spike_index_list = np.split(spike_index, np.cumsum(n_spikes)[:-1])
+    spike_index_dedup_list = np.split(spike_index_dedup,
+                                      np.cumsum(n_spikes_dedup)[:-1])
+
+    return spike_index_list, spike_index_dedup_list
 
 
 def run_voltage_treshold(standardized_path, standardized_dtype,
@@ -309,39 +439,41 @@ def run_voltage_treshold(standardized_path, standardized_dtype,
     # neighboring channels
     channel_index = make_channel_index(
         CONFIG.neigh_channels, CONFIG.geom, steps=2)
-    
+
+    # skip batches already saved
+    done = completed_batches(output_directory)
+    batch_ids = [batch_id for batch_id in range(reader.n_batches)
+                 if batch_id not in done]
+
+    # workers of this run save to new stores
+    run_id = new_run_id()
+
     if CONFIG.resources.multi_processing:
         parmap.starmap(run_voltage_threshold_parallel, 
-                       list(zip(np.arange(reader.n_batches))),
+                       list(zip(batch_ids)),
                        reader,
                        n_sec_chunk,
                        CONFIG.detect.threshold,
                        channel_index,
                        output_directory,
+                       run_id,
                        processes=CONFIG.resources.n_processors,
                        pm_pbar=True)                
     else:
-        for batch_id in range(reader.n_batches):
+        for batch_id in batch_ids:
             run_voltage_threshold_parallel(
                 batch_id,
                 reader,
                 n_sec_chunk,
                 CONFIG.detect.threshold,
                 channel_index,
-                output_directory)
+                output_directory,
+                run_id)
 
 
 def run_voltage_threshold_parallel(batch_id, reader, n_sec_chunk,
                                    threshold, channel_index,
-                                   output_directory):
-
-    # skip if the file exists
-    fname = os.path.join(
-        output_directory,
-        "detect_" + str(batch_id).zfill(5) + '.npz')
-
-    if os.path.exists(fname):
-        return
+                                   output_directory, run_id):
 
     # get a bach of size n_sec_chunk
     # but partioned into smaller minibatches of 
@@ -355,35 +487,26 @@ def run_voltage_threshold_parallel(batch_id, reader, n_sec_chunk,
     batch_offset = reader.idx_list[batch_id, 0] - reader.buffer
     # location of each minibatch (excluding buffer)
     minibatch_loc = minibatch_loc_rel + batch_offset
-    spike_index_list = []
+    n_detected = 0
     spike_index_dedup_list = []
     for j in range(batched_recordings.shape[0]):
         spike_index, energy = voltage_threshold(
             batched_recordings[j], 
             threshold)
 
-        # move to gpu
-        spike_index = torch.from_numpy(spike_index)
-        energy = torch.from_numpy(energy)
-
         # deduplicate
-        spike_index_dedup = deduplicate_gpu(
+        spike_index_dedup = deduplicate(
             spike_index, energy,
             batched_recordings[j].shape,
             channel_index)
 
-        # convert to numpy
-        spike_index = spike_index.cpu().data.numpy()
-        spike_index_dedup = spike_index_dedup.cpu().data.numpy()
-        
         # update the location relative to the whole recording
-        spike_index[:, 0] += (minibatch_loc[j, 0] - reader.buffer)
         spike_index_dedup[:, 0] += (minibatch_loc[j, 0] - reader.buffer)
-        spike_index_list.append(spike_index)
+        n_detected += len(spike_index)
         spike_index_dedup_list.append(spike_index_dedup)
 
     # save result
-    np.savez(fname,
-             spike_index=spike_index_list,
-             spike_index_dedup=spike_index_dedup_list,
-             minibatch_loc=minibatch_loc)
+    store = open_worker_store(output_directory, run_id)
+    store.append(batch_id,
+                 kill_edge_spikes(spike_index_dedup_list, minibatch_loc),
+                 n_detected)
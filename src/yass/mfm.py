@@ -209,14 +209,18 @@ class vbPar:
         Khat = self.ahat.size
         Ngroup, nfeatures, nchannel = maskedData.meanY.shape
 
-
-
+        # log densities of all groups under all K components at once. with
+        # prec = L L^T (batched cholesky), maha = |L^T (x - mu)|^2 and
+        # logdet(prec)/2 = sum(log(diag(L)))
         const1 = -nfeatures / 2 * np.log(2 * np.pi)
         prec = self.Vhat.transpose([2, 3, 0, 1]) * self.nuhat[:, np.newaxis, np.newaxis, np.newaxis]
-        xmu = (maskedData.meanY[:, :, np.newaxis] - self.muhat).transpose([0, 2, 3, 1])
-        maha = -np.squeeze(np.matmul(xmu[:, :, :, np.newaxis], np.matmul(prec, xmu[..., np.newaxis])), axis=(3, 4))/2.0
-        const2 = np.linalg.slogdet(prec)[1] / 2.0
-        log_rho = np.sum(maha + const1 + const2, axis=-1)
+        cholPrec = np.linalg.cholesky(prec)
+        # Khat x nchannel x Ngroup x nfeatures
+        xmu = (maskedData.meanY.transpose([2, 0, 1])[np.newaxis] -
+               self.muhat.transpose([1, 2, 0])[:, :, np.newaxis])
+        maha = -np.sum(np.square(np.matmul(xmu, cholPrec)), axis=3)/2.0
+        const2 = np.sum(np.log(np.diagonal(cholPrec, axis1=2, axis2=3)), axis=2)
+        log_rho = np.sum(maha + const1 + const2[:, :, np.newaxis], axis=1).T
         log_rho += np.log(pik)
         log_rho = log_rho - np.max(log_rho, axis=1)[:, np.newaxis]
         rho = np.exp(log_rho)
@@ -349,8 +353,6 @@ class suffStatistics:
                 vbParam.rhat * maskedData.weight[:, np.newaxis], axis=0)
             self.sumY = np.zeros([nfeature, Khat, nchannel])
             self.sumYSq = np.zeros([nfeature, nfeature, Khat, nchannel])
-            self.sumYSq1BS = np.zeros(
-                [Ngroup, nfeature, nfeature, Khat, nchannel])
             self.sumYSq1 = np.zeros([nfeature, nfeature, Khat, nchannel])
             self.sumYSq2 = np.zeros([nfeature, nfeature, Khat, nchannel])
             self.calc_suffstat(maskedData, vbParam, Ngroup, Khat, nfeature,
@@ -387,69 +389,45 @@ class suffStatistics:
                 Number of channels
         """
 
-        # noMask = maskedData.groupMask > 0
-        # nnoMask = noMask.sum(0)
-        # ind1 = nnoMask == 0
-        # self.sumYSq[:,:,:,ind1] = np.eye(nfeature)[:,:,np.newaxis, np.newaxis] * self.Nhat[np.newaxis,np.newaxis,:, np.newaxis]
-        # ind2 = nnoMask < Ngroup
-        # maskedEta = np.eye(nfeature)
-        # unmaskedY = maskedData.sumY[noMask]
-
-
-        for n in range(nchannel):
-            noMask = maskedData.groupMask[:, n] > 0
-            nnoMask = np.sum(noMask)
-            if nnoMask == 0:
-                for k in range(Khat):
-                    self.sumYSq[:, :, k, n] = np.eye(nfeature) * self.Nhat[k]
-
-            elif nnoMask < Ngroup:
-                maskedEta = np.eye(nfeature)
-                unmaskedY = maskedData.sumY[noMask, :, n]
-                unmaskedsumYSq = maskedData.sumYSq[noMask, :, :, n]
-                unmaskedEta = maskedData.sumEta[noMask, :, :, n]
-                unmaskedWeight = maskedData.weight[noMask]
-
-                rhat = vbParam.rhat[noMask, :]
-                self.sumY[:, :, n] = np.dot(unmaskedY.T, rhat)
-
-                visibleCluster = np.sum(rhat, axis=0) > 1e-10
-                sumMaskedRhat = self.Nhat - \
-                    np.sum(rhat * unmaskedWeight[:, np.newaxis],
-                           axis=0)
-                self.sumYSq2[:, :, :, n] = np.sum(
-                    rhat[:, np.newaxis, np.newaxis, :]
-                    * unmaskedEta[:, :, :, np.newaxis], axis=0) + \
-                    sumMaskedRhat * maskedEta[:, :, np.newaxis]
-                self.sumYSq1[:, :, visibleCluster, n] = np.sum(
-                    rhat[:, np.newaxis, np.newaxis, visibleCluster] *
-                    unmaskedsumYSq[:, :, :, np.newaxis],
-                    axis=0)
-                self.sumYSq[:, :, :, n] = self.sumYSq1[
-                    :, :, :, n] + self.sumYSq2[:, :, :, n]
-
-            elif nnoMask == Ngroup:
-                unmaskedY = maskedData.sumY[:, :, n]
-                unmaskedsumYSq = maskedData.sumYSq[:, :, :, n]
-                unmaskedEta = maskedData.sumEta[:, :, :, n]
-
-                rhat = vbParam.rhat[noMask, :]
-                self.sumY[:, :, n] = np.dot(unmaskedY.T, rhat)
-
-                visibleCluster = np.sum(rhat, axis=0) > 1e-10
-                sumMaskedRhat = self.Nhat - \
-                    np.sum(rhat * maskedData.weight[:, np.newaxis],
-                           axis=0)
-                self.sumYSq2[:, :, :, n] = np.sum(
-                    rhat[:, np.newaxis, np.newaxis, :] *
-                    unmaskedEta[:, :, :, np.newaxis],
-                    axis=0)
-                self.sumYSq1[:, :, visibleCluster, n] = np.sum(
-                    rhat[:, np.newaxis, np.newaxis, visibleCluster] *
-                    unmaskedsumYSq[:, :, :, np.newaxis],
-                    axis=0)
-                self.sumYSq[:, :, :, n] = self.sumYSq1[
-                    :, :, :, n] + self.sumYSq2[:, :, :, n]
+        # all channels at once: on each channel only the groups that are
+        # visible (groupMask > 0) are summed, the rest of the cluster mass
+        # gets an identity covariance. sums over groups are batched matmuls
+        # (nchannel, Ngroup, Khat)
+        visible = (maskedData.groupMask > 0).T
+        nVisible = visible.sum(1)
+        rhatVisible = visible[:, :, np.newaxis] * vbParam.rhat[np.newaxis]
+
+        self.sumY = np.matmul(
+            maskedData.sumY.transpose([2, 1, 0]),
+            rhatVisible).transpose([1, 2, 0])
+
+        visibleCluster = (rhatVisible.sum(1) > 1e-10).T
+        self.sumYSq1 = np.matmul(
+            maskedData.sumYSq.transpose([3, 1, 2, 0]).reshape(
+                nchannel, nfeature*nfeature, Ngroup),
+            rhatVisible).reshape(
+                nchannel, nfeature, nfeature, Khat).transpose([1, 2, 3, 0])
+        self.sumYSq1 *= visibleCluster
+
+        self.sumYSq2 = np.matmul(
+            maskedData.sumEta.transpose([3, 1, 2, 0]).reshape(
+                nchannel, nfeature*nfeature, Ngroup),
+            rhatVisible).reshape(
+                nchannel, nfeature, nfeature, Khat).transpose([1, 2, 3, 0])
+
+        # masked part of the clusters on partially visible channels
+        partial = np.logical_and(nVisible > 0, nVisible < Ngroup)
+        sumMaskedRhat = self.Nhat - np.matmul(maskedData.weight,
+                                              rhatVisible[partial])
+        self.sumYSq2[:, :, :, partial] += np.eye(nfeature)[
+            :, :, np.newaxis, np.newaxis] * sumMaskedRhat.T
+
+        self.sumYSq = self.sumYSq1 + self.sumYSq2
+
+        # channels not visible in any group
+        empty = nVisible == 0
+        self.sumYSq[:, :, :, empty] = np.eye(nfeature)[
+            :, :, np.newaxis, np.newaxis] * self.Nhat[:, np.newaxis]
 
 
 class ELBO_Class:
@@ -575,11 +553,9 @@ def multivariate_normal_logpdf(x, mu, Lam):
 
     const = -0.5 * p * C * np.log(2 * math.pi)
 
-    logpart = 0
-
-    for c in range(C):
-        logpart = logpart + logdet(Lam[:, :, c])
-    logpart = logpart * 0.5
+    # log determinants of all channels with one batched cholesky
+    cholLam = np.linalg.cholesky(np.transpose(Lam, [2, 0, 1]))
+    logpart = np.sum(np.log(np.diagonal(cholLam, axis1=1, axis2=2)))
 
     return maha + const + logpart
 
@@ -660,6 +636,33 @@ def init_param(maskedData, K, param):
     # suffStat = suffStatistics(maskedData, vbParam)
     return vbParam, suffStat
 
+def init_param_from_rhat(maskedData, rhat, param):
+    """
+        Initializes vbPar object from given soft assignments, e.g. the
+        parent generation's rhat restricted to a subset of its spikes.
+        Clusters that are not the most likely one for any spike are
+        dropped. Calculates sufficient statistics and updates global
+        parameters for the created vbPar object.
+
+        Parameters:
+        -----------
+        maskedData: maskData object
+
+        rhat: np.array (N, K)
+            soft assignments of the N groups
+
+        param: Config object (see config.py)
+
+    """
+    k_keep = np.unique(np.argmax(rhat, axis=1))
+    rhat = rhat[:, k_keep]
+    rhat = rhat/np.sum(rhat, axis=1, keepdims=True)
+
+    vbParam = vbPar(rhat)
+    suffStat = suffStatistics(maskedData, vbParam)
+    vbParam.update_global(suffStat, param)
+    return vbParam, suffStat
+
 def init_param_v2(maskedData, K, param, n_iter=5):
     """
         Initializes vbPar object using weighted kmeans++ for initial cluster
@@ -903,22 +906,21 @@ def merge_move(maskedData, vbParam, suffStat, param, L, check_full):
         maha[np.arange(K), np.arange(K)] = np.Inf
         merged = 0
         threshold = np.max(np.min(maha, 0))
-        ctr_merge_move_inner = 0
-        while np.min(maha) < threshold and merged == 0:
-            closeset_pair = np.where(maha == np.min(maha))
-            ka = closeset_pair[0][0]
-            kb = closeset_pair[1][0]
-            maha[ka, kb] = np.inf
-            if np.argmin(maha[kb, :]).ravel()[0] == ka:
-                maha[kb, ka] = np.inf
-
-            vbParam, suffStat, merged, L, ELBO = check_merge(
-                maskedData, vbParam, suffStat, ka, kb, param, L, ELBO)
-            if merged:
-                n_merged += 1
-                K -= 1
-            
-            ctr_merge_move_inner+=1
+
+        # score every candidate pair at once, only the ones that may
+        # increase the ELBO are checked (in order) with check_merge
+        pairs = merge_candidates(maha, threshold)
+        if len(pairs) > 0:
+            ELBO_merged = merge_ELBO(suffStat, vbParam, param, pairs)
+            tol = 1e-9*np.abs(ELBO.total)
+            for j in np.where(ELBO_merged >= ELBO.total - tol)[0]:
+                ka, kb = pairs[j]
+                vbParam, suffStat, merged, L, ELBO = check_merge(
+                    maskedData, vbParam, suffStat, ka, kb, param, L, ELBO)
+                if merged:
+                    n_merged += 1
+                    K -= 1
+                    break
 
         if not merged:
             all_checked = 1
@@ -932,6 +934,95 @@ def merge_move(maskedData, vbParam, suffStat, param, L, check_full):
     return vbParam, suffStat, L
 
 
+def merge_candidates(maha, threshold):
+    """
+        Pairs of clusters (ka, kb) in the order merge_move tries to merge
+        them: increasing mahalanobis distance below threshold, a pair and
+        its transpose only once if they are mutual nearest neighbours
+    """
+    maha = np.copy(maha)
+    pairs = []
+    while np.min(maha) < threshold:
+        closeset_pair = np.where(maha == np.min(maha))
+        ka = closeset_pair[0][0]
+        kb = closeset_pair[1][0]
+        maha[ka, kb] = np.inf
+        if np.argmin(maha[kb, :]).ravel()[0] == ka:
+            maha[kb, ka] = np.inf
+        pairs.append((ka, kb))
+
+    return pairs
+
+
+def merge_ELBO(suffStat, vbParam, param, pairs):
+    """
+        Total ELBO after merging each pair of clusters in pairs, same value
+        as ELBO_Class after check_merge but for all pairs at once. Only
+        the merged cluster has new global parameters, the other clusters
+        keep their terms of the current ELBO
+
+        Parameters:
+        -----------
+        suffStat: suffStatistics object
+
+        vbParam: vbPar object, global parameters updated from suffStat
+
+        param: Config object (see Config.py)
+
+        pairs: list
+            (ka, kb) cluster pairs
+    """
+    prior = param.cluster.prior
+    nfeature, Khat, nchannel = vbParam.muhat.shape
+    ka, kb = np.asarray(pairs).T
+
+    # global parameters of the merged clusters (see vbPar.update_global)
+    Nhat = suffStat.Nhat[ka] + suffStat.Nhat[kb]
+    sumY = (suffStat.sumY[:, ka] + suffStat.sumY[:, kb]).transpose([1, 2, 0])
+    sumYSq = (suffStat.sumYSq[:, :, ka] +
+              suffStat.sumYSq[:, :, kb]).transpose([2, 3, 0, 1])
+    ahat = prior.a + Nhat
+    lambdahat = prior.lambda0 + Nhat
+    nuhat = prior.nu + Nhat
+    muhat = sumY / lambdahat[:, np.newaxis, np.newaxis]
+
+    temp = muhat[..., np.newaxis] * sumY[:, :, np.newaxis]
+    invVhat = (np.eye(nfeature) / prior.V +
+               lambdahat[:, np.newaxis, np.newaxis, np.newaxis] *
+               muhat[..., np.newaxis] * muhat[:, :, np.newaxis] -
+               temp - temp.transpose([0, 1, 3, 2]) + sumYSq)
+    logdetVhat = -2*np.sum(np.log(np.diagonal(
+        np.linalg.cholesky(invVhat), axis1=2, axis2=3)), axis=(1, 2))
+
+    # cluster dependent terms (see ELBO_Class)
+    def kvarying(ahat, lambdahat, nuhat, logdetVhat):
+        return (specsci.gammaln(ahat) +
+                nfeature * nchannel/2.0 * np.log(prior.lambda0/lambdahat) +
+                logdetVhat * nuhat/2.0 +
+                nchannel * specsci.multigammaln(nuhat/2.0, nfeature))
+
+    logdetVhat_now = np.sum(np.linalg.slogdet(
+        np.transpose(vbParam.Vhat, [2, 3, 0, 1]))[1], axis=1)
+    kvarying_now = kvarying(vbParam.ahat, vbParam.lambdahat,
+                            vbParam.nuhat, logdetVhat_now)
+    kvarying_merged = kvarying(ahat, lambdahat, nuhat, logdetVhat)
+
+    entropy_now = -np.sum(vbParam.rhat * np.log(vbParam.rhat + 1e-200), 0)
+    rhat_merged = vbParam.rhat[:, ka] + vbParam.rhat[:, kb]
+    entropy_merged = -np.sum(rhat_merged * np.log(rhat_merged + 1e-200), 0)
+
+    # constants with one cluster less
+    K = Khat - 1
+    ahat_sum = vbParam.ahat.sum() - vbParam.ahat[ka] - vbParam.ahat[kb] + ahat
+    constants = K * np.log(prior.beta) - prior.beta - np.log(np.arange(K)+1).sum() - specsci.gammaln(ahat_sum) + specsci.gammaln(prior.a * K) - K * specsci.gammaln(prior.a) - prior.nu * nfeature * K * nchannel/2.0 * np.log(prior.V) - K * nchannel * specsci.multigammaln(prior.nu/2.0, nfeature) - nfeature * nchannel * np.log(np.pi) /2.0 * vbParam.rhat.sum()
+
+    return (constants +
+            kvarying_now.sum() - kvarying_now[ka] - kvarying_now[kb] +
+            kvarying_merged +
+            entropy_now.sum() - entropy_now[ka] - entropy_now[kb] +
+            entropy_merged)
+
+
 def check_merge(maskedData, vbParam, suffStat, ka, kb, param, L, ELBO):
     K = vbParam.rhat.shape[1]
     no_kab = np.ones(K).astype(bool)
@@ -982,11 +1073,22 @@ def check_merge(maskedData, vbParam, suffStat, ka, kb, param, L, ELBO):
         return vbParamTemp, suffStatTemp, merged, L, ELBO_amerge
 
 
-def spikesort(score, mask, group, param):
-    
+def spikesort(score, mask, group, param, rhat_init=None, tol=0):
+    """
+        Parameters:
+        -----------
+        rhat_init: np.array (N, K), optional
+            soft assignments to start from (e.g. the parent generation's
+            rhat restricted to these spikes), a single cluster if None
+
+        tol: float
+            stop split/merge iterations early once the relative change of
+            the ELBO between iterations is below tol (0 disables it)
+    """
+
     maskedData = maskData(score, mask, group)
 
-    vbParam, elbo = split_merge(maskedData, param)
+    vbParam, elbo = split_merge(maskedData, param, rhat_init, tol)
 
     # assignmentTemp = np.argmax(vbParam.rhat, axis=1)
 
@@ -1000,15 +1102,19 @@ def spikesort(score, mask, group, param):
     # return assignment, vbParam
     return vbParam#, elbo
 
-def split_merge(maskedData, param):
+def split_merge(maskedData, param, rhat_init=None, tol=0):
 
-    vbParam, suffStat = init_param(maskedData, 1, param)
+    if rhat_init is None:
+        vbParam, suffStat = init_param(maskedData, 1, param)
+    else:
+        vbParam, suffStat = init_param_from_rhat(maskedData, rhat_init, param)
     iter = 0
-    L = np.ones(1)
+    L = np.ones(vbParam.rhat.shape[1])
     n_iter = 5
     extra_iter = 3
-    k_max = 1
+    k_max = vbParam.rhat.shape[1]
     k_abs_max = 15
+    ELBO_prev = None
     
     # Cat: TODO: we limited # iterations; CHECK THIS
     #while iter < n_iter:
@@ -1027,6 +1133,14 @@ def split_merge(maskedData, param):
             n_iter = iter + extra_iter
             k_max = k_now
 
+        # stop once the ELBO stops moving
+        if tol > 0:
+            ELBO = ELBO_Class(maskedData, suffStat, vbParam, param).total
+            if (ELBO_prev is not None and k_now == K_prev and
+                    np.abs(ELBO - ELBO_prev) < tol*np.abs(ELBO_prev)):
+                break
+            ELBO_prev, K_prev = ELBO, k_now
+
         if iter > 100:
             print ("MFM split_merge reached 100 iterations...<<<<<<<<<< ")
 
@@ -12,7 +12,8 @@ class Detect(nn.Module):
         super(Detect, self).__init__()
         
         #os.environ["CUDA_VISIBLE_DEVICES"] = str(CONFIG.resources.gpu_id)
-        torch.cuda.set_device(CONFIG.resources.gpu_id)
+        if torch.cuda.is_available():
+            torch.cuda.set_device(CONFIG.resources.gpu_id)
 
         self.spike_size = spike_size
         self.channel_index = channel_index
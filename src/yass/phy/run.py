@@ -11,6 +11,8 @@ from sklearn.metrics.pairwise import cosine_similarity
 from yass import read_config
 
 from yass.visual.util import binary_reader_waveforms
+from yass.reader import read_waveforms_coalesced, scale_fname
+from yass.util import load_yaml
 
 #from yass.deconvolve.soft_assignment import get_soft_assignments
 
@@ -363,7 +365,7 @@ def get_final_features_amplitudes(units, pc_feature_ind, spike_train,
     
     return (amplitudes, pc_features)
     
-def binary_reader_waveforms_allspikes(filename, n_channels, n_times, spikes, channels=None, data_type='float32'):
+def binary_reader_waveforms_allspikes(filename, n_channels, n_times, spikes, channels=None, data_type=None):
     ''' Reader for loading raw binaries
     
         standardized_filename:  name of file contianing the raw binary
@@ -371,31 +373,44 @@ def binary_reader_waveforms_allspikes(filename, n_channels, n_times, spikes, cha
         n_times:  length of waveform 
         spikes: 1D array containing spike times in sample rate of raw data
         channels: load specific channels only
-        data_type: float32 for standardized data
+        data_type: dtype of the file, by default read from the yaml
+            saved next to it by preprocess (float32 if there is none)
         
         NOTE: this function returns zero arrays if outside the file boundaries
     
     '''
 
+    if data_type is None:
+        fname_params = os.path.splitext(filename)[0] + '.yaml'
+        if os.path.exists(fname_params):
+            data_type = load_yaml(fname_params)['dtype']
+        else:
+            data_type = 'float32'
+
     # ***** LOAD RAW RECORDING *****
-    wfs=[]
-    data_empty = np.zeros((n_times,n_channels),'float32')
-    with open(filename, "rb") as fin:
-        for ctr,s in enumerate(spikes):
-            # index into binary file: time steps * 4  4byte floats * n_channels
-            try:
-                fin.seek(s * 4 * n_channels, os.SEEK_SET)
-                data = np.fromfile(
-                fin,
-                dtype='float32',
-                count=(n_times * n_channels)).reshape(n_times, n_channels)[:,channels]
-                wfs.append(data)
-            except:
-                wfs.append(data_empty[:,channels])
-    
-    wfs=np.array(wfs)
+    recording = np.memmap(filename, dtype=data_type, mode='r')
+    recording = recording.reshape(-1, n_channels)
+
+    if channels is None:
+        channels = np.arange(n_channels)
+    channels = np.asarray(channels)
+
+    # spikes outside the file are left as zeros
+    spikes = np.asarray(spikes).astype('int64')
+    idx_in = np.where(np.logical_and(
+        spikes >= 0, spikes + n_times <= recording.shape[0]))[0]
+
+    wfs = np.zeros((len(spikes), n_times, len(channels)), 'float32')
+    wfs[idx_in] = read_waveforms_coalesced(
+        recording, spikes[idx_in],
+        np.broadcast_to(channels[None], (len(idx_in), len(channels))),
+        n_times)
+
+    # int16 standardized data is scaled per channel
+    fname_scale = scale_fname(filename)
+    if np.dtype(data_type) == np.int16 and os.path.exists(fname_scale):
+        wfs *= np.load(fname_scale)[channels]
 
-    fin.close()
     return wfs
 
 
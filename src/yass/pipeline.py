@@ -347,7 +347,6 @@ def iterative_block(TMP_FOLDER,
                      'residual'),
         standardized_path,
         standardized_dtype,
-        dtype_out='float32',
         run_chunk_sec=run_chunk_sec)
 
     # cluster
@@ -419,7 +418,6 @@ def pre_final_deconv(TMP_FOLDER,
                      'residual'),
         standardized_path,
         standardized_dtype,
-        dtype_out='float32',
         run_chunk_sec=run_chunk_sec)
 
     logger.info('SOFT ASSIGNMENT')
@@ -517,7 +515,6 @@ def get_partially_cleaned_templates(TMP_FOLDER,
                      'partial_residual'),
         standardized_path,
         standardized_dtype,
-        dtype_out='float32',
         run_chunk_sec=run_chunk_sec,
         min_ptp_units=big_unit_ptp,
         min_ptp_vis_chan=vis_chan_ptp)
@@ -637,7 +634,6 @@ def final_deconv(TMP_FOLDER,
                      'residual'),
         standardized_path,
         standardized_dtype,
-        dtype_out='float32',
         update_templates=update_templates,
         run_chunk_sec=run_chunk_sec)
 
@@ -1223,7 +1219,6 @@ def deconv_pass1(output_directory,
         os.path.join(output_directory, 'residual_0'),
         recording_dir,
         recording_dtype,
-        dtype_out='float32',
         run_chunk_sec=run_chunk_sec)
 
     # post deconv split
@@ -1266,7 +1261,6 @@ def deconv_pass1(output_directory,
             os.path.join(output_directory, 'residual_1'),
             recording_dir,
             recording_dtype,
-            dtype_out='float32',
             run_chunk_sec=run_chunk_sec)
 
         # soft assignment 1
@@ -1379,7 +1373,6 @@ def deconv_pass_2(output_directory,
         os.path.join(output_directory, 'residual_1'),
         recording_dir,
         recording_dtype,
-        dtype_out='float32',
         run_chunk_sec=run_chunk_sec)
 
     # runs soft assignment
@@ -97,7 +97,7 @@ def find_high_mad_unit(
                                replace=False)
 
     # get waveforms
-    wf, _ = reader.read_waveforms(spt)
+    wf, _ = reader.read_waveforms_bulk(spt, np.arange(reader.n_channels))
     _, n_times, n_channels = wf.shape
 
     # get mean waveform
@@ -265,7 +265,8 @@ def post_process(output_directory,
         # get data reader
         reader = READER(fname_recording,
                         recording_dtype,
-                        CONFIG) 
+                        CONFIG,
+                        mmap=True)
 
         # save folder
         save_dir = os.path.join(output_directory,
@@ -9,7 +9,7 @@ import yaml
 
 from yass import read_config
 from yass.preprocess.util import *
-from yass.reader import READER
+from yass.reader import READER, save_scale
 
 
 def run(output_directory):
@@ -49,6 +49,10 @@ def run(output_directory):
     * ``standardized.yaml`` - Standarized recordings metadata
     * ``whitening.npy`` - Whitening filter
 
+    If ``CONFIG.preprocess.streaming`` is True (default), every chunk is
+    written directly into ``standardized.bin``, otherwise chunks are saved
+    in ``filtered_files/`` and merged at the end.
+
     Everything is run on CPU.
 
     Examples
@@ -124,13 +128,33 @@ def run(output_directory):
         get_std(small_batch, sampling_rate,
                 fname_mean_sd, CONFIG.preprocess.apply_filter,
                 low_frequency, high_factor, order)
+
     # turn it off
     small_batch = None
 
-    # Make directory to hold filtered batch files:
-    filtered_location = os.path.join(output_directory, "filtered_files")
-    if not os.path.exists(filtered_location):
-        os.makedirs(filtered_location)
+    # int16 output is scaled per channel. READER finds the scale next to
+    # standardized.bin and returns float32
+    scale = get_standardized_scale(
+        reader, fname_mean_sd, CONFIG.preprocess.dtype,
+        CONFIG.preprocess.apply_filter, low_frequency, high_factor,
+        order, sampling_rate)
+    save_scale(standardized_path, scale)
+
+    # in streaming mode, batches are written directly into a preallocated
+    # file, which is renamed to standardized.bin once all batches are done
+    # (so an interrupted run is not mistaken for a finished one)
+    if CONFIG.preprocess.streaming:
+        filtered_location = None
+        fname_out = standardized_path + '.part'
+        make_output_file(fname_out, reader.end - reader.start,
+                         n_channels, CONFIG.preprocess.dtype)
+    else:
+        fname_out = None
+
+        # Make directory to hold filtered batch files:
+        filtered_location = os.path.join(output_directory, "filtered_files")
+        if not os.path.exists(filtered_location):
+            os.makedirs(filtered_location)
 
     # read config params
     multi_processing = CONFIG.resources.multi_processing
@@ -148,8 +172,21 @@ def run(output_directory):
             high_factor,
             order,
             sampling_rate,
+            fname_out,
+            scale,
             processes=n_processors,
             pm_pbar=True)
+    elif CONFIG.preprocess.streaming:
+        # single process: batches are done in order, so the filter state
+        # is carried over and only a buffer after each batch is read
+        filter_standardize_stream(
+            reader, fname_mean_sd,
+            CONFIG.preprocess.dtype,
+            fname_out,
+            low_frequency,
+            order,
+            sampling_rate,
+            scale)
     else:
         for batch_id in range(reader.n_batches):
             filter_standardize_batch(
@@ -161,10 +198,15 @@ def run(output_directory):
                 high_factor,
                 order,
                 sampling_rate,
+                fname_out,
+                scale
                 )
 
-    # Merge the chunk filtered files and delete the individual chunks
-    merge_filtered_files(filtered_location, output_directory)
+    if CONFIG.preprocess.streaming:
+        os.rename(fname_out, standardized_path)
+    else:
+        # Merge the chunk filtered files and delete the individual chunks
+        merge_filtered_files(filtered_location, output_directory)
 
     # save yaml file with params
     path_to_yaml = standardized_path.replace('.bin', '.yaml')
@@ -5,7 +5,100 @@ import logging
 import os
 import numpy as np
 
-from scipy.signal import butter, filtfilt
+from scipy.signal import butter, sosfilt, sosfilt_zi, sosfiltfilt
+
+from yass.reader import get_scale, quantize
+
+
+class ButterworthFilter(object):
+    """Highpass Butterworth filter, designed once as second-order sections
+    and applied to all channels at once
+
+    Parameters
+    ----------
+    low_frequency: int
+        Low pass frequency (Hz)
+    order: int
+        Order of Butterworth filter
+    sampling_frequency: int
+        Sampling frequency (Hz)
+    dtype: str
+        Precision used for filtering
+    """
+
+    def __init__(self, low_frequency, order, sampling_frequency,
+                 dtype='float32'):
+        low = float(low_frequency) / sampling_frequency * 2
+        self.dtype = np.dtype(dtype)
+        self.sos = butter(order, low, btype='high', analog=False,
+                          output='sos').astype(self.dtype)
+
+    def filtfilt(self, ts):
+        """Zero phase filtering of a T or (T, C) array along time
+        """
+        ts = np.asarray(ts, dtype=self.dtype)
+        return sosfiltfilt(self.sos, ts, axis=0)
+
+    def initial_state(self, ts):
+        """Steady state filter conditions for a signal starting at ts[0]
+        """
+        zi = sosfilt_zi(self.sos).astype(self.dtype)
+        if ts.ndim == 1:
+            return zi*ts[0]
+        return zi[:, :, None]*ts[0][None, None]
+
+    def filter_stream(self, ts, n_keep, zi=None):
+        """Zero phase filtering for consecutive chunks
+
+        The forward pass over ts[:n_keep] starts from the state zi left
+        by the previous chunk, so no buffer is needed before the chunk.
+        ts[n_keep:] is only used as lookahead for the backward pass.
+
+        Parameters
+        ----------
+        ts: np.array
+            (T, C) chunk followed by its lookahead
+        n_keep: int
+            Number of samples in the chunk (without lookahead)
+        zi: np.array
+            Forward filter state at the end of the previous chunk, if None
+            the filter starts in steady state
+
+        Returns
+        -------
+        filtered: np.array
+            (n_keep, C) filtered chunk
+        zf: np.array
+            Forward filter state to pass to the next chunk
+        """
+        ts = np.asarray(ts, dtype=self.dtype)
+        if zi is None:
+            zi = self.initial_state(ts)
+
+        forward, zf = sosfilt(self.sos, ts[:n_keep], axis=0, zi=zi)
+        if ts.shape[0] > n_keep:
+            lookahead, _ = sosfilt(self.sos, ts[n_keep:], axis=0, zi=zf)
+            forward = np.concatenate((forward, lookahead), axis=0)
+
+        backward = forward[::-1]
+        backward, _ = sosfilt(self.sos, backward, axis=0,
+                              zi=self.initial_state(backward))
+
+        return backward[::-1][:n_keep], zf
+
+
+# filters already designed in this process
+_FILTERS = {}
+
+
+def get_filter(low_frequency, order, sampling_frequency):
+    """Return a ButterworthFilter, designed once per process
+    """
+    key = (low_frequency, order, sampling_frequency)
+    if key not in _FILTERS:
+        _FILTERS[key] = ButterworthFilter(low_frequency, order,
+                                          sampling_frequency)
+    return _FILTERS[key]
 
 
 def _butterworth(ts, low_frequency, high_factor, order, sampling_frequency):
@@ -14,7 +107,8 @@ def _butterworth(ts, low_frequency, high_factor, order, sampling_frequency):
     Parameters
     ----------
     ts: np.array
-        T  numpy array, where T is the number of time samples
+        T or (T, C) numpy array, where T is the number of time samples
+        and C the number of channels
     low_frequency: int
         Low pass frequency (Hz)
     high_factor: float
@@ -26,28 +120,11 @@ def _butterworth(ts, low_frequency, high_factor, order, sampling_frequency):
 
     Notes
     -----
-    This function can only be applied to a one dimensional array, to apply
-    it to multiple channels use butterworth
-
-    Raises
-    ------
-    NotImplementedError
-        If a multidmensional array is passed
+    All channels are filtered at once in float32 with second-order
+    sections (see ButterworthFilter)
     """
-
-    low = float(low_frequency) / sampling_frequency * 2
-    high = float(high_factor) * 2
-    b, a = butter(order, low, btype='high', analog=False)
-
-    if ts.ndim == 1:
-        return filtfilt(b, a, ts)
-    else:
-        T, C = ts.shape
-        output = np.zeros((T, C), 'float32')
-        for c in range(C):
-            output[:, c] = filtfilt(b, a, ts[:, c])
-
-        return output
+    filt = get_filter(low_frequency, order, sampling_frequency)
+    return filt.filtfilt(ts)
 
 
 def _mean_standard_deviation(rec, centered=False):
@@ -116,7 +193,8 @@ def _standardize(rec, sd=None, centers=None):
 def filter_standardize_batch(batch_id, reader, fname_mean_sd,
                              apply_filter, out_dtype, output_directory,
                              low_frequency=None, high_factor=None,
-                             order=None, sampling_frequency=None):
+                             order=None, sampling_frequency=None,
+                             fname_out=None, scale=None):
     """Butterworth filter for a one dimensional time series
 
     Parameters
@@ -144,29 +222,25 @@ def filter_standardize_batch(batch_id, reader, fname_mean_sd,
     """
     logger = logging.getLogger(__name__)
 
-    
-    # filter
-    if apply_filter:
-        # read a batch
-        ts = reader.read_data_batch(batch_id, add_buffer=True)
-        ts = _butterworth(ts, low_frequency, high_factor,
-                              order, sampling_frequency)
-        ts = ts[reader.buffer:-reader.buffer]
-    else:
-        ts = reader.read_data_batch(batch_id, add_buffer=False)
+    ts = _standardized_batch(batch_id, reader, fname_mean_sd, apply_filter,
+                             low_frequency, high_factor, order,
+                             sampling_frequency)
+
+    # int16 output is divided by the per channel scale
+    ts = quantize(ts, out_dtype, scale)
+
+    # if an output file is given, write the batch in place
+    if fname_out is not None:
+        write_batch(fname_out, ts,
+                    reader.idx_list[batch_id][0] - reader.start)
+        return
 
-    # standardize
-    temp = np.load(fname_mean_sd)
-    sd = temp['sd']
-    centers = temp['centers']
-    ts = _standardize(ts, sd, centers)
-    
     # save
     fname = os.path.join(
         output_directory,
         "standardized_{}.npy".format(
             str(batch_id).zfill(6)))
-    np.save(fname, ts.astype(out_dtype))
+    np.save(fname, ts)
 
     #fname = os.path.join(
     #    output_directory,
@@ -224,6 +298,50 @@ def get_std(ts,
              sd=sd)
 
 
+def _standardized_batch(batch_id, reader, fname_mean_sd, apply_filter,
+                        low_frequency=None, high_factor=None, order=None,
+                        sampling_frequency=None):
+    """Read, filter (if apply_filter) and standardize one batch
+    """
+    # filter
+    if apply_filter:
+        # read a batch
+        ts = reader.read_data_batch(batch_id, add_buffer=True)
+        ts = _butterworth(ts, low_frequency, high_factor,
+                              order, sampling_frequency)
+        ts = ts[reader.buffer:-reader.buffer]
+    else:
+        ts = reader.read_data_batch(batch_id, add_buffer=False)
+
+    # standardize
+    temp = np.load(fname_mean_sd)
+    sd = temp['sd']
+    centers = temp['centers']
+    return _standardize(ts, sd, centers)
+
+
+def get_standardized_scale(reader, fname_mean_sd, out_dtype, apply_filter,
+                           low_frequency=None, high_factor=None,
+                           order=None, sampling_frequency=None,
+                           n_batches=10):
+    """Per channel scale to store standardized data as out_dtype (None
+    unless out_dtype is int16). Like yass.reader.get_reader_scale, it is
+    estimated from up to n_batches batches spread evenly over the recording,
+    after filtering and standardizing them
+    """
+    if np.dtype(out_dtype) != np.int16:
+        return None
+
+    batch_ids = np.unique(np.linspace(
+        0, reader.n_batches-1, n_batches).astype('int64'))
+    max_abs = np.max([np.abs(_standardized_batch(
+        batch_id, reader, fname_mean_sd, apply_filter, low_frequency,
+        high_factor, order, sampling_frequency)).max(0)
+        for batch_id in batch_ids], 0)
+
+    return get_scale(max_abs[None], out_dtype)
+
+
 def merge_filtered_files(filtered_location, output_directory):
 
     logger = logging.getLogger(__name__)
@@ -239,3 +357,52 @@ def merge_filtered_files(filtered_location, output_directory):
         res = np.load(os.path.join(filtered_location, fname))
         res.tofile(f)
         os.remove(os.path.join(filtered_location, fname))
+
+
+def filter_standardize_stream(reader, fname_mean_sd, out_dtype, fname_out,
+                              low_frequency, order, sampling_frequency,
+                              scale=None):
+    """Filter and standardize all batches in order, carrying the forward
+    filter state from one batch to the next so that only a buffer after
+    each batch is read. Batches are written into fname_out, which must be
+    preallocated with make_output_file
+    """
+    filt = get_filter(low_frequency, order, sampling_frequency)
+
+    temp = np.load(fname_mean_sd)
+    sd = temp['sd']
+    centers = temp['centers']
+
+    zi = None
+    for batch_id in range(reader.n_batches):
+        data_start, data_end = reader.idx_list[batch_id]
+        lookahead_end = min(data_end + reader.buffer, reader.end)
+
+        ts = reader.read_data(data_start, lookahead_end)
+        ts, zi = filt.filter_stream(ts, data_end - data_start, zi)
+        ts = _standardize(ts, sd, centers)
+
+        write_batch(fname_out, quantize(ts, out_dtype, scale),
+                    data_start - reader.start)
+
+
+def make_output_file(fname, n_observations, n_channels, dtype):
+    """Preallocate a (n_observations, n_channels) binary file so that
+    batches can be written to it in any order with write_batch
+    """
+    size = int(n_observations)*n_channels*np.dtype(dtype).itemsize
+    with open(fname, 'wb') as f:
+        f.truncate(size)
+
+
+def write_batch(fname, ts, data_start):
+    """Write a (T, C) batch into a preallocated binary file, starting at
+    row data_start
+    """
+    T, C = ts.shape
+    offset = int(data_start)*C*ts.dtype.itemsize
+    out = np.memmap(fname, dtype=ts.dtype, mode='r+',
+                    offset=offset, shape=(T, C))
+    out[:] = ts
+    out.flush()
+    del out
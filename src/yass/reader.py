@@ -1,10 +1,82 @@
 import os
+import logging
 import numpy as np
 
+
+logger = logging.getLogger(__name__)
+
+def scale_fname(bin_file):
+    '''
+    file holding the per channel scales of an int16 quantized recording
+    '''
+    return os.path.splitext(bin_file)[0] + '_scale.npy'
+
+
+def get_scale(data, dtype, headroom=4):
+    '''
+    per channel scale to store data as dtype. for int16, values up to
+    headroom times the largest absolute value (per channel) in data fit,
+    larger values are clipped. other dtypes are stored as they are and
+    have no scale (None)
+    '''
+    if np.dtype(dtype) != np.int16:
+        return None
+
+    max_abs = np.abs(data).max(0).astype('float32')*headroom
+    max_abs[max_abs == 0] = 1
+
+    return max_abs/np.iinfo('int16').max
+
+
+def get_reader_scale(reader, dtype, n_batches=10, headroom=4):
+    '''
+    per channel scale (see get_scale) from the largest absolute values of
+    up to n_batches batches spread evenly over the recording read by reader
+    '''
+    if np.dtype(dtype) != np.int16:
+        return None
+
+    batch_ids = np.unique(np.linspace(
+        0, reader.n_batches-1, n_batches).astype('int64'))
+    max_abs = np.max([np.abs(reader.read_data_batch(batch_id)).max(0)
+                      for batch_id in batch_ids], 0)
+
+    return get_scale(max_abs[None], dtype, headroom)
+
+
+def quantize(data, dtype, scale=None):
+    '''
+    convert (T, C) data to the on disk dtype. if scale is given, data
+    is divided by it, rounded and clipped to the range of dtype
+    '''
+    if scale is None:
+        return data.astype(dtype)
+
+    info = np.iinfo(dtype)
+    data = np.rint(data/scale)
+    n_clipped = np.count_nonzero((data < info.min) | (data > info.max))
+    if n_clipped > 0:
+        logger.warning('%d of %d samples clipped when converting to %s',
+                       n_clipped, data.size, np.dtype(dtype).name)
+    np.clip(data, info.min, info.max, out=data)
+
+    return data.astype(dtype)
+
+
+def save_scale(bin_file, scale):
+    '''
+    save the scale of a quantized recording next to it, READER finds it
+    there and dequantizes on read. nothing is saved if scale is None
+    '''
+    if scale is not None:
+        np.save(scale_fname(bin_file), np.asarray(scale, 'float32'))
+
+
 class READER(object):
 
     def __init__(self, bin_file, dtype, CONFIG,
-                 n_sec_chunk=None, buffer=None, chunk_sec=None, offset=0):
+                 n_sec_chunk=None, buffer=None, chunk_sec=None, offset=0,
+                 mmap=False):
 
         # frequently used parameters
         self.n_channels = CONFIG.recordings.n_channels
@@ -62,9 +134,75 @@ class READER(object):
             #print ("   # of batches: ", self.n_batches)
         # spike size
         self.spike_size = CONFIG.spike_size
-       
+
+        # if mmap is True, all reads go through a single read-only
+        # np.memmap of the whole recording. it is opened lazily (on first
+        # read) so that READER objects can still be sent to worker
+        # processes without copying the recording
+        self.mmap = mmap
+        self._memmap = None
+
+        # int16 recordings written by yass (standardized, residual) are
+        # quantized with a per channel scale saved next to them, reads
+        # then return float32 values. float16 is read as float32 too
+        fname_scale = scale_fname(self.bin_file)
+        if (np.issubdtype(self.dtype, np.integer) and
+                os.path.exists(fname_scale)):
+            self.scale = np.load(fname_scale).astype('float32')
+        else:
+            self.scale = None
+
+    def __getstate__(self):
+        # never pickle the memmap, each process opens its own
+        state = self.__dict__.copy()
+        state['_memmap'] = None
+        return state
+
+    def get_memmap(self):
+        '''
+        return the recording as a read-only (rec_len, n_channels) memmap
+        '''
+        if self._memmap is None:
+            self._memmap = np.memmap(self.bin_file,
+                                     dtype=self.dtype,
+                                     mode='r',
+                                     shape=(self.rec_len, self.n_channels))
+        return self._memmap
+
+    def close(self):
+        '''
+        release the memmap (if any). it is re-opened on the next read
+        '''
+        self._memmap = None
+
+    def dequantize(self, data, channels=None):
+        '''
+        convert data read from the file to the values it stores
+        '''
+        if self.scale is not None:
+            if channels is None:
+                return data*self.scale
+            return data*self.scale[channels]
+
+        if self.dtype == np.float16:
+            return data.astype('float32')
+
+        return data
 
     def read_data(self, data_start, data_end, channels=None):
+        '''
+        read data between data_start and data_end (in samples, relative
+        to the original recording). in mmap mode, the returned array is
+        a read-only view on the file unless channels is given or the
+        file is quantized
+        '''
+        if self.mmap:
+            data = self.get_memmap()[
+                int(data_start - self.offset):int(data_end - self.offset)]
+            if channels is not None:
+                data = data[:, channels]
+            return self.dequantize(data, channels)
+
         with open(self.bin_file, "rb") as fin:
             # Seek position and read N bytes
             #fin.seek((data_start-self.offset)*self.dtype.itemsize*self.n_channels, os.SEEK_SET)
@@ -78,7 +216,7 @@ class READER(object):
         if channels is not None:
             data = data[:, channels]
 
-        return data
+        return self.dequantize(data, channels)
 
     def read_data_batch(self, batch_id, add_buffer=False, channels=None):
 
@@ -111,10 +249,10 @@ class READER(object):
         if add_buffer:
             left_buffer = np.zeros(
                 (left_buffer_size, self.n_channels),
-                dtype=self.dtype)
+                dtype=data.dtype)
             right_buffer = np.zeros(
                 (right_buffer_size, self.n_channels),
-                dtype=self.dtype)
+                dtype=data.dtype)
             if channels is not None:
                 left_buffer = left_buffer[:, channels]
                 right_buffer = right_buffer[:, channels]
@@ -156,7 +294,7 @@ class READER(object):
             T_extra = n_mini_batches*T_mini - T
 
             pad_zeros = np.zeros((T_extra, C),
-                dtype=self.dtype)
+                dtype=data.dtype)
 
             data = np.concatenate((data, pad_zeros), axis=0)
         data_loc = np.zeros((n_mini_batches, 2), 'int32')
@@ -188,29 +326,119 @@ class READER(object):
             channels = np.arange(self.n_channels)
 
         # ***** LOAD RAW RECORDING *****
-        wfs = np.zeros((len(spike_times), n_times, len(channels)),
+        # spike_times are the centers of waveforms
+        spike_times_shifted = np.asarray(
+            spike_times).astype('int64') - n_times//2
+
+        # spikes whose waveform is not fully inside the recording
+        # are skipped
+        out_of_bounds = np.logical_or(
+            spike_times_shifted < 0,
+            spike_times_shifted + n_times > self.rec_len)
+        skipped_idx = np.where(out_of_bounds)[0]
+        spike_times_shifted = spike_times_shifted[~out_of_bounds]
+
+        wfs = np.zeros((len(spike_times_shifted), n_times, len(channels)),
                        'float32')
 
-        skipped_idx = []
-        total_size = n_times*self.n_channels
-        # spike_times are the centers of waveforms
-        spike_times_shifted = spike_times - n_times//2
-        offsets = spike_times_shifted.astype('int64')*self.dtype.itemsize*self.n_channels
-        with open(self.bin_file, "rb") as fin:
-            for ctr, spike in enumerate(spike_times_shifted):
-                try:
+        if self.mmap:
+            self._gather_waveforms(spike_times_shifted, n_times,
+                                   channels, wfs)
+        else:
+            total_size = n_times*self.n_channels
+            offsets = spike_times_shifted*self.dtype.itemsize*self.n_channels
+            with open(self.bin_file, "rb") as fin:
+                for ctr in range(len(spike_times_shifted)):
                     fin.seek(offsets[ctr], os.SEEK_SET)
                     wf = np.fromfile(fin,
                                      dtype=self.dtype,
                                      count=total_size)
                     wfs[ctr] = wf.reshape(
-                        n_times, self.n_channels)[:,channels]
-                except:
-                    skipped_idx.append(ctr)
-        wfs=np.delete(wfs, skipped_idx, axis=0)
-        fin.close()
+                        n_times, self.n_channels)[:, channels]
 
-        return wfs, skipped_idx
+        if self.scale is not None:
+            wfs *= self.scale[channels]
+
+        return wfs, skipped_idx.tolist()
+
+    def _gather_waveforms(self, spike_times_shifted, n_times, channels, wfs,
+                          block_size=10000):
+        '''
+        fill wfs with snippets starting at spike_times_shifted using
+        fancy indexing on the memmap. spikes are processed in blocks
+        to bound the size of the index arrays
+        '''
+        recording = self.get_memmap()
+        channels = np.asarray(channels)
+        t_range = np.arange(n_times)
+
+        for j in range(0, len(spike_times_shifted), block_size):
+            t_idx = (spike_times_shifted[j:j+block_size, None] +
+                     t_range[None])
+            wfs[j:j+block_size] = recording[
+                t_idx[:, :, None], channels[None, None]]
+
+
+    def read_waveforms_bulk(self, spike_times, channels_per_spike,
+                            n_times=None, max_gap=None, max_run_len=10000):
+        '''
+        read waveforms for many spikes at once. each spike reads its own
+        subset of channels. spikes are sorted by time and windows that
+        overlap or are less than max_gap samples apart are merged into
+        runs, so each run is a single sequential read.
+
+        spike_times: (n_spikes,) waveform centers
+        channels_per_spike: (n_spikes, n_neigh) channels to read for each
+            spike or (n_neigh,) to use the same channels for all spikes.
+            entries equal to n_channels (as in CONFIG.channel_index)
+            are filled with zeros
+        n_times: waveform length, defaults to spike_size
+        max_gap: windows less than max_gap samples apart are merged,
+            defaults to n_times
+        max_run_len: runs are split on a grid of max_run_len samples,
+            so they span less than max_run_len + n_times samples
+
+        returns wfs (n_spikes - n_skipped, n_times, n_neigh) in the same
+        order as spike_times and the indexes of skipped spikes
+        '''
+
+        if n_times is None:
+            n_times = self.spike_size
+
+        # n_times needs to be odd
+        if n_times % 2 == 0:
+            n_times += 1
+
+        spike_times_shifted = np.asarray(
+            spike_times).astype('int64') - n_times//2
+
+        channels_per_spike = np.asarray(channels_per_spike)
+        if channels_per_spike.ndim == 1:
+            channels_per_spike = np.broadcast_to(
+                channels_per_spike[None],
+                (len(spike_times_shifted), len(channels_per_spike)))
+
+        # spikes whose waveform is not fully inside the recording
+        # are skipped
+        out_of_bounds = np.logical_or(
+            spike_times_shifted < 0,
+            spike_times_shifted + n_times > self.rec_len)
+        skipped_idx = np.where(out_of_bounds)[0]
+
+        wfs = read_waveforms_coalesced(
+            self.get_memmap(),
+            spike_times_shifted[~out_of_bounds],
+            channels_per_spike[~out_of_bounds],
+            n_times,
+            max_gap,
+            max_run_len)
+
+        # padded channels stay zero
+        if self.scale is not None:
+            wfs *= np.append(self.scale, 0)[
+                channels_per_spike[~out_of_bounds]][:, None]
+
+        return wfs, skipped_idx.tolist()
 
     def read_clean_waveforms(self, spike_times, unit_ids, templates,
                              n_times=None, channels=None):
@@ -241,3 +469,60 @@ class READER(object):
             wfs += templates[:,:,channels][unit_ids]
         
         return wfs, skipped_idx
+
+
+def read_waveforms_coalesced(recording, spike_starts, channels_per_spike,
+                             n_times, max_gap=None, max_run_len=10000):
+    '''
+    gather (n_spikes, n_times, n_neigh) snippets from a
+    (n_observations, n_channels) array (usually a np.memmap). all
+    windows must be inside the recording.
+
+    windows are visited in time order and grouped into runs: a new run
+    starts when the gap to the previous window is larger than max_gap
+    or when the window start is in a different block of max_run_len
+    samples (a fixed grid over the recording, so a run spans less than
+    max_run_len + n_times samples). each run is read once and all of its
+    snippets are taken from that block.
+    channel indexes equal to n_channels give zeros.
+    '''
+
+    n_spikes = len(spike_starts)
+    n_channels = recording.shape[1]
+    wfs = np.zeros((n_spikes, n_times, channels_per_spike.shape[1]),
+                   'float32')
+    if n_spikes == 0:
+        return wfs
+
+    if max_gap is None:
+        max_gap = n_times
+
+    # visit windows in time order
+    order = np.argsort(spike_starts, kind='mergesort')
+    starts = spike_starts[order]
+
+    # find where new runs begin
+    gaps = starts[1:] - (starts[:-1] + n_times)
+    run_id = starts // max_run_len
+    new_run = np.logical_or(gaps > max_gap, run_id[1:] != run_id[:-1])
+    run_bounds = np.hstack((0, np.where(new_run)[0] + 1, n_spikes))
+
+    # padded channels (index n_channels) are read as the last channel and
+    # zeroed out after the gather
+    pad_mask = channels_per_spike >= n_channels
+    channels_clipped = np.minimum(channels_per_spike, n_channels - 1)
+
+    t_range = np.arange(n_times)
+    for j in range(len(run_bounds) - 1):
+        idx = order[run_bounds[j]:run_bounds[j+1]]
+        run_start = starts[run_bounds[j]]
+        run_end = starts[run_bounds[j+1] - 1] + n_times
+
+        block = np.asarray(recording[run_start:run_end])
+        t_idx = spike_starts[idx, None] - run_start + t_range[None]
+        wfs[idx] = block[t_idx[:, :, None], channels_clipped[idx][:, None]]
+
+    if pad_mask.any():
+        wfs.transpose(0, 2, 1)[pad_mask] = 0
+
+    return wfs
@@ -3,6 +3,9 @@ import logging
 import numpy as np
 import parmap
 
+from yass.reader import get_reader_scale, quantize, save_scale
+from yass.preprocess.util import make_output_file, write_batch
+
 class RESIDUAL(object):
     
     def __init__(self, 
@@ -32,6 +35,10 @@ class RESIDUAL(object):
                          multi_processing=False,
                          n_processors=1):
         '''
+        Batches are written directly into a preallocated file
+        (fname_out + '.part'), save_residual renames it once all batches
+        are done. An empty file in save_dir marks every finished batch so
+        that an interrupted run only redoes the missing ones
         '''
         if not os.path.exists(save_dir):
             os.makedirs(save_dir)
@@ -42,7 +49,45 @@ class RESIDUAL(object):
             batch_ids.append(batch_id)
             fnames_seg.append(
                 os.path.join(save_dir,
-                             'residual_seg{}.npy'.format(batch_id)))
+                             'residual_seg{}.done'.format(batch_id)))
+
+        self.fname_part = self.fname_out + '.part'
+        if not os.path.exists(self.fname_part):
+            for fname in fnames_seg:
+                if os.path.exists(fname):
+                    os.remove(fname)
+            make_output_file(self.fname_part,
+                             self.reader.end - self.reader.start,
+                             self.reader.n_channels,
+                             self.dtype_out)
+
+        # int16 output is scaled per channel, the scale only depends on
+        # the input (batches spread over the recording) so a resumed run
+        # gets the same one
+        self.scale = get_reader_scale(self.reader, self.dtype_out)
+
+        # spike train sorted by time, spikes of each batch are then a
+        # contiguous range found once here instead of in every batch
+        spike_train = np.load(self.fname_spike_train)
+        self.fname_spike_train_sorted = None
+        if np.any(np.diff(spike_train[:, 0]) < 0):
+            spike_train = spike_train[np.argsort(spike_train[:, 0],
+                                                 kind='mergesort')]
+            self.fname_spike_train_sorted = os.path.join(
+                save_dir, 'spike_train_sorted.npy')
+            np.save(self.fname_spike_train_sorted, spike_train)
+            self.fname_spike_train = self.fname_spike_train_sorted
+
+        # spikes are aligned at time 0 and need a buffer of n_time
+        n_time = np.load(self.fname_templates, mmap_mode='r').shape[1]
+        self.reader.buffer = n_time
+        batch_start = self.reader.idx_list[:, 0] - n_time
+        batch_end = self.reader.idx_list[:, 1]
+        spike_times = spike_train[:, 0] - n_time//2
+        self.batch_spike_range = np.stack(
+            (np.searchsorted(spike_times, batch_start),
+             np.searchsorted(spike_times, batch_end)), 1)
+        del spike_train, spike_times
 
         #self.logger.info("computing residuals")
         if multi_processing:
@@ -54,9 +99,7 @@ class RESIDUAL(object):
                          pm_pbar=True)
 
         else:
-            for ctr in range(len(batch_ids)):
-                self.subtract_parallel(
-                    [batch_ids[ctr]], [fnames_seg[ctr]])
+            self.subtract_parallel(batch_ids, fnames_seg)
 
         self.fnames_seg = fnames_seg
 
@@ -64,72 +107,102 @@ class RESIDUAL(object):
     def subtract_parallel(self, batch_ids, fnames_out):
         '''
         '''
-                
-        templates = None
-        spike_train = None
+
+        # templates and the (sorted) spike train are memory mapped, workers
+        # share them and only read the spikes of their batches
+        templates = np.load(self.fname_templates, mmap_mode='r')
+        spike_train = np.load(self.fname_spike_train, mmap_mode='r')
+        n_time = templates.shape[1]
+
+        # channels where each template is non zero
+        vis_chans = None
 
         for batch_id, fname_out in zip(batch_ids, fnames_out):
             if os.path.exists(fname_out):
                 continue
-            
-            # load upsampled templates only once per core:
-            if templates is None or spike_train is None:
-                #self.logger.info("loading upsampled templates")
-                templates = np.load(self.fname_templates)
-                spike_train = np.load(self.fname_spike_train)
-
-                # do not read spike train again here
-                #self.spike_train = up_data['spike_train_up']
-                n_time = templates.shape[1]
-                time_idx = np.arange(0, n_time)
-                self.reader.buffer = n_time
-                
-                # shift spike time so that it is aligned at
-                # time 0
-                spike_train[:, 0] -= n_time//2
+
+            if vis_chans is None:
+                vis_chans = [np.where(np.any(templates[k] != 0, 0))[0]
+                             for k in range(templates.shape[0])]
 
             # get relevantspike times
-            start, end = self.reader.idx_list[batch_id]
-            start -= self.reader.buffer 
-            idx_in_chunk = np.where(
-                np.logical_and(spike_train[:,0]>=start,
-                               spike_train[:,0]<end))[0]
-            spikes_in_chunk = spike_train[idx_in_chunk]
-            # offset
-            spikes_in_chunk[:,0] -=  start
-
-            #print ("SPIKE train: ", self.spike_train.shape)
-            #print ("templates: ", self.templates.shape)
+            start = self.reader.idx_list[batch_id, 0] - self.reader.buffer
+            first, last = self.batch_spike_range[batch_id]
+            spikes_in_chunk = np.array(spike_train[first:last])
+            # shift spike time so that it is aligned at time 0, and offset
+            spikes_in_chunk[:, 0] -= n_time//2 + start
+
             # note only derasterize up to last bit, don't remove spikes from 
             # buffer_size end because those will be looked at by next chunk
             # load indexes and then index into original data
-            #print ("batch_id: ", batch_id)
             data = self.reader.read_data_batch(batch_id, add_buffer=True)
-            #print ("data: ", data.shape)
 
-            #print ("local spike train: ", local_spike_train.shape)
-            #print ("self.n_time: ", self.n_time)
-            #print ("local spiketrain: ", local_spike_train)
-            for j in range(spikes_in_chunk.shape[0]):
-                tt, ii = spikes_in_chunk[j]
-                data[time_idx + tt, :] -= templates[ii]
+            subtract_templates(data, spikes_in_chunk, templates, vis_chans)
 
             # remove buffer
             data = data[self.reader.buffer:-self.reader.buffer]
 
-            # save
-            np.save(fname_out, data)
+            # write in place and mark the batch as done
+            write_batch(self.fname_part,
+                        quantize(data, self.dtype_out, self.scale),
+                        self.reader.idx_list[batch_id, 0] - self.reader.start)
+            open(fname_out, 'w').close()
 
 
     def save_residual(self):
-    
-        f = open(self.fname_out,'wb')
-        for fname in self.fnames_seg:
 
-            res = np.load(fname).astype(self.dtype_out)
-            f.write(res)
-        f.close()
-        
-        # delete residual chunks after successful merging/save
+        # the scale goes first, residual.bin is complete once it exists
+        save_scale(self.fname_out, self.scale)
+        os.rename(self.fname_part, self.fname_out)
+
+        # delete batch markers and the sorted copy of the spike train
         for fname in self.fnames_seg:
             os.remove(fname)
+        if self.fname_spike_train_sorted is not None:
+            os.remove(self.fname_spike_train_sorted)
+
+
+def subtract_templates(data, spike_train, templates, vis_chans,
+                       block_size=2**22):
+    """Subtract templates[unit] from data[time:time+n_time] for every
+    (time, unit) in spike_train, in place
+
+    Spikes of each unit are subtracted at once with a scatter add on the
+    visible channels of the unit only, in blocks of about block_size values
+
+    Parameters
+    ----------
+    data: numpy.ndarray (n_time_data, n_channels)
+    spike_train: numpy.ndarray (n_spikes, 2)
+        Start time (in data) and unit of each spike
+    templates: numpy.ndarray (n_units, n_time, n_channels)
+    vis_chans: list
+        Channels where each template is non zero
+    """
+    n_time = templates.shape[1]
+    n_channels = data.shape[1]
+    data_flat = np.ascontiguousarray(data).reshape(-1)
+
+    # spikes grouped by unit
+    order = np.argsort(spike_train[:, 1], kind='mergesort')
+    units, first = np.unique(spike_train[order, 1], return_index=True)
+    bounds = np.append(first, len(order))
+
+    for j, unit in enumerate(units):
+        chans = vis_chans[unit]
+        if len(chans) == 0:
+            continue
+        times = spike_train[order[bounds[j]:bounds[j+1]], 0].astype('int64')
+
+        # flat index of (time, channel) for a spike at time 0
+        offsets = (np.arange(n_time)[:, None]*n_channels + chans).ravel()
+        values = templates[unit][:, chans].ravel()
+
+        n_spikes = max(1, block_size//len(offsets))
+        for k in range(0, len(times), n_spikes):
+            idx = times[k:k+n_spikes, None]*n_channels + offsets
+            np.subtract.at(data_flat, idx.ravel(),
+                           np.tile(values, len(idx)))
+
+    if not np.shares_memory(data_flat, data):
+        data[:] = data_flat.reshape(data.shape)
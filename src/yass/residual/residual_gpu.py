@@ -5,7 +5,14 @@ import time
 from tqdm import tqdm
 import torch
 import sys
-import cudaSpline as deconv
+# cuda package for spline subtraction, not available on cpu only nodes
+# (residual.RESIDUAL is used there)
+try:
+    import cudaSpline as deconv
+except ImportError:
+    deconv = None
+
+from yass.reader import get_reader_scale, quantize, save_scale
 import matplotlib.pyplot as plt
 from scipy.interpolate import splrep, splev, splder, sproot
 import parmap
@@ -242,8 +249,11 @@ class RESIDUAL_GPU2(object):
             n_chunks_update = int(self.template_update_time/self.reader.n_sec_chunk)
             update_chunk = np.arange(0, self.reader.n_batches, n_chunks_update)
 
-        # open residual file for appending on the fly
-        f = open(self.fname_residual, 'wb')
+        # open residual file for appending on the fly, it is renamed once
+        # complete. in int16 the scale is estimated on batches spread
+        # over the recording
+        scale = get_reader_scale(self.reader, self.dtype_out)
+        f = open(self.fname_residual + '.part', 'wb')
         for batch_id, chunk in tqdm(enumerate(self.reader.idx_list)):
 
             # updated templates options
@@ -349,12 +359,14 @@ class RESIDUAL_GPU2(object):
                 print ("subtraction time: ", time.time()-t5)
 
             temp_out = objective[:,self.reader.buffer:-self.reader.buffer].cpu().data.numpy().copy(order='F')
-            f.write(temp_out.T)
+            f.write(quantize(temp_out.T, self.dtype_out, scale))
             
             batch_id+=1
             #if batch_id > 3:
             #    break
         f.close()
+        save_scale(self.fname_residual, scale)
+        os.rename(self.fname_residual + '.part', self.fname_residual)
 
         print ("Total residual time: ", time.time()-t0)
 
@@ -962,8 +974,11 @@ class RESIDUAL_GPU3(object):
         residual_array = []
         self.reader.buffer = 200
 
-        # open residual file for appending on the fly
-        f = open(self.fname_residual,'wb')
+        # open residual file for appending on the fly, it is renamed once
+        # complete. in int16 the scale is estimated on batches spread
+        # over the recording
+        scale = get_reader_scale(self.reader, self.dtype_out)
+        f = open(self.fname_residual + '.part', 'wb')
 
         #self.chunk_id =0
         batch_ctr = 0
@@ -1108,12 +1123,14 @@ class RESIDUAL_GPU3(object):
                 print ("subtraction time: ", time.time()-t5)
 
             temp_out = objective[:,self.reader.buffer:-self.reader.buffer].cpu().data.numpy().copy(order='F')
-            f.write(temp_out.T)
+            f.write(quantize(temp_out.T, self.dtype_out, scale))
             
             batch_id+=1
             #if batch_id > 3:
             #    break
         f.close()
+        save_scale(self.fname_residual, scale)
+        os.rename(self.fname_residual + '.part', self.fname_residual)
 
         print ("Total residual time: ", time.time()-t0)
             
@@ -16,7 +16,7 @@ def run(fname_shifts,
         output_directory,
         recordings_filename,
         recording_dtype,
-        dtype_out='float32',
+        dtype_out=None,
         update_templates=False,
         run_chunk_sec='full',
         min_ptp_units=0,
@@ -46,6 +46,11 @@ def run(fname_shifts,
         output_directory) used to draw the waveforms from, defaults to
         standardized.bin
 
+    dtype_out: str, optional
+        dtype of residual.bin, defaults to
+        CONFIG.deconvolution.residual_dtype. float16 or int16 (scaled per
+        channel) halve the file size, READER reads them as float32
+
     Returns
     -------
     spike_train: numpy.ndarray (n_clear_spikes, 2)
@@ -62,6 +67,9 @@ def run(fname_shifts,
 
     CONFIG = read_config()
 
+    if dtype_out is None:
+        dtype_out = CONFIG.deconvolution.residual_dtype
+
     # output folder
     if not os.path.exists(output_directory):
         os.makedirs(output_directory)
@@ -216,7 +216,8 @@ def update_templates(
 
     reader = READER(recordings_filename,
                     recording_dtype,
-                    CONFIG)
+                    CONFIG,
+                    mmap=True)
 
     # max channel for each unit
     max_channels = np.load(fname_templates).ptp(1).argmax(1)
@@ -426,7 +427,8 @@ def compute_a_template(spike_times, reader, spike_size):
                                        replace=False)
 
     # get waveforms
-    wf = reader.read_waveforms(spike_times, spike_size)[0]
+    wf = reader.read_waveforms_bulk(
+        spike_times, np.arange(reader.n_channels), spike_size)[0]
 
     if wf.shape[0] == 0:
         return np.zeros((spike_size, reader.n_channels), 'float32')
@@ -474,7 +476,8 @@ def run_cleaned_template_computation(
 
     reader_residual = READER(fname_residual_recording,
                              dtype_residual_recording,
-                             CONFIG)
+                             CONFIG,
+                             mmap=True)
 
     # run computing function
     if CONFIG.resources.multi_processing:
@@ -5,21 +5,52 @@ import os
 import logging
 
 import numpy as np
-from scipy.signal import argrelmin
+
 
 def voltage_threshold(recording, threshold, order=5):
+    """Find negative peaks crossing a threshold on all channels at once
+
+    A sample is a peak if it is smaller than -threshold and strictly
+    smaller than the order samples before and after it on the same channel
+    (same definition as scipy.signal.argrelmin with mode='clip')
+
+    Parameters
+    ----------
+    recording: numpy.ndarray (T, C)
+        Recording
+    threshold: float
+        Detection threshold
+    order: int
+        Number of samples on each side to compare to
+
+    Returns
+    -------
+    spike_index: numpy.ndarray (n_spikes, 2)
+        Spike times and channels, sorted by time
+    energy: numpy.ndarray (n_spikes,)
+        Absolute value of the recording at each peak
 
+    Notes
+    -----
+    Only samples crossing the threshold (a small fraction of the
+    recording) are compared to their neighbors, so the cost is one pass
+    over the recording plus 2*order comparisons per crossing
+    """
     T, C = recording.shape
-    spike_index = np.zeros((0, 2), 'int32')
-    energy = np.zeros(0, 'float32')
-    for c in range(C):
-        single_chan_rec = recording[:, c]
-        index = argrelmin(single_chan_rec, order=order)[0]
-        index = index[single_chan_rec[index] < -threshold]
-        spike_index_temp = np.vstack((index,
-                                      np.ones(len(index), 'int32')*c)).T
-        spike_index = np.concatenate((spike_index, spike_index_temp), axis=0)
-        energy_ = np.abs(single_chan_rec[index])
-        energy = np.hstack((energy, energy_))
-
-    return spike_index, energy
\ No newline at end of file
+    recording = np.ascontiguousarray(recording)
+
+    # samples crossing the threshold, in time order
+    index = np.flatnonzero(recording.ravel() < -threshold)
+    times, channels = np.divmod(index, C)
+    values = recording[times, channels]
+
+    # keep the ones that are strict local minima
+    is_peak = np.ones(len(index), 'bool')
+    for k in range(1, order + 1):
+        is_peak &= values < recording[np.maximum(times - k, 0), channels]
+        is_peak &= values < recording[np.minimum(times + k, T - 1), channels]
+
+    spike_index = np.vstack((times[is_peak], channels[is_peak])).T
+    energy = np.abs(values[is_peak])
+
+    return spike_index, energy
@@ -26,8 +26,16 @@ except ImportError:
     # py2
     from pipes import quote
 
+try:
+    # py3
+    import queue
+except ImportError:
+    # py2
+    import Queue as queue
+
 import subprocess
 import pickle
+import threading
 import datetime
 import os
 import functools
@@ -310,6 +318,152 @@ def human_readable_time(seconds):
                      if getattr(delta, k)))
 
 
+class _PrefetchError(object):
+    def __init__(self, exception):
+        self.exception = exception
+
+
+def prefetch(iterable, size=1):
+    """Iterate over iterable in a background thread
+
+    Up to size items are produced ahead of the consumer, so slow producers
+    (e.g. disk reads) overlap with the work done on each item. Exceptions
+    raised while producing items are re-raised in the consumer. If the
+    consumer stops early (break, exception or close), the producer stops
+    after the item it is producing
+
+    Parameters
+    ----------
+    iterable: iterable
+        Items to produce
+    size: int
+        Maximum number of items waiting to be consumed
+    """
+    items = queue.Queue(maxsize=size)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        # returns False once the consumer is gone
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except Exception as e:
+            put(_PrefetchError(e))
+            return
+        put(done)
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            item = items.get()
+            if item is done:
+                break
+            if isinstance(item, _PrefetchError):
+                raise item.exception
+            yield item
+    finally:
+        stop.set()
+
+
+class BackgroundWriter(object):
+    """Call a function on items in a background thread
+
+    Counterpart of prefetch for the output side: put returns as soon as the
+    item is queued (blocks if size items are already waiting), so slow
+    consumers (e.g. disk writes) overlap with the work producing the next
+    item. close waits for all items and re-raises the first exception
+    raised by function
+
+    Parameters
+    ----------
+    function: callable
+        Called with the arguments of every put
+    size: int
+        Maximum number of items waiting to be written
+    """
+
+    def __init__(self, function, size=1):
+        self.function = function
+        self.items = queue.Queue(maxsize=size)
+        self.error = None
+        self._done = object()
+
+        self.thread = threading.Thread(target=self._consume)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _consume(self):
+        while True:
+            item = self.items.get()
+            if item is self._done:
+                break
+            # after an error, keep draining so put never blocks forever
+            if self.error is None:
+                try:
+                    self.function(*item[0], **item[1])
+                except Exception as e:
+                    self.error = e
+
+    def put(self, *args, **kwargs):
+        if self.error is not None:
+            raise self.error
+        self.items.put((args, kwargs))
+
+    def close(self):
+        self.items.put(self._done)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def worker_devices(CONFIG):
+    """Devices for parallel torch workers (nn detection, deconv)
+
+    All gpus in CONFIG.torch_devices or, if there are no gpus and multi
+    processing is on, one cpu device per processor
+
+    Returns
+    -------
+    devices: list
+        One torch device per worker
+    n_threads: int
+        Torch threads of each cpu worker (cpu threads are split among cpu
+        workers), None with a single worker
+    """
+    import torch
+
+    devices = list(CONFIG.torch_devices)
+    if (devices[0].type == 'cpu' and CONFIG.resources.multi_processing):
+        devices = devices*CONFIG.resources.n_processors
+
+    n_threads = None
+    if len(devices) > 1:
+        n_cpu_workers = np.sum([device.type == 'cpu' for device in devices])
+        n_threads = max(torch.get_num_threads()//max(n_cpu_workers, 1), 1)
+
+    return devices, n_threads
+
+
 def save_metadata(path):
     timestamp = datetime.datetime.now().strftime('%c')
     metadata = dict(version=yass.__version__, timestamp=timestamp)
@@ -324,6 +478,19 @@ def change_extension(path, new_extension):
     return reduce(lambda x, y: x+'.'+y, elements)
 
 
+def replace_file(src, dst):
+    """Rename src to dst, overwriting dst if it exists. Atomic on posix,
+    so readers see either the old or the new file
+    """
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+    else:
+        # py2, os.rename does not overwrite on windows
+        if os.name == 'nt' and os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
 def requires(condition, message):
     """
     Utilify function to raise exception when an optional requirement is
@@ -5,7 +5,7 @@ import os
 from os.path import getsize
 import pytest
 import yaml
-from util import PATH_TO_TESTS, seed, dummy_predict_with_threshold
+from util import PATH_TO_TESTS, seed, dummy_predict_with_threshold, Bunch
 
 PATH_TO_ASSETS = os.path.join(PATH_TO_TESTS, 'assets')
 PATH_TO_RETINA_DIR = os.path.join(PATH_TO_ASSETS,  'recordings', 'retina')
@@ -73,6 +73,21 @@ def make_tmp_folder():
     shutil.rmtree(temp)
 
 
+@pytest.fixture
+def make_dummy_config():
+    """Factory of minimal CONFIG stand ins, with the fields READER and
+    the other batch readers use, for tests that need no config file
+    """
+    def make(n_channels, sampling_rate=1000, spike_size=11, gpu_id=0):
+        return Bunch(
+            recordings=Bunch(n_channels=n_channels,
+                             sampling_rate=sampling_rate),
+            resources=Bunch(gpu_id=gpu_id),
+            spike_size=spike_size)
+
+    return make
+
+
 @pytest.fixture()
 def path_to_data():
     return os.path.join(PATH_TO_RETINA_DIR, 'data.bin')
@@ -2,12 +2,19 @@
 process.run tests, checking that the pipeline finishes without errors for
 some configurations
 """
+import importlib
 import os
 
+import numpy as np
+import torch
+
 import yass
 from yass import preprocess
 from yass import detect
 from yass import cluster
+from yass.reader import READER
+from yass.cluster.getptp import GETPTP
+from yass.cluster.cluster import KNNIndex, knn_triage, knn_dist
 
 
 def test_cluster_nnet(path_to_config, make_tmp_folder):
@@ -78,3 +85,92 @@ def test_cluster_nnet(path_to_config, make_tmp_folder):
 #     cluster.run(None, spike_index_all, save_results=True)
 
 #     assert not cluster.run.executed
+
+
+def test_getptp_matches_snippets_from_whole_recording(make_tmp_folder,
+                                                      make_dummy_config):
+    config = make_dummy_config(5)
+
+    class Denoiser(torch.nn.Module):
+        def __init__(self):
+            super(Denoiser, self).__init__()
+            self.out = torch.nn.Linear(3, config.spike_size)
+
+        def forward(self, x):
+            return 2*x, x
+
+    path = os.path.join(make_tmp_folder, 'data.bin')
+    data = np.random.randn(2000, 5).astype('float32')
+    data.tofile(path)
+
+    # unsorted, some spikes exactly on batch boundaries
+    spike_index = np.stack((np.random.randint(10, 1990, 300),
+                            np.random.randint(0, 5, 300)), 1)
+    spike_index[:3, 0] = [300, 600, 900]
+    fname_spike_index = os.path.join(make_tmp_folder, 'spike_index.npy')
+    np.save(fname_spike_index, spike_index)
+
+    reader = READER(path, 'float32', config, n_sec_chunk=0.3)
+    getptp = GETPTP(fname_spike_index, reader, config, Denoiser())
+    getptp.block_size = 7
+    ptps_raw, ptps_denoised = getptp.compute_ptps()
+
+    t_range = np.arange(-5, 6)
+    wfs = data[spike_index[:, [0]] + t_range, spike_index[:, [1]]]
+    np.testing.assert_allclose(ptps_raw, wfs.ptp(1), rtol=1e-6)
+    np.testing.assert_allclose(ptps_denoised, 2*wfs.ptp(1), rtol=1e-6)
+
+
+def test_cluster_tasks_run_largest_first_with_shared_state(monkeypatch,
+                                                          make_tmp_folder):
+    cluster_run = importlib.import_module('yass.cluster.run')
+
+    class FakeCluster(object):
+        def __init__(self, data_in):
+            shared, (fname_out, fname_input) = data_in[:5], data_in[5:]
+            assert shared == ['raw', True, 'config', 'reader', None]
+            with open(os.path.join(make_tmp_folder, 'log.txt'), 'a') as f:
+                f.write(fname_input + '\n')
+            np.save(fname_out, 0)
+
+    monkeypatch.setattr(cluster_run, 'Cluster', FakeCluster)
+
+    sizes = [20, 5000, 300, 10, 700]
+    tasks = []
+    for j, size in enumerate(sizes):
+        fname_input = os.path.join(make_tmp_folder,
+                                   'partition_{}.npz'.format(j))
+        np.savez(fname_input, spike_times=np.arange(size))
+        tasks.append([os.path.join(make_tmp_folder, 'result_{}.npy'.format(j)),
+                      fname_input])
+
+    shared = ['raw', True, 'config', 'reader', None]
+    cluster_run.run_cluster_tasks(tasks, shared, 1)
+    with open(os.path.join(make_tmp_folder, 'log.txt')) as f:
+        done = f.read().split()
+    assert done == [tasks[j][1] for j in [1, 4, 2, 0, 3]]
+
+    os.remove(os.path.join(make_tmp_folder, 'log.txt'))
+    cluster_run.run_cluster_tasks(tasks, shared, 2)
+    with open(os.path.join(make_tmp_folder, 'log.txt')) as f:
+        done = f.read().split()
+    assert sorted(done) == sorted(task[1] for task in tasks)
+
+
+def test_knn_index_is_shared_by_triage_and_knn_dist():
+    pca_wf = np.random.randn(2000, 5)
+
+    index = KNNIndex(pca_wf, n_jobs=2)
+    dist = knn_dist(index)
+    tree = index.tree
+
+    np.testing.assert_array_equal(knn_triage(95, index),
+                                  knn_triage(95, pca_wf))
+    assert index.tree is tree
+    assert index.query(6).shape == (2000, 6)
+    np.testing.assert_array_equal(dist, knn_dist(pca_wf))
+
+    # approximate neighbours are within 1+eps of the exact ones
+    dist_approx = KNNIndex(pca_wf, eps=0.5).query(30)
+    assert np.all(dist_approx <= 1.5*dist + 1e-12)
+    assert np.all(dist_approx >= dist - 1e-12)
@@ -1,6 +1,10 @@
 import os
+
+import pytest
+
 import yass
 from yass import preprocess, cluster, deconvolve, detect
+from util import Bunch
 
 
 def test_deconvolution(patch_triage_network, path_to_config,
@@ -32,3 +36,276 @@ def test_deconvolution(patch_triage_network, path_to_config,
                      'deconv'),
         standardized_path,
         standardized_params['dtype'])
+
+
+def test_cpu_spline_subtraction_matches_templates():
+    import numpy as np
+    import torch
+    from yass.deconvolve.match_pursuit_cpu import deconvCPU
+    from yass.deconvolve.match_pursuit_gpu_new import (
+        transform_template_parallel)
+
+    # zero padded temp_temp of two units, visible on different units
+    temp_temp = [np.zeros((2, 30), 'float32'), np.zeros((1, 30), 'float32')]
+    for temp in temp_temp:
+        temp[:, 5:25] = np.random.randn(len(temp), 20)
+    vis_units = [np.array([0, 1]), np.array([1])]
+
+    d_cpu = deconvCPU.__new__(deconvCPU)
+    d_cpu.K = 2
+    d_cpu.coefficients = [transform_template_parallel(temp)
+                          for temp in temp_temp]
+    d_cpu.coefficients_to_gpu(vis_units)
+    d_cpu.obj_gpu = torch.zeros((2, 100))
+
+    # without sub-sample shifts, splines go through temp_temp
+    d_cpu.subtract_splines(torch.tensor([10, 50, 55]),
+                           torch.zeros(3),
+                           torch.tensor([0, 0, 1]),
+                           torch.tensor([1., 2., 1.]))
+
+    expected = np.zeros((2, 100), 'float32')
+    expected[:, 10:40] -= temp_temp[0]
+    expected[:, 50:80] -= 2*temp_temp[0]
+    expected[1, 55:85] -= temp_temp[1][0]
+
+    np.testing.assert_allclose(d_cpu.obj_gpu.numpy(), expected, atol=1e-3)
+
+
+def test_batched_objective_matches_per_unit_loop():
+    import numpy as np
+    import torch
+    from yass.deconvolve.match_pursuit_cpu import deconvCPU
+
+    K, C, RANK, STIME, n_time = 5, 6, 3, 11, 200
+    shifts = np.random.randint(0, 4, (K, C))
+    spat_comp = np.random.randn(K, RANK, C).astype('float32')
+    temp_comp = np.random.randn(K, RANK, STIME).astype('float32')
+    data = np.random.randn(C, n_time).astype('float32')
+    norms = np.random.rand(K).astype('float32')
+
+    d_cpu = deconvCPU.__new__(deconvCPU)
+    d_cpu.K, d_cpu.RANK, d_cpu.STIME = K, RANK, STIME
+    d_cpu.jitter_diff = 0
+    d_cpu.verbose = False
+    d_cpu.max_shift = shifts.max()
+    d_cpu.shift_offsets = torch.from_numpy(shifts.max() - shifts)
+    d_cpu.spat_comp = torch.from_numpy(spat_comp)
+    d_cpu.temp_comp = torch.from_numpy(temp_comp)
+    d_cpu.norms = torch.from_numpy(norms)
+    d_cpu.data = torch.from_numpy(data)
+    # two units per block
+    d_cpu.objective_block_size = 2*C*n_time
+    d_cpu.make_objective_shifted_svd()
+
+    expected = np.zeros((K, n_time+STIME-1))
+    for unit in range(K):
+        data_shifted = np.zeros_like(data)
+        for c in range(C):
+            data_shifted[c, shifts[unit, c]:] = data[
+                c, :n_time-shifts[unit, c]]
+        mm = np.matmul(spat_comp[unit], data_shifted)
+        for i in range(RANK):
+            expected[unit] += np.correlate(
+                np.pad(mm[i], STIME-1), temp_comp[unit, i], 'valid')
+    expected = 2*expected - norms[:, None]
+
+    np.testing.assert_allclose(d_cpu.obj_gpu.numpy(), expected,
+                               rtol=1e-4, atol=1e-3)
+
+
+def test_incremental_peaks_match_full_search():
+    import numpy as np
+    import torch
+    from yass.deconvolve.match_pursuit_cpu import deconvCPU
+
+    K, n_time = 4, 3000
+    d_cpu = deconvCPU.__new__(deconvCPU)
+    d_cpu.lockout_window = 20
+    d_cpu.subtraction_offset = 15
+    d_cpu.deconv_thresh = 1.
+    d_cpu.touch_start, d_cpu.touch_end = 0, 40
+    d_cpu.peak_block_size = 64
+    d_cpu.obj_gpu = torch.randn(K, n_time)*2
+    d_cpu.reset_peak_cache()
+
+    for _ in range(5):
+        d_cpu.incremental_peaks = True
+        d_cpu.find_peaks()
+        spike_times, neuron_ids = d_cpu.spike_times, d_cpu.neuron_ids
+
+        d_cpu.incremental_peaks = False
+        d_cpu.find_peaks()
+        np.testing.assert_array_equal(spike_times.numpy(),
+                                      d_cpu.spike_times.numpy())
+        np.testing.assert_array_equal(neuron_ids.numpy(),
+                                      d_cpu.neuron_ids.numpy())
+
+        # change the objective around a few spikes
+        times = spike_times[np.random.choice(len(spike_times), 10), 0]
+        for t in times:
+            d_cpu.obj_gpu[:, t:t+40] -= torch.rand(K, 1)*3
+        d_cpu.touch_objective(times)
+
+
+def test_init_cache_round_trip_and_eviction(make_tmp_folder):
+    import time
+    import numpy as np
+    from yass.deconvolve.init_cache import InitCache, init_cache_key
+
+    templates = np.random.randn(4, 21, 7)
+    geom = np.random.randn(7, 2)
+    neigh = np.random.rand(7, 7) > 0.5
+    key = init_cache_key(templates, 5, 30, 30, geom, neigh, 20000)
+    assert key == init_cache_key(templates.copy(), 5, 30, 30, geom,
+                                 neigh.copy(), 20000)
+    assert key != init_cache_key(templates, 3, 30, 30, geom, neigh, 20000)
+    assert key != init_cache_key(templates, 5, 30, 30, geom, ~neigh, 20000)
+    assert key != init_cache_key(templates, 5, 30, 30, geom, neigh, 30000)
+
+    cache = InitCache(os.path.join(make_tmp_folder, 'cache'), 10**9)
+    ragged = [np.random.randn(n, 9) for n in (3, 1, 5, 2)]
+    cache.save(key, 'subtraction_offset', 12)
+    cache.save_list(key, 'temp_temp', ragged)
+    assert cache.has(key, ['subtraction_offset', 'temp_temp'])
+
+    loaded = cache.load_list(key, 'temp_temp')
+    assert all(np.array_equal(a, b) for a, b in zip(ragged, loaded))
+    assert int(cache.load(key, 'subtraction_offset', mmap_mode=None)) == 12
+
+    # least recently used entry goes first
+    other = init_cache_key(templates + 1, 5, 30, 30, geom, neigh, 20000)
+    cache.save_list(other, 'temp_temp', ragged)
+    time.sleep(0.01)
+    cache.touch(key)
+    cache.max_size = 1
+    cache.evict(keep=key)
+    assert cache.has(key, ['temp_temp'])
+    assert not cache.has(other, ['temp_temp'])
+
+
+def test_overlapping_unit_pairs_match_dense_overlap():
+    import numpy as np
+    from yass.deconvolve.utils import overlapping_unit_pairs
+
+    np.random.seed(0)
+    geom = np.stack([np.tile([0, 16.], 32), np.repeat(np.arange(32)*20., 2)], 1)
+    main_chans = np.random.randint(64, size=200)
+    dist = np.linalg.norm(geom[main_chans][:, None] - geom[None], axis=2)
+    viscs = dist < np.random.uniform(10, 80, size=200)[:, None]
+
+    indptr, indices = overlapping_unit_pairs(viscs, main_chans, geom)
+
+    dense = np.logical_and(viscs[None], viscs[:, None]).sum(-1) > 0
+    sparse = np.zeros_like(dense)
+    sparse[np.repeat(np.arange(200), np.diff(indptr)), indices] = True
+    assert np.array_equal(dense, sparse)
+    assert all(np.all(np.diff(indices[indptr[u]:indptr[u+1]]) > 0)
+               for u in range(200))
+
+
+def test_gather_segments_trims_buffer_and_sorts(make_tmp_folder):
+    import numpy as np
+    from yass.deconvolve.run import (gather_segments, save_segment,
+                                     segment_fname, segment_done)
+
+    seg_dir = os.path.join(make_tmp_folder, 'segs')
+    os.makedirs(seg_dir)
+    reader = Bunch(n_sec_chunk=1, start=0, sampling_rate=100,
+                   buffer=10, batch_size=100)
+    d_gpu = Bunch(reader=reader, seg_dir=seg_dir, out_dir=make_tmp_folder)
+
+    np.random.seed(0)
+    expected = []
+    for chunk_id in range(4):
+        spike_train = np.stack((np.random.randint(0, 120, 50),
+                                np.random.randint(0, 5, 50)), 1)
+        offset = chunk_id*100 - 10
+        # shifts and scales hold the spike time and unit, to check that
+        # they stay aligned with the spike train
+        shifts = (spike_train[:, 0] + offset).astype('float32')
+        heights = spike_train[:, 1].astype('float32')
+        fname = segment_fname(d_gpu, chunk_id)
+        if chunk_id == 2:
+            # segment saved by older versions: no index, buffer spikes
+            # kept and times relative to the chunk
+            np.savez(fname, spike_train=spike_train, offset=offset,
+                     shifts=shifts, heights=heights)
+        else:
+            save_segment(fname, spike_train, shifts, heights, offset, 10, 110)
+
+        keep = (spike_train[:, 0] >= 10) & (spike_train[:, 0] < 110)
+        expected.append(spike_train[keep] + [offset, 0])
+
+    assert all(segment_done(d_gpu, chunk_id) for chunk_id in range(4))
+    gather_segments(d_gpu, range(4))
+
+    spike_train = np.load(os.path.join(make_tmp_folder, 'spike_train.npy'))
+    shifts = np.load(os.path.join(make_tmp_folder, 'shifts.npy'))
+    scales = np.load(os.path.join(make_tmp_folder, 'scales.npy'))
+    expected = np.concatenate(expected)
+    assert spike_train.dtype == np.int32
+    assert np.all(np.diff(spike_train[:, 0]) >= 0)
+    assert np.array_equal(np.sort(spike_train[:, 0]),
+                          np.sort(expected[:, 0]))
+    assert np.array_equal(shifts, spike_train[:, 0])
+    assert np.array_equal(scales, spike_train[:, 1])
+
+
+class FailOnceDeconv(object):
+    """Stand in for deconvGPU where every chunk fails on its first run,
+    tracked with files so that it also holds across worker processes
+    """
+    def __init__(self, seg_dir):
+        self.reader = Bunch(n_batches=5, n_sec_chunk=1, start=0,
+                            sampling_rate=100, buffer=0, batch_size=100)
+        self.seg_dir = seg_dir
+
+    def initialize(self, move_data_to_gpu=True):
+        pass
+
+    def data_to_gpu(self):
+        pass
+
+    def read_chunk(self, chunk_id):
+        return None, chunk_id*100
+
+    def run(self, chunk_id, chunk=None):
+        import numpy as np
+
+        fname_failed = os.path.join(self.seg_dir, 'failed_{}'.format(chunk_id))
+        if not os.path.exists(fname_failed):
+            open(fname_failed, 'w').close()
+            raise ValueError(chunk_id)
+        self.offset = chunk[1]
+        self.spike_train = np.array([[50, chunk_id]])
+        self.shifts = np.zeros(1, 'float32')
+        self.heights = np.ones(1, 'float32')
+
+
+@pytest.mark.parametrize('n_workers', [1, 2])
+def test_deconv_scheduler_retries_failed_chunks(make_tmp_folder, n_workers):
+    import torch
+    from yass.deconvolve.run import (run_core_deconv, run_deconv_workers,
+                                     segment_done)
+
+    CONFIG = Bunch(torch_devices=[torch.device('cpu')],
+                   resources=Bunch(multi_processing=int(n_workers > 1),
+                                   n_processors=n_workers))
+    d_gpu = FailOnceDeconv(make_tmp_folder)
+    run_core_deconv(d_gpu, CONFIG, max_retries=1)
+    assert all(segment_done(d_gpu, chunk_id) for chunk_id in range(5))
+
+    # every failure is counted once, also those reported by workers
+    # right before they stop
+    d_gpu = FailOnceDeconv(os.path.join(make_tmp_folder, 'attempts'))
+    os.makedirs(d_gpu.seg_dir)
+    attempts = {}
+    run_deconv_workers(d_gpu, range(5), [torch.device('cpu')]*n_workers,
+                       None, attempts, 0)
+    assert attempts == {chunk_id: 1 for chunk_id in range(5)}
+
+    d_gpu = FailOnceDeconv(os.path.join(make_tmp_folder, 'no_retries'))
+    os.makedirs(d_gpu.seg_dir)
+    with pytest.raises(RuntimeError):
+        run_core_deconv(d_gpu, CONFIG, max_retries=0)
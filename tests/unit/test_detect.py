@@ -1,8 +1,13 @@
 import os
 
+import numpy as np
+import torch
+from scipy.signal import argrelmin
+
 import yass
 from yass import preprocess
 from yass import detect
+from util import Bunch
 
 
 # def test_can_detect_with_threshold(path_to_config_threshold,
@@ -41,3 +46,220 @@ def test_can_detect_with_nnet(path_to_config, make_tmp_folder):
 #                standardized_params,
 #                whiten_filter,
 #                function=nnet_experimental.run)
+
+
+def test_voltage_threshold_finds_thresholded_local_minima():
+    from yass.threshold.detect import voltage_threshold
+
+    # rounding creates ties, which are not minima
+    recording = np.round(np.random.randn(2000, 6)*2).astype('float32')
+    threshold, order = 1.5, 5
+
+    spike_index, energy = voltage_threshold(recording, threshold, order)
+
+    expected = []
+    for c in range(recording.shape[1]):
+        index = argrelmin(recording[:, c], order=order)[0]
+        index = index[recording[index, c] < -threshold]
+        expected.append(np.vstack((index, np.ones(len(index))*c)).T)
+    expected = np.concatenate(expected)
+    expected = expected[np.lexsort((expected[:, 1], expected[:, 0]))]
+
+    np.testing.assert_array_equal(spike_index, expected)
+    np.testing.assert_array_equal(
+        energy, np.abs(recording[spike_index[:, 0], spike_index[:, 1]]))
+
+
+def test_deduplicate_matches_deduplicate_gpu():
+    import torch
+    from yass.detect.deduplication import deduplicate, deduplicate_gpu
+
+    T, C = 1000, 8
+    # each channel and its two neighbors on each side, padded with C
+    channel_index = np.full((C, 5), C)
+    for c in range(C):
+        neighbors = [c] + [k for k in range(c-2, c+3)
+                           if 0 <= k < C and k != c]
+        channel_index[c, :len(neighbors)] = neighbors
+
+    # spikes at unique (time, channel) locations
+    location = np.random.choice(T*C, 1500, replace=False)
+    spike_index = np.vstack(np.divmod(location, C)).T
+    energy = np.random.rand(len(spike_index)).astype('float32')
+
+    expected = deduplicate_gpu(torch.from_numpy(spike_index),
+                               torch.from_numpy(energy),
+                               (T, C), channel_index).numpy()
+    spike_index_dedup = deduplicate(spike_index, energy, (T, C),
+                                    channel_index)
+
+    np.testing.assert_array_equal(spike_index_dedup, expected)
+
+
+def test_spike_index_store_gather(make_tmp_folder):
+    from yass.detect.output import (SpikeIndexStore, completed_batches,
+                                    gather_result)
+
+    batch_dir = os.path.join(make_tmp_folder, 'batch')
+
+    # two workers, batches saved out of order
+    store_0 = SpikeIndexStore(os.path.join(batch_dir, 'worker_0'))
+    store_1 = SpikeIndexStore(os.path.join(batch_dir, 'worker_1'))
+    store_1.append(1, np.array([[120, 3], [150, 0]]), 4)
+    store_0.append(2, np.array([[210, 1]]), 1)
+    store_0.append(0, np.array([[5, 2], [30, 1], [30, 4]]), 5)
+
+    # an interrupted append leaves data without an index row
+    with open(store_0.fname_times, 'ab') as f:
+        f.write(np.array([999], 'int64').tobytes())
+    with open(store_0.fname_index, 'ab') as f:
+        f.write(np.array([3, 6], 'int64').tobytes())
+
+    assert completed_batches(batch_dir) == {0, 1, 2}
+
+    # appending again drops the incomplete data
+    store_0 = SpikeIndexStore(store_0.path)
+    store_0.append(3, np.zeros((0, 2), 'int64'), 0)
+    index, times, channels = store_0.read()
+    np.testing.assert_array_equal(index[:, 0], [2, 0, 3])
+    np.testing.assert_array_equal(times, [210, 5, 30, 30])
+
+    fname = os.path.join(make_tmp_folder, 'spike_index.npy')
+    gather_result(fname, batch_dir)
+    np.testing.assert_array_equal(
+        np.load(fname),
+        [[5, 2], [30, 1], [30, 4], [120, 3], [150, 0], [210, 1]])
+
+
+def test_worker_store_is_opened_once_per_run(make_tmp_folder):
+    from yass.detect.output import open_worker_store, list_stores
+
+    store = open_worker_store(make_tmp_folder, 'run0')
+    store.append(0, np.array([[5, 2]]), 1)
+    assert open_worker_store(make_tmp_folder, 'run0') is store
+
+    # a new run in the same process does not append to the old store
+    store_new = open_worker_store(make_tmp_folder, 'run1')
+    store_new.append(1, np.array([[120, 3]]), 1)
+    assert store_new.path != store.path
+    np.testing.assert_array_equal(store.read_index()[:, 0], [0])
+    assert len(list_stores(make_tmp_folder)) == 2
+
+
+class ThresholdDetector(object):
+    """Stand in for the nn detector: negative threshold crossings, with the
+    three samples around them as waveforms
+    """
+    def to(self, device):
+        return self
+
+    def get_spike_times(self, recording, threshold):
+        spike_index = torch.nonzero(recording < -threshold)
+        times = spike_index[:, 0]
+        wfs = torch.stack(
+            [recording[torch.clamp(times + k, 0, len(recording)-1),
+                       spike_index[:, 1]] for k in (-1, 0, 1)], 1)
+        return spike_index, wfs
+
+
+class IdentityDenoiser(object):
+    def to(self, device):
+        return self
+
+    def __call__(self, wfs):
+        return wfs, None
+
+
+def run_detection(make_tmp_folder, make_dummy_config, name, devices):
+    from yass.detect.output import gather_result, list_stores
+    from yass.detect.run import run_nn_detction_batch, run_nn_detection_workers
+    from yass.reader import READER
+
+    path = os.path.join(make_tmp_folder, 'data.bin')
+    if not os.path.exists(path):
+        np.random.seed(0)
+        np.random.randn(5000, 4).astype('float32').tofile(path)
+    reader = READER(path, 'float32', make_dummy_config(4), 1, 10)
+    channel_index = np.array([[0, 1, 4], [1, 0, 2], [2, 1, 3], [3, 2, 4]])
+
+    output_directory = os.path.join(make_tmp_folder, name)
+    os.makedirs(output_directory)
+    args = (output_directory, 'run', reader, 0.25, ThresholdDetector(),
+            IdentityDenoiser(), channel_index, 2)
+    if len(devices) > 1:
+        run_nn_detection_workers(range(reader.n_batches), devices, 1, *args)
+    else:
+        run_nn_detction_batch(range(reader.n_batches), *args,
+                              device=devices[0])
+
+    batch_ids = np.hstack([store.read_index()[:, 0]
+                           for store in list_stores(output_directory)])
+    fname = os.path.join(make_tmp_folder, name + '.npy')
+    gather_result(fname, output_directory)
+
+    return np.sort(batch_ids), np.load(fname)
+
+
+def test_nn_detection_workers_match_single_worker(make_tmp_folder,
+                                                   make_dummy_config):
+    cpu = torch.device('cpu')
+    batch_ids, spike_index = run_detection(
+        make_tmp_folder, make_dummy_config, 'single', [cpu])
+    batch_ids_workers, spike_index_workers = run_detection(
+        make_tmp_folder, make_dummy_config, 'workers', [cpu, cpu])
+
+    # every batch detected exactly once
+    np.testing.assert_array_equal(batch_ids, np.arange(5))
+    np.testing.assert_array_equal(batch_ids_workers, np.arange(5))
+
+    assert len(spike_index) > 0
+    np.testing.assert_array_equal(spike_index_workers, spike_index)
+
+
+def test_worker_devices_expand_cpu_to_n_processors():
+    from yass.util import worker_devices
+
+    cpu = torch.device('cpu')
+    CONFIG = Bunch(torch_devices=[cpu],
+                   resources=Bunch(multi_processing=1, n_processors=3))
+    devices, n_threads = worker_devices(CONFIG)
+    assert devices == [cpu]*3
+    assert n_threads == max(torch.get_num_threads()//3, 1)
+
+    CONFIG.resources.multi_processing = 0
+    assert worker_devices(CONFIG) == ([cpu], None)
+
+    # gpus are not expanded
+    gpus = [torch.device('cuda:0'), torch.device('cuda:1')]
+    CONFIG = Bunch(torch_devices=gpus,
+                   resources=Bunch(multi_processing=1, n_processors=3))
+    devices, n_threads = worker_devices(CONFIG)
+    assert devices == gpus
+
+
+def test_detect_nn_minibatches_matches_one_minibatch_at_a_time():
+    from yass.detect.deduplication import deduplicate
+    from yass.detect.run import detect_nn_minibatches
+
+    batched_recordings = torch.randn(4, 300, 4)
+    # no spikes in one minibatch
+    batched_recordings[2] = 0
+    channel_index = np.array([[0, 1, 4], [1, 0, 2], [2, 1, 3], [3, 2, 4]])
+
+    spike_index, spike_index_dedup = detect_nn_minibatches(
+        batched_recordings, ThresholdDetector(), IdentityDenoiser(),
+        channel_index, 2, denoise_block_size=7)
+
+    # unbatched: detect, denoise and deduplicate each minibatch alone
+    for j in range(4):
+        expected, wfs = ThresholdDetector().get_spike_times(
+            batched_recordings[j], 2)
+        energy = (wfs.max(1)[0] - wfs.min(1)[0]).numpy()
+        expected = expected.numpy()
+        np.testing.assert_array_equal(spike_index[j], expected)
+        if len(expected) > 0:
+            np.testing.assert_array_equal(
+                spike_index_dedup[j],
+                deduplicate(expected, energy, (300, 4), channel_index))
+    assert len(spike_index[2]) == 0
+    assert sum(len(s) for s in spike_index_dedup) > 0
@@ -0,0 +1,120 @@
+import numpy as np
+
+from yass import mfm
+
+
+class Prior(object):
+    beta = 1
+    a = 1
+    lambda0 = 0.01
+    nu = 5
+    V = 2
+
+
+class Cluster(object):
+    prior = Prior()
+
+
+class Param(object):
+    cluster = Cluster()
+
+
+def make_masked_data(N=300, nfeature=3, nchannel=5):
+    score = np.random.randn(N, nfeature, nchannel)
+    mask = (np.random.rand(N, nchannel) > 0.3)*np.random.rand(N, nchannel)
+    # fully visible and fully masked channels
+    mask[:, 1] = 1
+    mask[:, 3] = 0
+    group = np.unique(np.random.randint(0, 60, N), return_inverse=True)[1]
+
+    return mfm.maskData(score, mask, group)
+
+
+def test_suffstat_matches_per_channel_sums():
+    maskedData = make_masked_data()
+    Ngroup, nfeature, nchannel = maskedData.sumY.shape
+    rhat = np.random.dirichlet(np.ones(4), Ngroup)
+    suffStat = mfm.suffStatistics(maskedData, mfm.vbPar(rhat))
+
+    eye = np.eye(nfeature)[:, :, np.newaxis]
+    for n in range(nchannel):
+        visible = maskedData.groupMask[:, n] > 0
+        rhat_n = rhat[visible]
+        sumY = np.einsum('gf,gk->fk', maskedData.sumY[visible, :, n], rhat_n)
+        sumYSq = np.einsum('gef,gk->efk',
+                           maskedData.sumYSq[visible, :, :, n] +
+                           maskedData.sumEta[visible, :, :, n], rhat_n)
+        if visible.sum() < Ngroup:
+            sumYSq += eye*(suffStat.Nhat - np.dot(
+                maskedData.weight[visible], rhat_n))
+
+        np.testing.assert_allclose(suffStat.sumY[:, :, n], sumY, atol=1e-10)
+        np.testing.assert_allclose(suffStat.sumYSq[:, :, :, n], sumYSq,
+                                   atol=1e-10)
+
+
+def test_merge_ELBO_matches_ELBO_after_merge():
+    maskedData = make_masked_data()
+    K = 5
+    rhat = np.random.dirichlet(np.ones(K)*0.3, maskedData.weight.size)
+    suffStat = mfm.suffStatistics(maskedData, mfm.vbPar(rhat))
+    vbParam = mfm.vbPar(rhat)
+    vbParam.update_global(suffStat, Param)
+
+    pairs = [(0, 1), (3, 2), (4, 0)]
+    ELBO_merged = mfm.merge_ELBO(suffStat, vbParam, Param, pairs)
+
+    ELBO = mfm.ELBO_Class(maskedData, suffStat, vbParam, Param)
+    for (ka, kb), expected in zip(pairs, ELBO_merged):
+        # a merge that always increases the ELBO is accepted by check_merge
+        ELBO.total = -np.inf
+        vbParamMerged, suffStatMerged, merged, _, ELBOMerged = \
+            mfm.check_merge(maskedData, vbParam, suffStat, ka, kb, Param,
+                            np.ones(K), ELBO)
+        assert merged
+        np.testing.assert_allclose(ELBOMerged.total, expected, rtol=1e-10)
+
+
+def test_spikesort_finds_separated_clusters():
+    centers = np.random.randn(3, 5)*10
+    labels = np.random.randint(0, 3, 2000)
+    score = (centers[labels] + np.random.randn(2000, 5))[:, :, np.newaxis]
+
+    vbParam = mfm.spikesort(score, np.ones((2000, 1)), np.arange(2000),
+                            Param)
+
+    assignment = vbParam.rhat.argmax(1)
+    assert vbParam.rhat.shape[1] == 3
+    for k in range(3):
+        assert len(np.unique(assignment[labels == k])) == 1
+
+
+def test_warm_start_converges_in_fewer_iterations(monkeypatch):
+    centers = np.random.randn(3, 5)*10
+    labels = np.random.randint(0, 3, 2000)
+    score = (centers[labels] + np.random.randn(2000, 5))[:, :, np.newaxis]
+
+    n_births = []
+    birth_move = mfm.birth_move
+
+    def count_birth_move(*args):
+        n_births.append(1)
+        return birth_move(*args)
+
+    monkeypatch.setattr(mfm, 'birth_move', count_birth_move)
+
+    mfm.spikesort(score, np.ones((2000, 1)), np.arange(2000), Param)
+    n_cold = len(n_births)
+
+    # parent's assignments with an extra empty cluster
+    rhat = np.zeros((2000, 4))
+    rhat[np.arange(2000), labels] = 1
+    del n_births[:]
+    vbParam = mfm.spikesort(score, np.ones((2000, 1)), np.arange(2000),
+                            Param, rhat_init=rhat, tol=1e-3)
+
+    assert len(n_births) < n_cold
+    assignment = vbParam.rhat.argmax(1)
+    assert vbParam.rhat.shape[1] == 3
+    for k in range(3):
+        assert len(np.unique(assignment[labels == k])) == 1
@@ -1,5 +1,7 @@
 import os
 
+import numpy as np
+
 try:
     from pathlib2 import Path
 except ImportError:
@@ -80,3 +82,104 @@ def test_can_preprocess_without_filtering(path_to_config,
     (standardized_path,
      standardized_params) = preprocess.run(
         os.path.join(make_tmp_folder, 'preprocess'))
+
+
+def test_streaming_batches_match_merged_file(make_tmp_folder,
+                                             make_dummy_config):
+    from yass.preprocess.util import (filter_standardize_batch, get_std,
+                                      make_output_file,
+                                      merge_filtered_files)
+    from yass.reader import READER
+
+    config = make_dummy_config(4)
+
+    path = os.path.join(make_tmp_folder, 'data.bin')
+    np.random.randn(3500, 4).astype('float32').tofile(path)
+
+    reader = READER(path, 'float32', config, n_sec_chunk=1)
+    fname_mean_sd = os.path.join(make_tmp_folder, 'mean_sd.npz')
+    get_std(reader.read_data(0, 1000), 1000, fname_mean_sd,
+            True, 300, 0.1, 3)
+
+    # merged files
+    filtered_location = os.path.join(make_tmp_folder, 'filtered_files')
+    os.makedirs(filtered_location)
+    for batch_id in range(reader.n_batches):
+        filter_standardize_batch(batch_id, reader, fname_mean_sd, True,
+                                 'float32', filtered_location,
+                                 300, 0.1, 3, 1000)
+    merge_filtered_files(filtered_location, make_tmp_folder)
+    merged = np.fromfile(os.path.join(make_tmp_folder, 'standardized.bin'),
+                         dtype='float32')
+
+    # streaming, batches written in reverse order
+    fname_out = os.path.join(make_tmp_folder, 'streamed.bin')
+    make_output_file(fname_out, reader.rec_len, 4, 'float32')
+    for batch_id in reversed(range(reader.n_batches)):
+        filter_standardize_batch(batch_id, reader, fname_mean_sd, True,
+                                 'float32', None, 300, 0.1, 3, 1000,
+                                 fname_out)
+    streamed = np.fromfile(fname_out, dtype='float32')
+
+    np.testing.assert_array_equal(streamed, merged)
+
+
+def test_int16_standardized_file_matches_float32(make_tmp_folder,
+                                                 make_dummy_config):
+    from yass.preprocess.util import (filter_standardize_stream, get_std,
+                                      get_standardized_scale,
+                                      make_output_file)
+    from yass.reader import READER, save_scale
+
+    config = make_dummy_config(4)
+
+    path = os.path.join(make_tmp_folder, 'data.bin')
+    data = np.random.randn(3500, 4).astype('float32')
+    # a large deflection at the end of the recording must not be clipped
+    data[3200] *= 50
+    data.tofile(path)
+
+    reader = READER(path, 'float32', config, n_sec_chunk=1)
+    fname_mean_sd = os.path.join(make_tmp_folder, 'mean_sd.npz')
+    small_batch = reader.read_data(0, 1000)
+    get_std(small_batch, 1000, fname_mean_sd, True, 300, 0.1, 3)
+
+    standardized = {}
+    for dtype in ['float32', 'int16']:
+        fname_out = os.path.join(make_tmp_folder, dtype + '.bin')
+        scale = get_standardized_scale(reader, fname_mean_sd, dtype,
+                                       True, 300, 0.1, 3, 1000)
+        save_scale(fname_out, scale)
+        make_output_file(fname_out, reader.rec_len, 4, dtype)
+        filter_standardize_stream(reader, fname_mean_sd, dtype, fname_out,
+                                  300, 3, 1000, scale)
+        standardized[dtype] = READER(fname_out, dtype,
+                                     config).read_data(0, 3500)
+
+    assert os.path.getsize(os.path.join(make_tmp_folder, 'int16.bin')) == \
+        3500*4*2
+    np.testing.assert_allclose(standardized['int16'],
+                               standardized['float32'], atol=1e-2)
+
+
+def test_filter_stream_matches_filtfilt():
+    from yass.preprocess.util import ButterworthFilter
+
+    ts = np.random.randn(20000, 5).astype('float32')
+    filt = ButterworthFilter(300, 3, 20000)
+    expected = filt.filtfilt(ts)
+
+    chunk, buffer = 4000, 1000
+    zi = None
+    filtered = []
+    for start in range(0, len(ts), chunk):
+        end = min(start + chunk + buffer, len(ts))
+        out, zi = filt.filter_stream(ts[start:end], min(chunk, end - start),
+                                     zi)
+        filtered.append(out)
+    filtered = np.concatenate(filtered)
+
+    assert filtered.dtype == np.float32
+    # away from the recording edges, chunked and full filtering agree
+    np.testing.assert_allclose(filtered[500:-500], expected[500:-500],
+                               atol=1e-4)
@@ -0,0 +1,150 @@
+import logging
+import os
+
+import numpy as np
+import pytest
+
+from yass.reader import (READER, get_scale, get_reader_scale, quantize,
+                         save_scale)
+
+
+N_CHANNELS = 7
+
+
+@pytest.fixture
+def config(make_dummy_config):
+    return make_dummy_config(N_CHANNELS)
+
+
+def make_recording(path, n_observations=500, dtype='float32'):
+    data = np.random.randn(n_observations, N_CHANNELS).astype(dtype)
+    data.tofile(path)
+    return data
+
+
+def test_mmap_read_data_matches_file_read(make_tmp_folder, config):
+    path = os.path.join(make_tmp_folder, 'data.bin')
+    data = make_recording(path)
+
+    reader = READER(path, 'float32', config, mmap=False)
+    reader_mmap = READER(path, 'float32', config, mmap=True)
+
+    np.testing.assert_array_equal(reader_mmap.read_data(10, 120),
+                                  reader.read_data(10, 120))
+    np.testing.assert_array_equal(reader_mmap.read_data(10, 120, [1, 4]),
+                                  data[10:120, [1, 4]])
+
+
+def test_mmap_read_waveforms_matches_file_read(make_tmp_folder, config):
+    path = os.path.join(make_tmp_folder, 'data.bin')
+    make_recording(path)
+
+    reader = READER(path, 'float32', config, mmap=False)
+    reader_mmap = READER(path, 'float32', config, mmap=True)
+
+    # first and last spikes are too close to the edges
+    spike_times = np.array([2, 5, 100, 37, 250, 495, 499])
+    channels = np.array([0, 3, 6])
+
+    wfs, skipped = reader.read_waveforms(spike_times, channels=channels)
+    wfs_mmap, skipped_mmap = reader_mmap.read_waveforms(spike_times,
+                                                        channels=channels)
+
+    assert skipped == [0, 5, 6]
+    assert skipped_mmap == skipped
+    assert wfs_mmap.shape == (4, config.spike_size, 3)
+    np.testing.assert_array_equal(wfs_mmap, wfs)
+
+
+def test_read_waveforms_bulk_matches_read_waveforms(make_tmp_folder, config):
+    path = os.path.join(make_tmp_folder, 'data.bin')
+    make_recording(path, n_observations=5000)
+
+    reader = READER(path, 'float32', config)
+
+    # unsorted, overlapping, far apart and out of bounds spikes
+    spike_times = np.array([4000, 12, 30, 31, 2500, 4995, 45, 100, 4001])
+    channels_per_spike = np.random.randint(
+        0, N_CHANNELS, (len(spike_times), 3))
+    # padded channel
+    channels_per_spike[1, 2] = N_CHANNELS
+
+    wfs_all, skipped_all = reader.read_waveforms(spike_times)
+    wfs, skipped = reader.read_waveforms_bulk(
+        spike_times, channels_per_spike, max_gap=20, max_run_len=1000)
+
+    assert skipped == skipped_all == [5]
+
+    channels_kept = np.delete(channels_per_spike, skipped, axis=0)
+    for k in range(len(wfs)):
+        for c, channel in enumerate(channels_kept[k]):
+            if channel == N_CHANNELS:
+                np.testing.assert_array_equal(wfs[k, :, c], 0)
+            else:
+                np.testing.assert_array_equal(wfs[k, :, c],
+                                              wfs_all[k, :, channel])
+
+
+def test_quantized_recordings_are_read_as_float32(make_tmp_folder, config):
+    path = os.path.join(make_tmp_folder, 'data.bin')
+    data = make_recording(path, n_observations=1000)
+    spike_times = np.array([3, 100, 37, 600, 998])
+    channels = np.array([0, 3, 6])
+    channels_per_spike = np.array([[1, 2, 7]]*len(spike_times))
+
+    reader = READER(path, 'float32', config, n_sec_chunk=0.3)
+    wfs, skipped = reader.read_waveforms(spike_times, channels=channels)
+    wfs_bulk, _ = reader.read_waveforms_bulk(spike_times,
+                                             channels_per_spike)
+
+    for dtype in ['float16', 'int16']:
+        path_q = os.path.join(make_tmp_folder, 'data_{}.bin'.format(dtype))
+        scale = get_scale(data, dtype)
+        quantize(data, dtype, scale).tofile(path_q)
+        save_scale(path_q, scale)
+        assert (scale is None) == (dtype == 'float16')
+
+        for mmap in [False, True]:
+            reader_q = READER(path_q, dtype, config, n_sec_chunk=0.3,
+                              mmap=mmap)
+            assert reader_q.rec_len == reader.rec_len
+
+            read = reader_q.read_data(10, 120, channels)
+            assert read.dtype == np.float32
+            np.testing.assert_allclose(read, data[10:120, channels],
+                                       atol=2e-3)
+
+            batch = reader_q.read_data_batch(0, add_buffer=True)
+            np.testing.assert_allclose(
+                batch, reader.read_data_batch(0, add_buffer=True), atol=2e-3)
+
+            wfs_q, skipped_q = reader_q.read_waveforms(spike_times,
+                                                       channels=channels)
+            assert skipped_q == skipped
+            np.testing.assert_allclose(wfs_q, wfs, atol=2e-3)
+
+            wfs_bulk_q, _ = reader_q.read_waveforms_bulk(spike_times,
+                                                         channels_per_spike)
+            np.testing.assert_allclose(wfs_bulk_q, wfs_bulk, atol=2e-3)
+
+
+def test_reader_scale_covers_all_batches_and_clipping_is_logged(
+        make_tmp_folder, caplog, config):
+    path = os.path.join(make_tmp_folder, 'data.bin')
+    data = make_recording(path, n_observations=1000)
+    # artifact in the last batch only
+    data[950, 2] = 100
+    data.tofile(path)
+
+    reader = READER(path, 'float32', config, n_sec_chunk=0.3)
+    scale = get_reader_scale(reader, 'int16')
+    np.testing.assert_allclose(scale, get_scale(data, 'int16'))
+    assert get_reader_scale(reader, 'float16') is None
+
+    with caplog.at_level(logging.WARNING, logger='yass.reader'):
+        quantize(data, 'int16', scale)
+    assert caplog.records == []
+
+    with caplog.at_level(logging.WARNING, logger='yass.reader'):
+        quantize(data, 'int16', scale/100)
+    assert 'clipped' in caplog.text
@@ -0,0 +1,77 @@
+import os
+
+import numpy as np
+import pytest
+
+from yass.reader import READER
+from yass.residual.residual import RESIDUAL, subtract_templates
+
+
+def test_subtract_templates_matches_spike_by_spike_loop():
+    np.random.seed(0)
+    n_time, n_channels, n_units = 21, 10, 5
+    templates = np.random.randn(n_units, n_time, n_channels).astype('float32')
+    templates *= np.random.rand(n_units, 1, n_channels) < 0.4
+    vis_chans = [np.where(np.any(templates[k] != 0, 0))[0]
+                 for k in range(n_units)]
+
+    data = np.random.randn(500, n_channels).astype('float32')
+    spike_train = np.stack((np.random.randint(0, 500-n_time, 200),
+                            np.random.randint(0, n_units, 200)), 1)
+
+    expected = data.copy()
+    for tt, ii in spike_train:
+        expected[tt:tt+n_time] -= templates[ii]
+
+    subtract_templates(data, spike_train, templates, vis_chans,
+                       block_size=100)
+    np.testing.assert_allclose(data, expected, atol=1e-5)
+
+
+N_CHANNELS = 6
+
+
+@pytest.fixture
+def config(make_dummy_config):
+    return make_dummy_config(N_CHANNELS)
+
+
+def test_residual_written_in_place_and_read_back(make_tmp_folder, config):
+    np.random.seed(0)
+    n_time, n_units, n_observations = 21, 4, 1000
+    templates = np.random.randn(n_units, n_time, N_CHANNELS).astype('float32')
+    spike_train = np.stack((np.random.randint(n_time, n_observations-n_time,
+                                              100),
+                            np.random.randint(0, n_units, 100)), 1)
+    data = np.random.randn(n_observations, N_CHANNELS).astype('float32')
+
+    fname_templates = os.path.join(make_tmp_folder, 'templates.npy')
+    fname_spike_train = os.path.join(make_tmp_folder, 'spike_train.npy')
+    fname_data = os.path.join(make_tmp_folder, 'data.bin')
+    np.save(fname_templates, templates)
+    np.save(fname_spike_train, spike_train)
+    data.tofile(fname_data)
+
+    expected = data.copy()
+    for tt, ii in spike_train:
+        expected[tt-n_time//2:tt-n_time//2+n_time] -= templates[ii]
+
+    for dtype_out, atol in [('float32', 1e-5), ('float16', 1e-2),
+                            ('int16', 1e-2)]:
+        fname_out = os.path.join(make_tmp_folder,
+                                 'residual_{}.bin'.format(dtype_out))
+        reader = READER(fname_data, 'float32', config, n_sec_chunk=0.3)
+        residual = RESIDUAL(fname_templates, fname_spike_train, reader,
+                            fname_out, dtype_out)
+        residual.compute_residual(os.path.join(make_tmp_folder, 'segs'))
+        residual.save_residual()
+
+        assert os.path.getsize(fname_out) == expected.size*np.dtype(
+            dtype_out).itemsize
+        # no batch markers or sorted spike train left behind
+        assert os.listdir(os.path.join(make_tmp_folder, 'segs')) == []
+
+        reader_out = READER(fname_out, dtype_out, config)
+        read = reader_out.read_data(0, n_observations)
+        assert read.dtype == np.float32
+        np.testing.assert_allclose(read, expected, atol=atol)
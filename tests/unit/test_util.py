@@ -1,3 +1,7 @@
+import threading
+
+import pytest
+
 from yass import util
 
 
@@ -44,3 +48,57 @@ def test_all_args_instance_method():
 def test_args_kwargs_instance_method():
     assert util.map_parameters_in_fn_call([0], dict(b=1, c=2),
                                           obj.add) == expected
+
+
+def test_background_writer_calls_in_order_and_reraises():
+    written = []
+    with util.BackgroundWriter(lambda x, y=0: written.append(x + y),
+                               size=2) as writer:
+        for i in range(10):
+            writer.put(i, y=1)
+    assert written == list(range(1, 11))
+
+    def fail(x):
+        raise ValueError(x)
+
+    writer = util.BackgroundWriter(fail)
+    writer.put(0)
+    try:
+        writer.close()
+    except ValueError:
+        pass
+    else:
+        assert False, 'error in the writer thread was not raised'
+
+
+def test_prefetch_keeps_order_and_reraises():
+    assert list(util.prefetch(iter(range(20)), size=3)) == list(range(20))
+
+    def fail():
+        yield 0
+        yield 1
+        raise ValueError('read failed')
+
+    items = []
+    with pytest.raises(ValueError):
+        for item in util.prefetch(fail()):
+            items.append(item)
+    assert items == [0, 1]
+
+
+def test_prefetch_producer_stops_when_consumer_stops_early():
+    finished = threading.Event()
+
+    def produce():
+        try:
+            for i in range(1000):
+                yield i
+        finally:
+            finished.set()
+
+    items = util.prefetch(produce(), size=1)
+    assert next(items) == 0
+    items.close()
+
+    # the producer does not stay blocked on a full queue
+    assert finished.wait(timeout=5)
@@ -14,6 +14,13 @@ class BaseClass(object):
     pass
 
 
+class Bunch(object):
+    """Object holding the keyword arguments as attributes
+    """
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
 class TestingType(type):
     def __getattr__(self, name):
 